@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+离线批量聊天完成（/v1/batches）
+上传一个 JSONL 文件，每行一个聊天完成请求，服务端按并发上限在异步路径上执行，
+结果完成一条就追加一条到输出 JSONL。输出文件同时是检查点：中断后恢复时跳过已完成的行。
+
+输入行格式（兼容 OpenAI Batch）：
+    {"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+也可以直接是聊天完成请求体本身，此时 custom_id 为行号。
+
+运行中的批次持有 BATCH_DIR/<id>.lock 上的文件锁，同一批次同一时间只在一个进程中执行：
+平滑重启时新进程启动后就会恢复未完成的批次，此时旧进程可能还在执行它们，新进程等旧进程停下释放锁后再接着跑。
+
+批次归属创建它的客户端（认证时记录的 request.state.client_id），其他客户端查询、下载、取消、恢复都返回 404。
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import FileResponse
+
+BATCH_DIR = os.environ.get("BATCH_DIR", "batches")
+BATCH_DEFAULT_CONCURRENCY = int(os.environ.get("BATCH_DEFAULT_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "32"))
+BATCH_MAX_INPUT_BYTES = int(os.environ.get("BATCH_MAX_INPUT_BYTES", str(200 * 1024 * 1024)))
+BATCH_STATE_SAVE_INTERVAL = 1.0  # 秒
+BATCH_LOCK_RETRY_INTERVAL = 1.0  # 秒，批次被其他进程锁定时的重试间隔
+
+# 执行单行请求的函数，由 main.py 注册：接收请求体字典和批次所属的客户端，返回响应体字典，失败时抛出 HTTPException
+BatchRunner = Callable[[Dict[str, Any], Optional[str]], Awaitable[Dict[str, Any]]]
+_runner: Optional[BatchRunner] = None
+
+_batches: Dict[str, Dict[str, Any]] = {}
+_tasks: Dict[str, asyncio.Task] = {}
+
+
+def configure_batch_runner(runner: BatchRunner):
+    global _runner
+    _runner = runner
+
+
+def _path(batch_id: str, kind: str) -> str:
+    return os.path.join(BATCH_DIR, f"{batch_id}.{kind}")
+
+
+def _save_state(batch: Dict[str, Any]):
+    tmp_path = _path(batch["id"], "json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(batch, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, _path(batch["id"], "json"))
+
+
+def _load_state(batch_id: str) -> Optional[Dict[str, Any]]:
+    if batch_id in _batches:
+        return _batches[batch_id]
+    try:
+        with open(_path(batch_id, "json"), "r", encoding="utf-8") as f:
+            batch = json.load(f)
+    except FileNotFoundError:
+        return None
+    _batches[batch_id] = batch
+    return batch
+
+
+def _scan_output(batch_id: str) -> Tuple[Set[int], int, int]:
+    """从输出文件中读取检查点，返回 (已完成的行号, 成功数, 失败数)"""
+    done = set()
+    failed = 0
+    try:
+        with open(_path(batch_id, "output.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    done.add(result["line"])
+                except (ValueError, KeyError):
+                    # 进程中断时可能留下半行，忽略后该行会被重新执行
+                    continue
+                if result.get("error"):
+                    failed += 1
+    except FileNotFoundError:
+        pass
+    return done, len(done) - failed, failed
+
+
+def _parse_line(raw: str, line_number: int):
+    """解析输入行，返回 (custom_id, 请求体)"""
+    item = json.loads(raw)
+    if not isinstance(item, dict):
+        raise ValueError("Each line must be a JSON object.")
+    if "body" in item:
+        url = item.get("url", "/v1/chat/completions")
+        if url != "/v1/chat/completions":
+            raise ValueError(f"Unsupported url: {url}")
+        return str(item.get("custom_id", line_number)), item["body"]
+    return str(line_number), item
+
+
+async def _run_line(raw: str, line_number: int, owner: Optional[str]) -> Dict[str, Any]:
+    """执行一行请求，错误记录在结果中，不中断整个批次"""
+    custom_id = str(line_number)
+    result: Dict[str, Any] = {"id": f"batch_req_{uuid.uuid4().hex}", "line": line_number}
+    try:
+        custom_id, body = _parse_line(raw, line_number)
+        response_body = await _runner(body, owner)
+        result["response"] = {"status_code": 200, "body": response_body}
+        result["error"] = None
+    except HTTPException as e:
+        result["response"] = {"status_code": e.status_code, "body": None}
+        result["error"] = {"code": "upstream_error", "message": str(e.detail)}
+    except ValueError as e:
+        result["response"] = None
+        result["error"] = {"code": "invalid_request", "message": str(e)}
+    except Exception as e:
+        result["response"] = None
+        result["error"] = {"code": "internal_error", "message": str(e)}
+    result["custom_id"] = custom_id
+    return result
+
+
+def _try_lock(batch_id: str) -> Optional[int]:
+    """以非阻塞方式锁定批次，返回持有锁的文件描述符；已被其他进程锁定时返回 None"""
+    fd = os.open(_path(batch_id, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+async def _lock_batch(batch_id: str) -> int:
+    fd = _try_lock(batch_id)
+    if fd is None:
+        print(f"Batch {batch_id} is running in another process, waiting for it to stop")
+    while fd is None:
+        await asyncio.sleep(BATCH_LOCK_RETRY_INTERVAL)
+        fd = _try_lock(batch_id)
+    return fd
+
+
+async def _run_batch(batch_id: str):
+    lock_fd = None
+    try:
+        lock_fd = await _lock_batch(batch_id)
+        await _execute_batch(batch_id)
+    finally:
+        if lock_fd is not None:
+            os.close(lock_fd)  # 关闭描述符即释放锁
+        _tasks.pop(batch_id, None)
+
+
+async def _execute_batch(batch_id: str):
+    batch = _batches[batch_id]
+    done, completed, failed = await asyncio.to_thread(_scan_output, batch_id)
+    batch["request_counts"].update({"completed": completed, "failed": failed})
+    semaphore = asyncio.Semaphore(batch["concurrency"])
+    write_lock = asyncio.Lock()
+    pending: Set[asyncio.Task] = set()
+    last_saved = 0.0
+
+    batch["status"] = "in_progress"
+    batch["in_progress_at"] = batch.get("in_progress_at") or int(time.time())
+    await asyncio.to_thread(_save_state, batch)
+
+    async def run_one(raw: str, line_number: int):
+        nonlocal last_saved
+        try:
+            result = await _run_line(raw, line_number, batch.get("owner"))
+            async with write_lock:
+                with open(_path(batch_id, "output.jsonl"), "a", encoding="utf-8") as out:
+                    out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                counts = batch["request_counts"]
+                counts["failed" if result["error"] else "completed"] += 1
+                now = time.monotonic()
+                if now - last_saved >= BATCH_STATE_SAVE_INTERVAL:
+                    last_saved = now
+                    await asyncio.to_thread(_save_state, batch)
+        finally:
+            semaphore.release()
+
+    try:
+        with open(_path(batch_id, "input.jsonl"), "r", encoding="utf-8") as f:
+            for line_number, raw in enumerate(f, start=1):
+                if batch["status"] == "cancelling":
+                    break
+                if line_number in done or not raw.strip():
+                    continue
+                # 先拿到并发名额再创建任务，保证同时存在的任务数不超过并发上限
+                await semaphore.acquire()
+                task = asyncio.create_task(run_one(raw, line_number))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.gather(*pending)
+        batch["status"] = "cancelled" if batch["status"] == "cancelling" else "completed"
+        batch["completed_at"] = int(time.time())
+    except asyncio.CancelledError:
+        # 进程退出：保持 in_progress 状态，启动后自动恢复
+        for task in pending:
+            task.cancel()
+        raise
+    except Exception as e:
+        batch["status"] = "failed"
+        batch["errors"] = [{"message": str(e)}]
+    finally:
+        await asyncio.to_thread(_save_state, batch)
+
+
+def _start(batch_id: str):
+    if batch_id not in _tasks:
+        _tasks[batch_id] = asyncio.create_task(_run_batch(batch_id))
+
+
+def resume_pending_batches():
+    """启动时恢复上次未完成的批次"""
+    if not os.path.isdir(BATCH_DIR):
+        return
+    for name in os.listdir(BATCH_DIR):
+        if not name.endswith(".json"):
+            continue
+        batch = _load_state(name[: -len(".json")])
+        if batch and batch["status"] in ("validating", "in_progress", "cancelling"):
+            if batch["status"] == "cancelling":
+                batch["status"] = "cancelled"
+                _save_state(batch)
+                continue
+            print(f"Resuming batch {batch['id']}")
+            _start(batch["id"])
+
+
+async def shutdown_batches():
+    """停止运行中的批次，状态保留为 in_progress 以便下次启动时恢复"""
+    tasks = list(_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _public(batch: Dict[str, Any]) -> Dict[str, Any]:
+    done = batch["request_counts"]["completed"] + batch["request_counts"]["failed"]
+    total = batch["request_counts"]["total"]
+    public = {key: value for key, value in batch.items() if key != "owner"}
+    public["progress"] = round(done / total, 4) if total else 1.0
+    return public
+
+
+def _client_id(request: Request) -> Optional[str]:
+    return getattr(request.state, "client_id", None)
+
+
+def _owned_batch(batch_id: str, request: Request) -> Dict[str, Any]:
+    """取出属于当前客户端的批次；不存在或属于其他客户端时一律 404，不暴露批次是否存在"""
+    batch = _load_state(batch_id)
+    if not batch or batch.get("owner") != _client_id(request):
+        raise HTTPException(status_code=404, detail=f"Batch '{batch_id}' not found.")
+    return batch
+
+
+# 创建路由器
+batch_router = APIRouter(prefix="/v1/batches", tags=["batches"])
+
+
+@batch_router.post("")
+async def create_batch(request: Request, concurrency: int = Query(BATCH_DEFAULT_CONCURRENCY, ge=1)):
+    """上传 JSONL 请求文件并开始执行"""
+    if _runner is None:
+        raise HTTPException(status_code=503, detail="Batch runner is not configured.")
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    size = 0
+    total = 0
+    last_byte = b"\n"
+    try:
+        with open(_path(batch_id, "input.jsonl"), "wb") as f:
+            async for chunk in request.stream():
+                if not chunk:
+                    continue
+                size += len(chunk)
+                if size > BATCH_MAX_INPUT_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Batch input exceeds {BATCH_MAX_INPUT_BYTES} bytes.")
+                total += chunk.count(b"\n")
+                last_byte = chunk[-1:]
+                f.write(chunk)
+    except HTTPException:
+        os.remove(_path(batch_id, "input.jsonl"))
+        raise
+    if last_byte != b"\n":
+        total += 1
+    if total == 0:
+        os.remove(_path(batch_id, "input.jsonl"))
+        raise HTTPException(status_code=400, detail="Batch input is empty.")
+
+    batch = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": "/v1/chat/completions",
+        "status": "validating",
+        "concurrency": min(concurrency, BATCH_MAX_CONCURRENCY),
+        "created_at": int(time.time()),
+        "in_progress_at": None,
+        "completed_at": None,
+        "request_counts": {"total": total, "completed": 0, "failed": 0},
+        "errors": None,
+        "owner": _client_id(request),
+    }
+    _batches[batch_id] = batch
+    await asyncio.to_thread(_save_state, batch)
+    _start(batch_id)
+    return _public(batch)
+
+
+@batch_router.get("")
+async def list_batches(request: Request):
+    """列出当前进程已知的、属于当前客户端的批次"""
+    owner = _client_id(request)
+    return {"object": "list", "data": [_public(batch) for batch in _batches.values() if batch.get("owner") == owner]}
+
+
+@batch_router.get("/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    """查询批次状态和进度"""
+    return _public(_owned_batch(batch_id, request))
+
+
+@batch_router.get("/{batch_id}/output")
+async def get_batch_output(batch_id: str, request: Request):
+    """下载结果 JSONL（批次运行中也可下载已完成的部分）"""
+    _owned_batch(batch_id, request)
+    path = _path(batch_id, "output.jsonl")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="No results yet.")
+    return FileResponse(path, media_type="application/jsonl", filename=f"{batch_id}.output.jsonl")
+
+
+@batch_router.post("/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, request: Request):
+    """取消批次：不再启动新的请求，已在执行的请求完成后结束"""
+    batch = _owned_batch(batch_id, request)
+    if batch["status"] in ("validating", "in_progress"):
+        batch["status"] = "cancelling" if batch_id in _tasks else "cancelled"
+        await asyncio.to_thread(_save_state, batch)
+    return _public(batch)
+
+
+@batch_router.post("/{batch_id}/resume")
+async def resume_batch(batch_id: str, request: Request, concurrency: Optional[int] = Query(None, ge=1)):
+    """从检查点继续执行未完成（或被取消、失败）的批次"""
+    batch = _owned_batch(batch_id, request)
+    if batch_id in _tasks:
+        return _public(batch)
+    if batch["status"] == "completed":
+        raise HTTPException(status_code=409, detail="Batch is already completed.")
+    if concurrency:
+        batch["concurrency"] = min(concurrency, BATCH_MAX_CONCURRENCY)
+    batch["status"] = "in_progress"
+    _start(batch_id)
+    return _public(batch)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+基准测试使用的固定输入数据
+全部由固定种子生成，保证每次运行的输入完全一致，结果可以和保存的基线比较
+"""
+
+import json
+import random
+
+SEED = 20250713
+
+_WORDS = (
+    "the quick brown fox jumps over lazy dog tenbin gateway stream token delta "
+    "请 帮 我 总结 一下 这段 代码 的 性能 问题 并 给出 优化 建议"
+).split()
+
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(_WORDS) for _ in range(words))
+
+
+def chat_history(turns: int, words_per_message: int, seed: int = SEED):
+    """生成 system + 多轮 user/assistant 的纯文本历史"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": _text(rng, 40)}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": _text(rng, words_per_message)})
+        messages.append({"role": "assistant", "content": _text(rng, words_per_message * 2)})
+    messages.append({"role": "user", "content": _text(rng, words_per_message)})
+    return messages
+
+
+def multimodal_history(turns: int, seed: int = SEED):
+    """生成包含文本和图片片段的多模态历史"""
+    rng = random.Random(seed)
+    messages = [{"role": "system", "content": _text(rng, 40)}]
+    for i in range(turns):
+        messages.append({
+            "role": "user",
+            "content": [
+                {"type": "text", "text": _text(rng, 60)},
+                {"type": "image_url", "image_url": {"url": f"https://example.com/image-{i}.png"}},
+                {"type": "text", "text": _text(rng, 20)},
+            ],
+        })
+        messages.append({"role": "assistant", "content": _text(rng, 120)})
+    return messages
+
+
+SHORT_HISTORY = chat_history(turns=1, words_per_message=20)
+LONG_HISTORY = chat_history(turns=100, words_per_message=200)
+MULTIMODAL_HISTORY = multimodal_history(turns=20)
+
+
+def delta_tokens(count: int, seed: int = SEED):
+    """生成上游增量片段，长度分布接近真实流量（多数为 1-4 个词）"""
+    rng = random.Random(seed)
+    return [_text(rng, rng.randint(1, 4)) + " " for _ in range(count)]
+
+
+def upstream_frames(tokens):
+    """把增量片段包装成上游 graphql-transport-ws 的 next 帧"""
+    frames = []
+    for seq, token in enumerate(tokens):
+        frames.append(json.dumps({
+            "id": "bench",
+            "type": "next",
+            "payload": {
+                "data": {
+                    "startConversation": {
+                        "seq": seq,
+                        "deltaToken": token,
+                        "isFinished": False,
+                        "newStateToken": None,
+                        "error": None,
+                        "fileUploadIds": None,
+                        "toolResult": None,
+                        "action": None,
+                        "activity": None,
+                        "toolError": None,
+                        "__typename": "AIConversationStreamResult",
+                    }
+                }
+            },
+        }))
+    return frames
+
+
+STREAM_TOKENS = delta_tokens(500)
+UPSTREAM_FRAMES = upstream_frames(STREAM_TOKENS)
+# 思考模型：前 300 个片段是思考内容，分隔符之后是回答
+REASONING_TOKENS = STREAM_TOKENS[:300] + ["\n\n---\n\n"] + STREAM_TOKENS[300:]
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""基准测试公共配置：让基准测试可以直接导入仓库根目录下的模块"""
+
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+并发流的内存剖析（tracemalloc）
+
+用进程内的上游替身代替 Tenbin（不连网络、不获取令牌），驱动完整的流式路径：
+UpstreamAttempt 线程、思考/回答拆分、增量合并、SSE 编码和回放缓冲。
+所有流都输出到一半时上游暂停，此时拍快照，与启动前的快照比较，
+报告每个活动流占用的字节数和分配热点，然后放行上游让流正常结束。
+
+    python benchmarks/memory_profile.py                       # 依次测 10、100、1000 个并发流
+    python benchmarks/memory_profile.py --streams 100 --tokens 400 --top 15
+    python benchmarks/memory_profile.py --model Claude-3.7-Sonnet-Extended   # 含思考内容的模型
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import websocket  # noqa: E402
+
+import main  # noqa: E402
+from bench_data import REASONING_TOKENS, STREAM_TOKENS  # noqa: E402
+from stream_replay import ReplayRegistry  # noqa: E402
+
+
+class StandInUpstream:
+    """模拟上游 graphql-transport-ws 连接：输出一半增量后等待放行，再输出剩余部分"""
+
+    def __init__(self, tokens, paused: threading.Semaphore, release: threading.Event):
+        self._frames = [json.dumps({"type": "connection_ack"})]
+        for seq, token in enumerate(tokens):
+            self._frames.append(json.dumps({
+                "id": "1",
+                "type": "next",
+                "payload": {"data": {"startConversation": {"seq": seq, "deltaToken": token, "isFinished": False}}},
+            }))
+        self._frames.append(json.dumps({
+            "id": "1",
+            "type": "next",
+            "payload": {"data": {"startConversation": {"seq": len(tokens), "deltaToken": "", "isFinished": True,
+                                                        "newStateToken": "stand-in"}}},
+        }))
+        self._frames.append('{"id":"1","type":"complete"}')
+        self._pause_at = 1 + len(tokens) // 2
+        self._index = 0
+        self._paused = paused
+        self._release = release
+        self._timeout = None
+        self._closed = False
+
+    def send(self, frame):
+        pass
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def recv(self):
+        if self._closed or self._index >= len(self._frames):
+            raise websocket.WebSocketConnectionClosedException("stand-in closed")
+        if self._index == self._pause_at:
+            if self._paused is not None:
+                self._paused.release()
+                self._paused = None
+            if not self._release.wait(self._timeout):
+                raise websocket.WebSocketTimeoutException("stand-in paused")
+        frame = self._frames[self._index]
+        self._index += 1
+        return frame
+
+    def close(self):
+        self._closed = True
+
+    def abort(self):
+        self._closed = True
+
+
+def install_stand_in(tokens, paused: threading.Semaphore, release: threading.Event):
+    """把上游连接和令牌获取替换为替身"""
+    main.websocket.create_connection = lambda *args, **kwargs: StandInUpstream(tokens, paused, release)
+    main.acquire_upstream_session = lambda *args, **kwargs: {
+        "session_id": "stand-in",
+        "execution_token": "stand-in",
+        "file_upload_ids": [],
+        "state_token": "",
+    }
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+async def profile(streams: int, model: str, tokens, top: int):
+    paused = threading.Semaphore(0)
+    release = threading.Event()
+    install_stand_in(tokens, paused, release)
+    request = main.ChatCompletionRequest(model=model, messages=[{"role": "user", "content": "hi"}], stream=True)
+    prompt = main.build_tenbin_prompt(request.messages)
+    # 每轮使用新的回放注册表，上一轮已结束流的缓冲不会留到下一轮
+    replay_registry = ReplayRegistry()
+    replay_registry.heartbeat = main.replay_registry.heartbeat
+
+    async def consume(stream_id: str):
+        deadline = main.request_deadline()
+        events = main.stream_completion_events(request, model, prompt, [], deadline, stream_id)
+        if main.SSE_RESUME_ENABLED:
+            events = replay_registry.read(replay_registry.start(stream_id, events))
+        received = 0
+        async for event in events:
+            received += len(event)
+        return received
+
+    gc.collect()
+    baseline = tracemalloc.take_snapshot()
+    rss_before = current_rss()
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(consume(f"chatcmpl-profile-{i}")) for i in range(streams)]
+
+    # 等所有上游都停在一半
+    for _ in range(streams):
+        await asyncio.to_thread(paused.acquire)
+    await asyncio.sleep(0.2)  # 让事件循环处理完已送达的片段
+    gc.collect()
+    snapshot = tracemalloc.take_snapshot()
+    rss_during = current_rss()
+
+    release.set()
+    received = sum(await asyncio.gather(*tasks))
+    elapsed = time.perf_counter() - started
+
+    stats = snapshot.compare_to(baseline, "lineno")
+    allocated = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    print(f"\n=== {streams} concurrent streams, model={model}, {len(tokens)} tokens each ===")
+    print(f"traced bytes per active stream: {allocated / streams:,.0f}")
+    print(f"RSS growth per active stream:   {(rss_during - rss_before) / streams:,.0f}")
+    print(f"total traced growth:            {allocated:,} bytes")
+    print(f"SSE bytes delivered:            {received:,} in {elapsed:.2f}s")
+    print(f"top {top} allocation sites while streaming:")
+    for stat in stats[:top]:
+        frame = stat.traceback[0]
+        filename = os.path.relpath(frame.filename, ROOT_DIR) if frame.filename.startswith(ROOT_DIR) else frame.filename
+        print(f"  {stat.size_diff / streams:>10,.0f} B/stream  {stat.count_diff:>+8} blocks  {filename}:{frame.lineno}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Profile gateway memory per concurrent stream with tracemalloc")
+    parser.add_argument("--streams", type=int, nargs="+", default=[10, 100, 1000], help="concurrent stream counts")
+    parser.add_argument("--model", default="Claude-3.7-Sonnet", help="model name passed to the stream path")
+    parser.add_argument("--tokens", type=int, default=0, help="tokens per stream (default: the benchmark dataset)")
+    parser.add_argument("--top", type=int, default=10, help="number of allocation sites to show")
+    parser.add_argument("--frames", type=int, default=1, help="traceback depth recorded by tracemalloc")
+    return parser.parse_args(argv)
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    tokens = REASONING_TOKENS if args.model == "Claude-3.7-Sonnet-Extended" else STREAM_TOKENS
+    if args.tokens:
+        tokens = (tokens * (args.tokens // len(tokens) + 1))[:args.tokens]
+    main.TENBIN_MODELS.setdefault(args.model, args.model)
+
+    tracemalloc.start(args.frames)
+    for streams in args.streams:
+        asyncio.run(profile(streams, args.model, tokens, args.top))
+    tracemalloc.stop()
+
+
+if __name__ == "__main__":
+    run()
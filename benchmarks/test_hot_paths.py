@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+网关热点函数的微基准测试（pytest-benchmark）
+
+benchmarks/baselines/<平台>/0001_baseline.json 是提交在仓库中的基线。与基线比较，平均耗时回退超过 15% 时失败：
+    pytest benchmarks --benchmark-only --benchmark-storage=benchmarks/baselines \
+        --benchmark-compare=0001 --benchmark-compare-fail=mean:15%
+
+基线只在同类机器上可比。换了基准机器或有意改变性能时，重新生成并提交基线：
+    rm -r benchmarks/baselines
+    pytest benchmarks --benchmark-only --benchmark-storage=benchmarks/baselines --benchmark-save=baseline
+"""
+
+import json
+import types
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from fastapi.security import HTTPAuthorizationCredentials
+
+import main
+from bench_data import (
+    LONG_HISTORY,
+    MULTIMODAL_HISTORY,
+    REASONING_TOKENS,
+    SHORT_HISTORY,
+    STREAM_TOKENS,
+    UPSTREAM_FRAMES,
+)
+
+STREAM_ID = "chatcmpl-benchmark"
+CREATED = 1700000000
+MODEL = "Claude-3.7-Sonnet-Extended"
+# 按名称参数化：参数值会写入基线 JSON，直接用数据集作参数会把整份数据复制进基线
+HISTORIES = {"short": SHORT_HISTORY, "long": LONG_HISTORY, "multimodal": MULTIMODAL_HISTORY}
+
+
+@pytest.mark.parametrize("name", list(HISTORIES), ids=list(HISTORIES))
+def test_build_tenbin_prompt(benchmark, name):
+    history = HISTORIES[name]
+    messages = [main.ChatMessage(**message) for message in history]
+    prompt = benchmark(main.build_tenbin_prompt, messages)
+    assert prompt.endswith("\n\nAssistant:")
+
+
+@pytest.mark.parametrize("name", list(HISTORIES), ids=list(HISTORIES))
+def test_ingest_chat_request(benchmark, name):
+    history = HISTORIES[name]
+    body = json.dumps({"model": MODEL, "messages": history, "stream": True}).encode("utf-8")
+
+    def ingest():
+        request = main.chat_request_decoder.decode(body)
+        return main.build_tenbin_prompt(request.messages)
+
+    prompt = benchmark(ingest)
+    assert prompt == main.build_tenbin_prompt([main.ChatMessage(**message) for message in history])
+
+
+def test_encode_stream_chunk(benchmark):
+    def encode_all():
+        return [
+            main.encode_stream_chunk(STREAM_ID, CREATED, MODEL, {"content": token})
+            for token in STREAM_TOKENS
+        ]
+
+    chunks = benchmark(encode_all)
+    assert len(chunks) == len(STREAM_TOKENS)
+
+
+def test_decode_upstream_frame(benchmark):
+    def decode_all():
+        return [main.decode_upstream_frame(frame)["deltaToken"] for frame in UPSTREAM_FRAMES]
+
+    tokens = benchmark(decode_all)
+    assert tokens == STREAM_TOKENS
+
+
+def test_reasoning_split(benchmark):
+    def split_all():
+        splitter = main.ReasoningSplitter(True)
+        segments = []
+        for token in REASONING_TOKENS:
+            segments.extend(splitter.feed(token))
+        segments.extend(splitter.finish())
+        return segments
+
+    segments = benchmark(split_all)
+    assert segments[0][0] == "reasoning_content"
+    assert segments[-1][0] == "content"
+
+
+def test_delta_coalescing(benchmark):
+    def coalesce_all():
+        coalescer = main.DeltaCoalescer(max_delay_ms=60000, max_bytes=4096)
+        segments = []
+        for token in STREAM_TOKENS:
+            segments.extend(coalescer.push("content", token))
+        segments.extend(coalescer.flush())
+        return segments
+
+    segments = benchmark(coalesce_all)
+    assert "".join(text for _, text in segments) == "".join(STREAM_TOKENS)
+
+
+def test_aggregate_segments(benchmark):
+    segments = [("content", token) for token in STREAM_TOKENS] + [("finish", "stop")]
+
+    content, reasoning = benchmark(main.aggregate_segments, segments)
+    assert content == "".join(STREAM_TOKENS)
+    assert reasoning is None
+
+
+def test_authenticate_client(benchmark, monkeypatch):
+    keys = {f"sk-bench-{i:04d}" for i in range(1000)}
+    monkeypatch.setattr(main, "VALID_CLIENT_KEYS", keys)
+    credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials="sk-bench-0500")
+    request = types.SimpleNamespace(state=types.SimpleNamespace())
+
+    def authenticate():
+        # 协程内部没有 await，直接驱动到结束，避免把事件循环开销算进去
+        coroutine = main.authenticate_client(request, credentials)
+        try:
+            coroutine.send(None)
+        except StopIteration:
+            pass
+
+    benchmark(authenticate)
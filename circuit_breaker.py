@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游操作的熔断器
+每个上游操作（获取执行令牌、WebSocket 订阅）一个熔断器，按滑动窗口内的错误率和慢调用率判断：
+closed（正常）→ open（直接拒绝，返回 503 和 Retry-After）→ half-open（放行一个探测请求）→ closed/open。
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+from fastapi import HTTPException
+
+BREAKER_ENABLED = os.environ.get("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "60"))  # 秒，统计窗口
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "10"))  # 窗口内调用数不足时不打开
+BREAKER_FAILURE_RATE = float(os.environ.get("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_RATE = float(os.environ.get("BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", "30"))  # 打开后多久进入半开
+BREAKER_TOKEN_SLOW_SECONDS = float(os.environ.get("BREAKER_TOKEN_SLOW_SECONDS", "45"))
+BREAKER_STREAM_SLOW_SECONDS = float(os.environ.get("BREAKER_STREAM_SLOW_SECONDS", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(HTTPException):
+    """熔断器打开时抛出，直接作为 503 响应返回"""
+
+    def __init__(self, name: str, retry_after: float):
+        self.breaker = name
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(
+            status_code=503,
+            detail=f"Upstream {name} is temporarily unavailable (circuit open), retry after {self.retry_after}s.",
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+class CircuitBreaker:
+    """按滑动窗口内的错误率和慢调用率开关的熔断器"""
+
+    def __init__(
+        self,
+        name: str,
+        slow_call_seconds: float,
+        failure_rate: float = BREAKER_FAILURE_RATE,
+        slow_call_rate: float = BREAKER_SLOW_CALL_RATE,
+        min_calls: int = BREAKER_MIN_CALLS,
+        window: float = BREAKER_WINDOW,
+        open_seconds: float = BREAKER_OPEN_SECONDS,
+    ):
+        self.name = name
+        self.slow_call_seconds = slow_call_seconds
+        self.failure_rate = failure_rate
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.open_count = 0
+        self._probe_started = 0.0  # 半开状态下正在进行的探测请求的开始时间，0 表示没有
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()  # (时间, 是否失败, 是否慢调用)
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        cutoff = now - self.window
+        while self._calls and self._calls[0][0] < cutoff:
+            self._calls.popleft()
+
+    def _open(self, now: float):
+        self.state = OPEN
+        self.opened_at = now
+        self.open_count += 1
+        self._probe_started = 0.0
+        self._calls.clear()
+
+    def before_call(self):
+        """调用上游前检查；打开时抛出 CircuitOpenError"""
+        if not BREAKER_ENABLED:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    raise CircuitOpenError(self.name, remaining)
+                self.state = HALF_OPEN
+            # 半开：同一时间只放行一个探测请求，探测结果迟迟不回来时允许重新探测
+            if self._probe_started and now - self._probe_started < self.open_seconds:
+                raise CircuitOpenError(self.name, self._probe_started + self.open_seconds - now)
+            self._probe_started = now
+
+    def check(self):
+        """只读检查：此刻调用会被拒绝时抛出 CircuitOpenError，不改变状态，也不占用半开状态的探测名额"""
+        if not BREAKER_ENABLED:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self.state == OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    raise CircuitOpenError(self.name, remaining)
+            elif self.state == HALF_OPEN and self._probe_started and now - self._probe_started < self.open_seconds:
+                raise CircuitOpenError(self.name, self._probe_started + self.open_seconds - now)
+
+    def record(self, duration: float, failed: bool):
+        """记录一次调用结果"""
+        if not BREAKER_ENABLED:
+            return
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            now = time.monotonic()
+            if self.state == HALF_OPEN:
+                if failed or slow:
+                    self._open(now)
+                else:
+                    self.state = CLOSED
+                    self._probe_started = 0.0
+                    self._calls.clear()
+                return
+            if self.state == OPEN:
+                return
+
+            self._trim(now)
+            self._calls.append((now, failed, slow))
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                self._open(now)
+
+    def record_success(self, duration: float):
+        self.record(duration, False)
+
+    def record_failure(self, duration: float):
+        self.record(duration, True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            total = len(self._calls)
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            state = self.state
+            retry_after = None
+            if state == OPEN:
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    retry_after = round(remaining, 1)
+                else:
+                    state = HALF_OPEN
+        return {
+            "state": state,
+            "calls": total,
+            "failure_rate": round(failures / total, 4) if total else 0.0,
+            "slow_call_rate": round(slow_calls / total, 4) if total else 0.0,
+            "slow_call_seconds": self.slow_call_seconds,
+            "open_count": self.open_count,
+            "retry_after": retry_after,
+        }
+
+
+token_breaker = CircuitBreaker("token_issuance", BREAKER_TOKEN_SLOW_SECONDS)
+stream_breaker = CircuitBreaker("websocket_subscription", BREAKER_STREAM_SLOW_SECONDS)
+
+
+def breaker_states() -> Dict[str, Dict[str, Any]]:
+    return {breaker.name: breaker.snapshot() for breaker in (token_breaker, stream_breaker)}
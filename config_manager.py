@@ -3,18 +3,38 @@
 """
 配置文件管理API端点
 用于支持chat.html的设置保存功能
+
+另有服务端对话存储（/config/conversations），对话历史可以在设备之间同步，
+聊天请求带 conversation_id 时由网关从存储的历史构建提示，客户端不必每轮上传完整历史：
+- 每个对话一个只追加的 JSONL 日志（消息记录，以及删除、清空的标记记录）和一个元数据文件
+  （标题、消息数、消息字节数、下一个序号）
+- 消息按序号分页读取：before / after 游标，只返回客户端需要显示的最近一段
+- 内存中缓存每个对话的消息偏移索引，读取一页只需按偏移读取对应的行
+- 删除、清空只追加标记；失效记录超过一半时重写日志
+- 对话归属创建它的客户端（元数据中记录客户端 API Key 的哈希），其他客户端读写时按不存在处理
 """
 
+import bisect
 import json
 import os
+import re
+import threading
+from collections import OrderedDict
 from datetime import datetime
-from fastapi import APIRouter, HTTPException
+from typing import Any, Dict, List, Optional, Union
+from fastapi import APIRouter, HTTPException, Query, Request
 from pydantic import BaseModel
 
 # 配置文件路径
 CONFIG_FILE = 'tenbin_config.json'
 SESSIONS_FILE = 'tenbin_sessions.json'
 TENBIN_FILE = 'tenbin.json'  # 第三方服务凭证文件
+CONVERSATION_DIR = os.environ.get('CONVERSATION_DIR', 'conversations')
+CONVERSATION_PAGE_LIMIT = int(os.environ.get('CONVERSATION_PAGE_LIMIT', '200'))  # 单页最多返回的消息数
+CONVERSATION_HISTORY_LIMIT = int(os.environ.get('CONVERSATION_HISTORY_LIMIT', '500'))  # 网关构建提示时最多读取的历史消息数
+CONVERSATION_INDEX_CACHE_SIZE = int(os.environ.get('CONVERSATION_INDEX_CACHE_SIZE', '256'))
+CONVERSATION_COMPACT_MIN_BYTES = 64 * 1024  # 日志小于该值时不重写
+CONVERSATION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,128}$')
 
 # 数据模型
 class ConfigData(BaseModel):
@@ -34,6 +54,25 @@ class SessionData(BaseModel):
     created_at: str = None
     updated_at: str = None
 
+class ConversationMeta(BaseModel):
+    title: str = None
+    created_at: str = None
+
+class StoredMessage(BaseModel):
+    id: str = None
+    seq: int = None  # 省略时由服务端分配；给出时必须大于对话中已有的序号
+    role: str
+    content: Union[str, List[Dict[str, Any]]]
+    reasoning_content: Optional[str] = None
+    timestamp: str = None
+
+class MessageAppend(BaseModel):
+    messages: List[StoredMessage]
+    title: str = None
+
+class MessageDeletion(BaseModel):
+    ids: List[str]
+
 def load_config():
     """加载配置文件"""
     if os.path.exists(CONFIG_FILE):
@@ -140,6 +179,308 @@ def save_tenbin_session_id(session_id):
         print(f"保存到 tenbin.json 失败: {e}")
         return False
 
+class ConversationConflict(Exception):
+    """追加的消息序号不大于已有序号"""
+
+
+class ConversationIndex:
+    """一个对话日志中有效消息的序号、ID 和行偏移，序号递增"""
+
+    __slots__ = ('seqs', 'entries', 'ids')
+
+    def __init__(self):
+        self.seqs: List[int] = []
+        self.entries: Dict[int, tuple] = {}  # 序号 -> (偏移, 长度, 消息 ID)
+        self.ids: Dict[str, int] = {}  # 消息 ID -> 序号
+
+    def add(self, seq: int, offset: int, length: int, message_id: str):
+        self.seqs.append(seq)
+        self.entries[seq] = (offset, length, message_id)
+        self.ids[message_id] = seq
+
+    def remove(self, seqs):
+        removed = set(seqs) & self.entries.keys()
+        if removed:
+            for seq in removed:
+                del self.ids[self.entries.pop(seq)[2]]
+            self.seqs = [seq for seq in self.seqs if seq not in removed]
+        return removed
+
+    @property
+    def live_bytes(self) -> int:
+        return sum(length for _, length, _ in self.entries.values())
+
+
+class ConversationStore:
+    """服务端对话存储，消息只追加写入，按序号游标分页读取"""
+
+    def __init__(self, directory: str = CONVERSATION_DIR, cache_size: int = CONVERSATION_INDEX_CACHE_SIZE):
+        self.directory = directory
+        self.cache_size = cache_size
+        self._indexes: "OrderedDict[str, ConversationIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _path(self, conversation_id: str, kind: str) -> str:
+        if not CONVERSATION_ID_PATTERN.match(conversation_id):
+            raise ValueError(f"Invalid conversation id: {conversation_id!r}")
+        return os.path.join(self.directory, f"{conversation_id}.{kind}")
+
+    def _load_meta(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self._path(conversation_id, 'json'), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _save_meta(self, meta: Dict[str, Any]):
+        tmp_path = self._path(meta['id'], 'json.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self._path(meta['id'], 'json'))
+
+    def _require_meta(self, conversation_id: str, owner: Optional[str]) -> Dict[str, Any]:
+        """取出属于 owner 的对话元数据；不存在或属于其他客户端时一律抛出 KeyError"""
+        meta = self._load_meta(conversation_id)
+        if meta is None or meta.get('owner') != owner:
+            raise KeyError(conversation_id)
+        return meta
+
+    def _index(self, conversation_id: str) -> ConversationIndex:
+        """取得对话的偏移索引，不在缓存中时扫描一遍日志"""
+        index = self._indexes.get(conversation_id)
+        if index is not None:
+            self._indexes.move_to_end(conversation_id)
+            return index
+        index = ConversationIndex()
+        path = self._path(conversation_id, 'jsonl')
+        try:
+            with open(path, 'rb') as f:
+                offset = 0
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # 进程中断时留下的半行，截掉后再继续追加
+                        f.close()
+                        os.truncate(path, offset)
+                        break
+                    record = json.loads(line)
+                    op = record.get('op')
+                    if op == 'delete':
+                        index.remove(record['seqs'])
+                    elif op == 'clear':
+                        index = ConversationIndex()
+                    else:
+                        index.add(record['seq'], offset, len(line), record['id'])
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+        self._indexes[conversation_id] = index
+        while len(self._indexes) > self.cache_size:
+            self._indexes.popitem(last=False)
+        return index
+
+    def _append_lines(self, conversation_id: str, records: List[Dict[str, Any]]) -> List[tuple]:
+        """把记录追加到日志末尾，返回每条记录的 (偏移, 长度)"""
+        lines = [(json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8') for record in records]
+        with open(self._path(conversation_id, 'jsonl'), 'ab') as f:
+            offset = f.tell()
+            f.write(b''.join(lines))
+        positions = []
+        for line in lines:
+            positions.append((offset, len(line)))
+            offset += len(line)
+        return positions
+
+    def _read(self, conversation_id: str, index: ConversationIndex, seqs: List[int]) -> List[Dict[str, Any]]:
+        if not seqs:
+            return []
+        messages = []
+        with open(self._path(conversation_id, 'jsonl'), 'rb') as f:
+            for seq in seqs:
+                offset, length, _ = index.entries[seq]
+                f.seek(offset)
+                messages.append(json.loads(f.read(length)))
+        return messages
+
+    def _update_stats(self, meta: Dict[str, Any], index: ConversationIndex, log_bytes: int):
+        meta['message_count'] = len(index.seqs)
+        meta['bytes'] = index.live_bytes
+        meta['log_bytes'] = log_bytes
+        meta['updated_at'] = datetime.now().isoformat()
+
+    def _maybe_compact(self, conversation_id: str, meta: Dict[str, Any], index: ConversationIndex):
+        """失效记录占日志一半以上时，只保留有效消息重写日志"""
+        if meta['log_bytes'] < CONVERSATION_COMPACT_MIN_BYTES or meta['log_bytes'] < 2 * meta['bytes']:
+            return
+        path = self._path(conversation_id, 'jsonl')
+        compacted = ConversationIndex()
+        with open(path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+            for seq in index.seqs:
+                offset, length, message_id = index.entries[seq]
+                src.seek(offset)
+                compacted.add(seq, dst.tell(), length, message_id)
+                dst.write(src.read(length))
+        os.replace(path + '.tmp', path)
+        self._indexes[conversation_id] = compacted
+        meta['log_bytes'] = meta['bytes']
+
+    def list(self, owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """属于 owner 的全部对话的元数据，最近更新的在前"""
+        conversations = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if name.endswith('.json'):
+                meta = self._load_meta(name[:-len('.json')])
+                if meta is not None and meta.get('owner') == owner:
+                    conversations.append(meta)
+        conversations.sort(key=lambda meta: meta.get('updated_at') or '', reverse=True)
+        return conversations
+
+    def get(self, conversation_id: str, owner: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        meta = self._load_meta(conversation_id)
+        return meta if meta is not None and meta.get('owner') == owner else None
+
+    def _load_or_create(self, conversation_id: str, owner: Optional[str], title: str = None,
+                        created_at: str = None) -> Dict[str, Any]:
+        meta = self._load_meta(conversation_id)
+        if meta is None:
+            os.makedirs(self.directory, exist_ok=True)
+            now = datetime.now().isoformat()
+            meta = {
+                'id': conversation_id, 'title': title or '新对话', 'created_at': created_at or now,
+                'updated_at': now, 'message_count': 0, 'bytes': 0, 'log_bytes': 0, 'next_seq': 0,
+                'owner': owner,
+            }
+        elif meta.get('owner') != owner:
+            # 对话 ID 已被其他客户端使用：不覆盖，也不暴露它的存在
+            raise KeyError(conversation_id)
+        elif title is not None:
+            meta['title'] = title
+            meta['updated_at'] = datetime.now().isoformat()
+        return meta
+
+    def upsert(self, conversation_id: str, title: str = None, created_at: str = None,
+               owner: Optional[str] = None) -> Dict[str, Any]:
+        """创建对话或修改标题"""
+        with self._lock:
+            meta = self._load_or_create(conversation_id, owner, title, created_at)
+            self._save_meta(meta)
+            return meta
+
+    def append(self, conversation_id: str, messages: List[Dict[str, Any]], title: str = None,
+               owner: Optional[str] = None) -> Dict[str, Any]:
+        """追加消息，返回带序号的消息记录和更新后的元数据；对话不存在时自动创建"""
+        with self._lock:
+            meta = self._load_or_create(conversation_id, owner, title)
+            index = self._index(conversation_id)
+            records = []
+            next_seq = meta['next_seq']
+            for message in messages:
+                seq = message.get('seq')
+                if seq is None:
+                    seq = next_seq
+                elif seq < next_seq:
+                    raise ConversationConflict(f"seq {seq} is not after the last message (next seq is {next_seq})")
+                record = {
+                    'id': message.get('id') or f"msg_{conversation_id}_{seq}",
+                    'seq': seq,
+                    'role': message['role'],
+                    'content': message['content'],
+                    'timestamp': message.get('timestamp') or datetime.now().isoformat(),
+                }
+                if message.get('reasoning_content'):
+                    record['reasoning_content'] = message['reasoning_content']
+                if record['id'] in index.ids or any(record['id'] == other['id'] for other in records):
+                    raise ConversationConflict(f"message id {record['id']!r} already exists")
+                records.append(record)
+                next_seq = seq + 1
+            appended = 0
+            for record, (offset, length) in zip(records, self._append_lines(conversation_id, records)):
+                index.add(record['seq'], offset, length, record['id'])
+                appended += length
+            meta['next_seq'] = next_seq
+            self._update_stats(meta, index, meta['log_bytes'] + appended)
+            self._save_meta(meta)
+            return {'messages': records, 'conversation': meta}
+
+    def page(self, conversation_id: str, before: int = None, after: int = None,
+             limit: int = CONVERSATION_PAGE_LIMIT, owner: Optional[str] = None) -> Dict[str, Any]:
+        """按序号游标读取一页消息（按序号升序）
+
+        默认返回最近的 limit 条；给出 before 时返回序号小于 before 的最近 limit 条，
+        给出 after 时返回序号大于 after 的最早 limit 条。
+        """
+        with self._lock:
+            meta = self._require_meta(conversation_id, owner)
+            index = self._index(conversation_id)
+            seqs = index.seqs
+            if after is not None:
+                start = bisect.bisect_right(seqs, after)
+                selected = seqs[start:start + limit]
+                has_more = start + limit < len(seqs)
+            else:
+                end = len(seqs) if before is None else bisect.bisect_left(seqs, before)
+                start = max(end - limit, 0)
+                selected = seqs[start:end]
+                has_more = start > 0
+            messages = self._read(conversation_id, index, selected)
+        return {
+            'messages': messages,
+            'has_more': has_more,
+            'next_before': selected[0] if selected and after is None and has_more else None,
+            'next_after': selected[-1] if selected and after is not None and has_more else None,
+            'conversation': meta,
+        }
+
+    def history(self, conversation_id: str, before: int = None, limit: int = CONVERSATION_HISTORY_LIMIT,
+                owner: Optional[str] = None) -> List[Dict[str, Any]]:
+        """构建提示用的历史：序号小于 before 的最近 limit 条消息"""
+        return self.page(conversation_id, before=before, limit=limit, owner=owner)['messages']
+
+    def delete_messages(self, conversation_id: str, message_ids: List[str],
+                        owner: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            meta = self._require_meta(conversation_id, owner)
+            index = self._index(conversation_id)
+            seqs = sorted(index.ids[message_id] for message_id in set(message_ids) if message_id in index.ids)
+            if seqs:
+                (_, length), = self._append_lines(conversation_id, [{'op': 'delete', 'seqs': seqs}])
+                index.remove(seqs)
+                self._update_stats(meta, index, meta['log_bytes'] + length)
+                self._maybe_compact(conversation_id, meta, index)
+                self._save_meta(meta)
+            return meta
+
+    def clear(self, conversation_id: str, owner: Optional[str] = None) -> Dict[str, Any]:
+        """清空对话的消息；序号继续递增，旧游标不会指向新消息"""
+        with self._lock:
+            meta = self._require_meta(conversation_id, owner)
+            (_, length), = self._append_lines(conversation_id, [{'op': 'clear'}])
+            index = self._indexes[conversation_id] = ConversationIndex()
+            self._update_stats(meta, index, meta['log_bytes'] + length)
+            self._maybe_compact(conversation_id, meta, index)
+            self._save_meta(meta)
+            return meta
+
+    def delete(self, conversation_id: str, owner: Optional[str] = None) -> bool:
+        with self._lock:
+            if self.get(conversation_id, owner) is None:
+                return False
+            self._indexes.pop(conversation_id, None)
+            found = False
+            for kind in ('json', 'jsonl'):
+                try:
+                    os.remove(self._path(conversation_id, kind))
+                    found = True
+                except FileNotFoundError:
+                    pass
+            return found
+
+
+conversation_store = ConversationStore()
+
 # 创建路由器
 config_router = APIRouter(prefix="/config", tags=["config"])
 
@@ -196,6 +537,72 @@ async def get_tenbin_credentials():
     credentials = load_tenbin_credentials()
     return {"status": "success", "data": credentials}
 
+# 对话存储保存聊天内容，由 main.py 加上客户端认证后挂载
+conversation_router = APIRouter(prefix="/config/conversations", tags=["config"])
+
+def client_id(request: Request) -> Optional[str]:
+    """认证时记录的客户端标识（API Key 的哈希），对话按它区分归属"""
+    return getattr(request.state, 'client_id', None)
+
+def conversation_call(method, conversation_id: str, request: Request, *args, **kwargs):
+    """以当前客户端的身份调用存储方法，把存储的异常转换为 HTTP 错误"""
+    try:
+        return method(conversation_id, *args, owner=client_id(request), **kwargs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Conversation '{conversation_id}' not found.")
+    except ConversationConflict as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@conversation_router.get("")
+def list_conversations(request: Request):
+    """获取当前客户端的对话列表（只有元数据）"""
+    return {"status": "success", "data": conversation_store.list(owner=client_id(request))}
+
+@conversation_router.put("/{conversation_id}")
+def put_conversation(conversation_id: str, conversation: ConversationMeta, request: Request):
+    """创建对话或修改标题"""
+    meta = conversation_call(
+        conversation_store.upsert, conversation_id, request, conversation.title, conversation.created_at
+    )
+    return {"status": "success", "data": meta}
+
+@conversation_router.delete("/{conversation_id}")
+def delete_conversation(conversation_id: str, request: Request):
+    if not conversation_call(conversation_store.delete, conversation_id, request):
+        raise HTTPException(status_code=404, detail=f"Conversation '{conversation_id}' not found.")
+    return {"status": "success", "message": "对话已删除"}
+
+@conversation_router.get("/{conversation_id}/messages")
+def get_conversation_messages(
+    conversation_id: str,
+    request: Request,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=CONVERSATION_PAGE_LIMIT),
+):
+    """分页读取消息：默认最近 limit 条，用 next_before / next_after 继续翻页"""
+    page = conversation_call(conversation_store.page, conversation_id, request, before, after, limit)
+    return {"status": "success", "data": page}
+
+@conversation_router.post("/{conversation_id}/messages")
+def append_conversation_messages(conversation_id: str, body: MessageAppend, request: Request):
+    """追加消息，对话不存在时自动创建"""
+    messages = [message.dict(exclude_none=True) for message in body.messages]
+    result = conversation_call(conversation_store.append, conversation_id, request, messages, body.title)
+    return {"status": "success", "data": result}
+
+@conversation_router.post("/{conversation_id}/messages/delete")
+def delete_conversation_messages(conversation_id: str, body: MessageDeletion, request: Request):
+    meta = conversation_call(conversation_store.delete_messages, conversation_id, request, body.ids)
+    return {"status": "success", "data": meta}
+
+@conversation_router.delete("/{conversation_id}/messages")
+def clear_conversation_messages(conversation_id: str, request: Request):
+    meta = conversation_call(conversation_store.clear, conversation_id, request)
+    return {"status": "success", "data": meta}
+
 if __name__ == "__main__":
     # 测试脚本
     print("配置管理模块测试")
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按模型的 token 预算裁剪过长的对话历史
+始终保留 system 消息和最近的几轮对话，从最早的中间轮次开始按整轮丢弃（用户消息连同其后的回复），
+并插入一条占位说明。每条消息的 token 数在一次裁剪中只估算一次，裁剪本身是 O(消息数)。
+估算不做跨请求缓存：计算本身和对字符串求哈希一样是 O(长度)，缓存只会长期持有大段消息内容。
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+CAPABILITIES_FILE = "model_capabilities.json"
+CONTEXT_WINDOW_ENABLED = os.environ.get("CONTEXT_WINDOW_ENABLED", "false").lower() == "true"
+CONTEXT_WINDOW_MAX_TOKENS = int(os.environ.get("CONTEXT_WINDOW_MAX_TOKENS", "0"))  # 全局预算上限，0 表示只用模型表
+CONTEXT_WINDOW_KEEP_RECENT = int(os.environ.get("CONTEXT_WINDOW_KEEP_RECENT", "2"))  # 始终保留的最近消息数
+
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色前缀等固定开销
+PLACEHOLDER_TEMPLATE = "[{count} earlier messages were omitted to fit the context window]"
+
+MODEL_CAPABILITIES: Dict[str, Dict[str, int]] = {}
+
+
+def load_model_capabilities():
+    """Load per-model context limits from model_capabilities.json"""
+    global MODEL_CAPABILITIES
+    try:
+        with open(CAPABILITIES_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+            MODEL_CAPABILITIES = data if isinstance(data, dict) else {}
+            print(f"Successfully loaded capabilities for {len(MODEL_CAPABILITIES)} models.")
+    except FileNotFoundError:
+        print(f"Warning: {CAPABILITIES_FILE} not found. Context windowing uses built-in defaults.")
+        MODEL_CAPABILITIES = {}
+    except Exception as e:
+        print(f"Error loading {CAPABILITIES_FILE}: {e}")
+        MODEL_CAPABILITIES = {}
+
+
+def get_prompt_budget(model: str) -> int:
+    """模型可用于提示的 token 数 = 上下文长度 - 为输出预留的部分"""
+    caps = MODEL_CAPABILITIES.get(model) or MODEL_CAPABILITIES.get("default") or {}
+    budget = caps.get("context_tokens", 32000) - caps.get("reserve_tokens", 4096)
+    if CONTEXT_WINDOW_MAX_TOKENS > 0:
+        budget = min(budget, CONTEXT_WINDOW_MAX_TOKENS)
+    return max(budget, 1)
+
+
+def content_text(content: Any) -> str:
+    """取出消息内容中的文本部分"""
+    if isinstance(content, list):
+        return " ".join(item.get("text", "") for item in content if item.get("type") == "text")
+    return content or ""
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：ASCII 约 4 字符一个 token，其他字符按 UTF-8 字节数 / 3"""
+    if not text:
+        return 0
+    if text.isascii():
+        return (len(text) + 3) // 4
+    return (len(text.encode("utf-8")) + 2) // 3
+
+
+def message_tokens(message) -> int:
+    return estimate_tokens(content_text(message.content)) + MESSAGE_OVERHEAD_TOKENS
+
+
+def fit_messages(messages: List, budget: int, keep_recent: int = CONTEXT_WINDOW_KEEP_RECENT) -> Tuple[List, Dict[str, int]]:
+    """裁剪消息列表使其不超过预算，返回 (新消息列表, 统计信息)
+
+    返回列表中的占位消息以 {"role": "system", "content": ...} 字典给出，由调用方转换成自己的消息类型。
+    """
+    counts = [message_tokens(message) for message in messages]
+    original_tokens = sum(counts)
+    stats = {
+        "budget": budget,
+        "original_tokens": original_tokens,
+        "tokens": original_tokens,
+        "dropped_messages": 0,
+    }
+    if original_tokens <= budget:
+        return messages, stats
+
+    # 把非 system 消息按轮分组：每轮从一条 user 消息开始，包含其后的回复；
+    # 最近 keep_recent 条消息所在的轮次不丢弃，其余轮次从最早的开始整轮丢弃，避免留下没有问题的回复
+    non_system = [i for i, message in enumerate(messages) if message.role != "system"]
+    protected = set(non_system[-max(keep_recent, 1):])
+    turns: List[List[int]] = []
+    for i in non_system:
+        if not turns or messages[i].role == "user":
+            turns.append([])
+        turns[-1].append(i)
+    droppable = [turn for turn in turns if protected.isdisjoint(turn)]
+
+    placeholder_tokens = estimate_tokens(PLACEHOLDER_TEMPLATE.format(count=len(messages))) + MESSAGE_OVERHEAD_TOKENS
+    total = original_tokens + placeholder_tokens
+    dropped = set()
+    for turn in droppable:
+        if total <= budget:
+            break
+        dropped.update(turn)
+        total -= sum(counts[i] for i in turn)
+
+    if not dropped:
+        return messages, stats
+
+    placeholder = {"role": "system", "content": PLACEHOLDER_TEMPLATE.format(count=len(dropped))}
+    first_dropped = min(dropped)
+    result = []
+    for i, message in enumerate(messages):
+        if i == first_dropped:
+            result.append(placeholder)
+        if i not in dropped:
+            result.append(message)
+
+    stats["tokens"] = total
+    stats["dropped_messages"] = len(dropped)
+    return result, stats
+
+
+def context_window_headers(stats: Optional[Dict[str, int]]) -> Dict[str, str]:
+    """把裁剪统计转换为响应头"""
+    if not stats:
+        return {}
+    return {
+        "X-Context-Budget": str(stats["budget"]),
+        "X-Context-Original-Tokens": str(stats["original_tokens"]),
+        "X-Context-Tokens": str(stats["tokens"]),
+        "X-Context-Dropped-Messages": str(stats["dropped_messages"]),
+    }
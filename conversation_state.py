@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游会话状态复用
+Tenbin 每轮结束时返回 newStateToken。把「本轮请求的消息 + 助手回复」的哈希映射到该令牌和所属账户，
+下一轮请求的历史（去掉最后一条用户消息）命中时，只把新的用户消息连同 stateToken 发给上游，
+不必每轮重新上传整个对话。状态未知、账户不可用或上游拒绝时退回发送完整提示。
+哈希包含发起请求的客户端和附件内容的 sha256：不同客户端、或文本相同而附件不同的历史不会共用状态。
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from context_window import content_text
+from file_uploads import attachment_digest
+
+CONVERSATION_STATE_ENABLED = os.environ.get("CONVERSATION_STATE_ENABLED", "false").lower() == "true"
+CONVERSATION_STATE_CACHE_SIZE = int(os.environ.get("CONVERSATION_STATE_CACHE_SIZE", "10000"))
+CONVERSATION_STATE_TTL = int(os.environ.get("CONVERSATION_STATE_TTL", str(3600)))  # 秒
+# 秒，复用状态时等待首个增量的时间，超时视为状态不可用并退回完整提示
+CONVERSATION_STATE_FIRST_TOKEN_TIMEOUT = float(os.environ.get("CONVERSATION_STATE_FIRST_TOKEN_TIMEOUT", "10"))
+
+
+class ConversationState(NamedTuple):
+    state_token: str
+    session_id: str
+
+
+def _message_bytes(role: str, text: str) -> bytes:
+    # 角色和内容之间、消息之间用控制字符分隔，避免不同拆分得到相同的串
+    return role.encode("utf-8") + b"\x00" + text.encode("utf-8") + b"\x01"
+
+
+def history_hasher(model: str, messages: List, client_id: Optional[str] = None):
+    """返回已输入模型名、客户端和给定消息（含附件内容的 sha256）的 sha256 对象"""
+    digest = hashlib.sha256(model.encode("utf-8") + b"\x02" + (client_id or "").encode("utf-8") + b"\x02")
+    for message in messages:
+        digest.update(_message_bytes(message.role, content_text(message.content)))
+        if isinstance(message.content, list):
+            for item in message.content:
+                sha256 = attachment_digest(item)
+                if sha256:
+                    digest.update(b"\x03" + sha256.encode("ascii"))
+    return digest
+
+
+class ConversationRecorder:
+    """随流累积助手回复的哈希，结束时把 newStateToken 记入缓存"""
+
+    def __init__(self, cache: "ConversationStateCache", model: str, messages: List, client_id: Optional[str] = None):
+        self.cache = cache
+        self._digest = history_hasher(model, messages, client_id)
+        self._digest.update(b"assistant\x00")
+        self.state_token: Optional[str] = None
+        self.finished = False
+
+    def feed(self, kind: str, value: str):
+        if kind == "content":
+            self._digest.update(value.encode("utf-8"))
+        elif kind == "state":
+            self.state_token = value
+        elif kind == "finish":
+            self.finished = True
+
+    def commit(self, session_id: str):
+        """回复完整结束且拿到状态令牌时记录"""
+        if self.finished and self.state_token:
+            self._digest.update(b"\x01")
+            self.cache.put(self._digest.hexdigest(), ConversationState(self.state_token, session_id))
+
+
+class ConversationStateCache:
+    """历史哈希 -> (stateToken, 账户) 的 LRU 缓存，带过期时间"""
+
+    def __init__(self, max_size: int = CONVERSATION_STATE_CACHE_SIZE, ttl: int = CONVERSATION_STATE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[ConversationState, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "fallbacks": 0, "stored": 0}
+
+    def get(self, key: str) -> Optional[ConversationState]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            state, stored_at = item
+            if time.time() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return state
+
+    def put(self, key: str, state: ConversationState):
+        with self._lock:
+            self._items[key] = (state, time.time())
+            self._items.move_to_end(key)
+            self.counters["stored"] += 1
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def lookup(
+        self, model: str, messages: List, client_id: Optional[str] = None
+    ) -> Optional[Tuple[str, ConversationState]]:
+        """最后一条是用户消息且同一客户端之前的历史已知时，返回 (历史哈希, 状态)"""
+        if len(messages) < 2 or messages[-1].role != "user":
+            return None
+        key = history_hasher(model, messages[:-1], client_id).hexdigest()
+        state = self.get(key)
+        self.incr("hits" if state else "misses")
+        return (key, state) if state else None
+
+    def recorder(self, model: str, messages: List, client_id: Optional[str] = None) -> ConversationRecorder:
+        return ConversationRecorder(self, model, messages, client_id)
+
+    def incr(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"enabled": CONVERSATION_STATE_ENABLED, "entries": len(self._items), **self.counters}
+
+
+conversation_cache = ConversationStateCache()
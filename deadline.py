@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+请求级截止时间
+每个聊天请求有一个总时间预算（默认值、X-Request-Timeout 请求头或请求体中的 timeout），
+取令牌、获取执行令牌、建立连接、等待首字和字间空闲各阶段都从剩余预算中取超时，
+超出时以 504 和具体阶段说明结束请求，不会有请求或线程无限期挂起。
+"""
+
+import os
+import time
+from typing import Optional
+
+from fastapi import HTTPException
+
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "600"))  # 秒，默认总预算
+REQUEST_DEADLINE_MAX = float(os.environ.get("REQUEST_DEADLINE_MAX", "1800"))  # 秒，客户端可指定的上限
+STREAM_IDLE_TIMEOUT = float(os.environ.get("STREAM_IDLE_TIMEOUT", "60"))  # 秒，两个上游增量之间的最长间隔
+
+
+class DeadlineExceeded(HTTPException):
+    """某个阶段超出时间预算"""
+
+    def __init__(self, stage: str, seconds: float, limit: str = "Request deadline"):
+        self.stage = stage
+        super().__init__(status_code=504, detail=f"{limit} of {seconds:g}s exceeded during {stage}.")
+
+
+class Deadline:
+    """一个请求的截止时间，使用单调时钟"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def check(self, stage: str):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage, self.seconds)
+
+    def timeout(self, stage: str, cap: Optional[float] = None) -> float:
+        """本阶段可用的超时时间（不超过 cap），预算已用完时抛出 DeadlineExceeded"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage, self.seconds)
+        return min(remaining, cap) if cap is not None else remaining
+
+
+def request_deadline(timeout: Optional[float] = None, header: Optional[str] = None) -> Deadline:
+    """按请求体 timeout、X-Request-Timeout 请求头、默认值的顺序确定截止时间"""
+    seconds = REQUEST_DEADLINE
+    if timeout is None and header:
+        try:
+            timeout = float(header)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="X-Request-Timeout must be a number of seconds.")
+    if timeout is not None:
+        if timeout <= 0:
+            raise HTTPException(status_code=400, detail="timeout must be positive.")
+        seconds = min(timeout, REQUEST_DEADLINE_MAX)
+    return Deadline(seconds)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+运行时诊断
+网关变慢时用来判断瓶颈在 CPU、事件循环还是线程池：
+- 采样剖析器（所有线程，折叠栈格式，可直接生成火焰图）或 cProfile（事件循环线程），运行 N 秒后下载结果
+- 事件循环延迟：后台任务定时休眠，记录实际唤醒比预期晚了多久，报告分位数
+- 默认线程池（asyncio.to_thread）的使用情况和各类线程数
+- 所有线程和 asyncio 任务的实时调用栈
+
+空闲时只有事件循环延迟监视器在运行（每 LOOP_LAG_INTERVAL 秒唤醒一次），剖析器只在显式启动后工作。
+"""
+
+import asyncio
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import PlainTextResponse, Response
+
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))  # 秒，0 表示不监视
+LOOP_LAG_SAMPLES = int(os.environ.get("LOOP_LAG_SAMPLES", "1200"))  # 保留最近的样本数（默认约 10 分钟）
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "300"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))  # 秒，采样间隔
+PROFILE_MAX_DEPTH = 64
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """返回 p50/p90/p99/max，单位与输入相同"""
+    if not values:
+        return {"p50": 0.0, "p90": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    return {
+        "p50": ordered[int(last * 0.50)],
+        "p90": ordered[int(last * 0.90)],
+        "p99": ordered[int(last * 0.99)],
+        "max": ordered[last],
+    }
+
+
+def thread_group(name: str) -> str:
+    """把 "upstream-hedge"、"asyncio_3" 这类线程名归到同一组"""
+    return name.split("-", 1)[0].rstrip("_0123456789") or name
+
+
+class LoopLagMonitor:
+    """在事件循环中定时休眠，记录唤醒延迟"""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, max_samples: int = LOOP_LAG_SAMPLES):
+        self.interval = interval
+        self.samples: Deque[float] = deque(maxlen=max_samples)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(time.perf_counter() - started - self.interval, 0.0))
+
+    def snapshot(self) -> Dict:
+        samples = list(self.samples)
+        return {
+            "enabled": self._task is not None,
+            "interval": self.interval,
+            "samples": len(samples),
+            "window_seconds": round(len(samples) * self.interval, 1),
+            "lag_ms": {key: round(value * 1000, 2) for key, value in percentiles(samples).items()},
+            "last_ms": round(samples[-1] * 1000, 2) if samples else None,
+        }
+
+
+class SamplingProfiler:
+    """后台线程按固定间隔抓取所有线程的调用栈，按折叠栈计数"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="debug-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None and len(calls) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                calls.append(thread_group(names.get(ident, str(ident))))
+                self.stacks[";".join(reversed(calls))] += 1
+            self.samples += 1
+
+    def report(self) -> str:
+        """折叠栈格式：每行 "线程;外层;...;内层 次数"，可交给 flamegraph.pl / speedscope"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class ProfileSession:
+    """一次剖析：同一时间只允许一个，结束后保留结果供下载"""
+
+    def __init__(self, mode: str, seconds: float, interval: float):
+        self.mode = mode
+        self.seconds = seconds
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._sampler: Optional[SamplingProfiler] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        if mode == "sampling":
+            self._sampler = SamplingProfiler(interval)
+            self._sampler.start()
+        else:
+            # cProfile 只记录调用 enable() 的线程，这里是事件循环线程
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+
+    @property
+    def running(self) -> bool:
+        return self.finished_at is None
+
+    def stop(self):
+        if not self.running:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._sampler is not None:
+            self._sampler.stop()
+        if self._profile is not None:
+            self._profile.disable()
+        self.finished_at = time.time()
+
+    def status(self) -> Dict:
+        status = {
+            "mode": self.mode,
+            "running": self.running,
+            "seconds": self.seconds,
+            "started_at": int(self.started_at),
+            "elapsed": round((self.finished_at or time.time()) - self.started_at, 2),
+        }
+        if self._sampler is not None:
+            status["samples"] = self._sampler.samples
+        return status
+
+    def text(self, sort: str, limit: int) -> str:
+        if self._sampler is not None:
+            return self._sampler.report()
+        out = io.StringIO()
+        pstats.Stats(self._profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def pstats_dump(self) -> bytes:
+        """与 pstats.Stats.dump_stats 写出的文件格式相同，可用 snakeviz / pstats 打开"""
+        if self._profile is None:
+            raise HTTPException(status_code=400, detail="pstats output is only available for cprofile sessions.")
+        self._profile.create_stats()
+        return marshal.dumps(self._profile.stats)
+
+
+loop_lag_monitor = LoopLagMonitor()
+_profile_session: Optional[ProfileSession] = None
+
+
+def threadpool_stats() -> Dict:
+    """默认线程池（asyncio.to_thread / run_in_executor）和其他线程的情况"""
+    loop = asyncio.get_running_loop()
+    executor = getattr(loop, "_default_executor", None)
+    groups = Counter(thread_group(thread.name) for thread in threading.enumerate())
+    if executor is None:
+        # 第一次 to_thread 调用时才创建，容量与 ThreadPoolExecutor 的默认值一致
+        pool = {"created": False, "max_workers": min(32, (os.cpu_count() or 1) + 4)}
+    else:
+        threads = len(executor._threads)
+        idle = min(executor._idle_semaphore._value, threads)
+        pool = {
+            "created": True,
+            "max_workers": executor._max_workers,
+            "threads": threads,
+            "busy": threads - idle,  # 近似值：按空闲信号量计算
+            "queued": executor._work_queue.qsize(),
+            "utilization": round((threads - idle) / executor._max_workers, 3),
+        }
+    return {"default_executor": pool, "threads": dict(groups), "total_threads": sum(groups.values())}
+
+
+def dump_stacks(include_tasks: bool = True, limit: Optional[int] = None) -> str:
+    """所有线程和（可选）asyncio 任务的当前调用栈"""
+    out = io.StringIO()
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        thread = threads.get(ident)
+        name = thread.name if thread else "unknown"
+        daemon = " daemon" if thread is not None and thread.daemon else ""
+        out.write(f'Thread "{name}" ({ident}{daemon}):\n')
+        out.write("".join(traceback.format_stack(frame, limit)))
+        out.write("\n")
+    if include_tasks:
+        tasks = asyncio.all_tasks()
+        out.write(f"{len(tasks)} asyncio tasks:\n\n")
+        for task in tasks:
+            out.write(f'Task "{task.get_name()}" {task.get_coro()!r}:\n')
+            task.print_stack(limit=limit, file=out)
+            out.write("\n")
+    return out.getvalue()
+
+
+# 创建路由器
+debug_router = APIRouter(prefix="/debug", tags=["debug"])
+
+
+@debug_router.post("/profile/start")
+async def start_profile(
+    mode: str = Query("sampling", pattern="^(sampling|cprofile)$"),
+    seconds: float = Query(30, gt=0),
+    interval: float = Query(PROFILE_SAMPLE_INTERVAL, ge=0.001, le=1),
+):
+    """启动剖析，seconds 秒后自动停止；sampling 覆盖所有线程，cprofile 只记录事件循环线程"""
+    global _profile_session
+    if _profile_session is not None and _profile_session.running:
+        raise HTTPException(status_code=409, detail="A profiling session is already running.")
+    _profile_session = ProfileSession(mode, min(seconds, PROFILE_MAX_SECONDS), interval)
+    return _profile_session.status()
+
+
+@debug_router.post("/profile/stop")
+async def stop_profile():
+    """提前停止正在运行的剖析"""
+    if _profile_session is None:
+        raise HTTPException(status_code=404, detail="No profiling session.")
+    _profile_session.stop()
+    return _profile_session.status()
+
+
+@debug_router.get("/profile/status")
+async def profile_status():
+    return _profile_session.status() if _profile_session else {"running": False}
+
+
+@debug_router.get("/profile")
+async def download_profile(
+    format: str = Query("text", pattern="^(text|pstats)$"),
+    sort: str = Query("cumulative"),
+    limit: int = Query(100, ge=1),
+):
+    """下载最近一次剖析的结果：sampling 为折叠栈文本，cprofile 为 pstats 文本或二进制文件"""
+    if _profile_session is None:
+        raise HTTPException(status_code=404, detail="No profiling session.")
+    if _profile_session.running:
+        raise HTTPException(status_code=409, detail="Profiling session is still running.")
+    name = f"tenbin-{_profile_session.mode}-{int(_profile_session.started_at)}"
+    if format == "pstats":
+        return Response(
+            content=_profile_session.pstats_dump(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{name}.prof"'},
+        )
+    try:
+        report = _profile_session.text(sort, limit)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Unknown sort key: {sort}")
+    return PlainTextResponse(report, headers={"Content-Disposition": f'inline; filename="{name}.txt"'})
+
+
+@debug_router.get("/loop-lag")
+async def loop_lag():
+    """事件循环唤醒延迟的分位数（毫秒）"""
+    return loop_lag_monitor.snapshot()
+
+
+@debug_router.get("/threadpool")
+async def threadpool():
+    return threadpool_stats()
+
+
+@debug_router.get("/stacks")
+async def stacks(tasks: bool = Query(True), limit: Optional[int] = Query(None, ge=1)):
+    """所有线程和 asyncio 任务的实时调用栈"""
+    return PlainTextResponse(dump_stacks(tasks, limit))
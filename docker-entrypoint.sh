@@ -69,8 +69,8 @@ echo "⏳ 等待API Solver启动..."
 sleep 3
 
 echo "🤖 启动 Tenbin API 服务器 (端口 8401)..."
-# 启动主API服务器
-python3 /app/main.py > /app/logs/api_server.log 2>&1 &
+# 启动主API服务器（由 supervisor.py 管理，kill -HUP 平滑重启，SIGTERM 排空后退出）
+python3 /app/supervisor.py > /app/logs/api_server.log 2>&1 &
 API_PID=$!
 
 echo "⏳ 等待API服务器启动..."
@@ -99,10 +99,14 @@ check_services() {
     fi
     
     if [ "$api_status" != "200" ]; then
-        echo "❌ API服务器异常，重新启动..."
-        kill $API_PID 2>/dev/null
-        python3 /app/main.py > /app/logs/api_server.log 2>&1 &
-        API_PID=$!
+        if kill -0 $API_PID 2>/dev/null; then
+            echo "❌ API服务器异常，平滑重启..."
+            kill -HUP $API_PID
+        else
+            echo "❌ API服务器异常，重新启动..."
+            python3 /app/supervisor.py >> /app/logs/api_server.log 2>&1 &
+            API_PID=$!
+        fi
     fi
     
     if [ "$solver_status" != "200" ]; then
@@ -116,7 +120,10 @@ check_services() {
 # 优雅关闭处理
 cleanup() {
     echo "🛑 正在关闭服务..."
-    kill $HTTP_PID $API_PID $SOLVER_PID 2>/dev/null
+    # API 服务器先拒绝新请求，等进行中的流输出完再退出（最长 DRAIN_GRACE_SECONDS）
+    kill -TERM $API_PID 2>/dev/null
+    wait $API_PID 2>/dev/null
+    kill $HTTP_PID $SOLVER_PID 2>/dev/null
     pkill Xvfb 2>/dev/null
     echo "✅ 服务已关闭"
     exit 0
@@ -132,6 +139,7 @@ echo "   - API服务器日志: tail -f /app/logs/api_server.log"
 
 # 监控循环
 while true; do
-    sleep 30
+    sleep 30 &
+    wait $!  # 让 SIGTERM 立即触发 cleanup，而不是等 sleep 结束
     check_services
 done
\ No newline at end of file
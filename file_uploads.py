@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多模态附件上传
+附件（图片/文件）按内容哈希保存在本地内容寻址目录中，再分块流式上传到 Tenbin，
+得到的 fileUploadId 按 (账户, 内容哈希) 缓存，同一附件在会话的每一轮重复发送时只上传一次。
+整个过程按固定大小的块处理，网关内存占用与附件大小无关。
+
+Tenbin 的上传接口地址通过 TENBIN_UPLOAD_URL 配置，接口需接受原始文件内容作为请求体，
+并返回包含 fileUploadId（或 id）的 JSON。该接口未经确认，默认不配置：此时以及上传失败时
+只发送消息中的文本（附件在提示中渲染为带文件名和类型的占位说明），也不计为账户错误。
+
+保存的附件记录上传它的客户端（元数据中的 owners），file id 只能由这些客户端引用，
+内容相同的附件只保存一份，每个上传过它的客户端都可以引用。
+
+本地目录按最近使用时间回收：超过 UPLOAD_RETENTION 未使用的附件删除，
+总大小超过 UPLOAD_DIR_MAX_BYTES 时从最久未使用的开始删除。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import unquote
+
+import requests
+from fastapi import APIRouter, HTTPException, Request
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "uploads")
+TENBIN_UPLOAD_URL = os.environ.get("TENBIN_UPLOAD_URL", "")  # 为空时不上传附件
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_CACHE_SIZE = int(os.environ.get("UPLOAD_CACHE_SIZE", "1024"))
+UPLOAD_CACHE_TTL = int(os.environ.get("UPLOAD_CACHE_TTL", str(6 * 3600)))  # 上游 fileUploadId 的缓存时间，秒
+UPLOAD_RETENTION = int(os.environ.get("UPLOAD_RETENTION", str(24 * 3600)))  # 附件最后一次使用后保留的秒数
+UPLOAD_DIR_MAX_BYTES = int(os.environ.get("UPLOAD_DIR_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+UPLOAD_GC_INTERVAL = 600.0  # 两次回收之间的最短间隔，秒
+UPLOAD_TIMEOUT = 120.0
+BASE64_CHUNK_SIZE = 64 * 1024  # 必须是 4 的倍数
+
+_DATA_URL_PATTERN = re.compile(r"^data:([^;,]*)(;[^,]*)?,")
+_FILE_ID_PATTERN = re.compile(r"^file-([0-9a-f]{64})$")
+
+
+class Attachment:
+    """本地保存的一个附件"""
+
+    __slots__ = ("sha256", "path", "size", "mime_type", "filename")
+
+    def __init__(self, sha256: str, path: str, size: int, mime_type: str, filename: str):
+        self.sha256 = sha256
+        self.path = path
+        self.size = size
+        self.mime_type = mime_type
+        self.filename = filename
+
+    @property
+    def file_id(self) -> str:
+        return f"file-{self.sha256}"
+
+
+def _store_path(sha256: str) -> str:
+    return os.path.join(UPLOAD_DIR, sha256)
+
+
+def _touch(path: str):
+    """更新修改时间，回收按它判断附件最近一次使用"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+_meta_lock = threading.Lock()
+
+
+def _load_meta(path: str) -> dict:
+    try:
+        with open(path + ".json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _commit_to_store(
+    tmp_path: str, sha256: str, size: int, mime_type: str, filename: str, owner: Optional[str] = None
+) -> Attachment:
+    """把临时文件移动到内容寻址目录，内容已存在时直接丢弃临时文件；把 owner 记为可引用该附件的客户端"""
+    path = _store_path(sha256)
+    with _meta_lock:
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            _touch(path)
+            meta = _load_meta(path) or {"size": size, "mime_type": mime_type, "filename": filename}
+        else:
+            os.replace(tmp_path, path)
+            meta = {"size": size, "mime_type": mime_type, "filename": filename}
+        owners = meta.setdefault("owners", [])
+        if owner not in owners:
+            owners.append(owner)
+            with open(path + ".json.part", "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(path + ".json.part", path + ".json")
+    upload_collector.maybe_start()
+    return Attachment(sha256, path, size, mime_type, filename)
+
+
+class UploadCollector:
+    """回收本地附件目录：删除过期的附件和残留的临时文件，并把总大小控制在上限以内"""
+
+    def __init__(self, retention: int = UPLOAD_RETENTION, max_bytes: int = UPLOAD_DIR_MAX_BYTES):
+        self.retention = retention
+        self.max_bytes = max_bytes
+        self.last_run = 0.0
+        self.removed = 0
+        self._lock = threading.Lock()
+
+    def maybe_start(self):
+        """距上次回收超过 UPLOAD_GC_INTERVAL 时在后台线程中回收"""
+        if time.monotonic() - self.last_run < UPLOAD_GC_INTERVAL or self._lock.locked():
+            return
+        self.last_run = time.monotonic()
+        threading.Thread(target=self.collect, name="upload-gc", daemon=True).start()
+
+    def collect(self, now: Optional[float] = None) -> int:
+        """执行一次回收，返回删除的附件数"""
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            return self._collect(time.time() if now is None else now)
+        finally:
+            self._lock.release()
+
+    def _collect(self, now: float) -> int:
+        try:
+            names = os.listdir(UPLOAD_DIR)
+        except FileNotFoundError:
+            return 0
+        entries = []  # (最近使用时间, 大小, 路径)
+        removed = 0
+        for name in names:
+            path = os.path.join(UPLOAD_DIR, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if name.endswith(".part"):
+                # 进程中断留下的临时文件
+                if now - stat.st_mtime > self.retention:
+                    _remove(path)
+                continue
+            if _FILE_ID_PATTERN.match(f"file-{name}"):
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for used_at, size, path in entries:
+            if now - used_at <= self.retention and total <= self.max_bytes:
+                break
+            _remove(path)
+            _remove(path + ".json")
+            total -= size
+            removed += 1
+        self.removed += removed
+        return removed
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+upload_collector = UploadCollector()
+
+
+def store_chunks(
+    chunks: Iterator[bytes], mime_type: str, filename: str, max_bytes: int = MAX_UPLOAD_BYTES, owner: Optional[str] = None
+) -> Attachment:
+    """把字节块流写入内容寻址目录，边写边计算哈希"""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ValueError(f"Attachment exceeds {max_bytes} bytes")
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return _commit_to_store(tmp_path, digest.hexdigest(), size, mime_type, filename, owner)
+
+
+def iter_base64_chunks(encoded: str, start: int = 0) -> Iterator[bytes]:
+    """分块解码 base64 字符串，避免一次性生成完整的二进制副本"""
+    pending = ""
+    for offset in range(start, len(encoded), BASE64_CHUNK_SIZE):
+        piece = pending + "".join(encoded[offset:offset + BASE64_CHUNK_SIZE].split())
+        usable = len(piece) - len(piece) % 4
+        pending = piece[usable:]
+        if usable:
+            yield base64.b64decode(piece[:usable])
+    if pending:
+        yield base64.b64decode(pending + "=" * (-len(pending) % 4))
+
+
+def store_data_url(data_url: str, filename: str = "", owner: Optional[str] = None) -> Optional[Attachment]:
+    """解码 data URL 并保存，非 base64 data URL 返回 None"""
+    match = _DATA_URL_PATTERN.match(data_url)
+    if not match or ";base64" not in (match.group(2) or ""):
+        return None
+    mime_type = match.group(1) or "application/octet-stream"
+    return store_chunks(iter_base64_chunks(data_url, match.end()), mime_type, filename, owner=owner)
+
+
+def get_stored_attachment(file_id: str, owner: Optional[str] = None) -> Optional[Attachment]:
+    """按 /v1/files 返回的 file id 查找 owner 上传过的附件；其他客户端的附件按不存在处理"""
+    match = _FILE_ID_PATTERN.match(file_id or "")
+    if not match:
+        return None
+    sha256 = match.group(1)
+    path = _store_path(sha256)
+    if not os.path.exists(path):
+        return None
+    meta = _load_meta(path)
+    if owner not in meta.get("owners", []):
+        return None
+    _touch(path)
+    return Attachment(
+        sha256,
+        path,
+        meta.get("size", os.path.getsize(path)),
+        meta.get("mime_type", "application/octet-stream"),
+        meta.get("filename", ""),
+    )
+
+
+def attachment_placeholder(item: dict) -> str:
+    """图片/文件内容在提示中的占位说明，带上请求中给出的文件名和类型"""
+    item_type = item.get("type")
+    if item_type == "image_url":
+        label, filename = "图片", ""
+        url = (item.get("image_url") or {}).get("url", "")
+    elif item_type == "file":
+        file_part = item.get("file") or {}
+        label, filename = "文件", file_part.get("filename", "")
+        url = file_part.get("file_data", "")
+    else:
+        return ""
+    match = _DATA_URL_PATTERN.match(url or "")
+    mime_type = match.group(1) if match else ""
+    details = " ".join(part for part in (filename, f"({mime_type})" if mime_type else "") if part)
+    return f"[{label}: {details}]" if details else f"[{label}]"
+
+
+def attachment_digest(item: dict) -> str:
+    """图片/文件内容的 sha256，与 extract_attachments 保存后的 Attachment.sha256 相同；其他引用按原文计算，非附件返回空串"""
+    item_type = item.get("type")
+    if item_type == "image_url":
+        ref = (item.get("image_url") or {}).get("url", "")
+    elif item_type == "file":
+        file_part = item.get("file") or {}
+        ref = file_part.get("file_id") or file_part.get("file_data", "")
+    else:
+        return ""
+    match = _FILE_ID_PATTERN.match(ref or "")
+    if match:
+        return match.group(1)
+    digest = hashlib.sha256()
+    match = _DATA_URL_PATTERN.match(ref or "")
+    if match and ";base64" in (match.group(2) or ""):
+        for chunk in iter_base64_chunks(ref, match.end()):
+            digest.update(chunk)
+    else:
+        digest.update((ref or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def extract_attachments(messages: List, owner: Optional[str] = None) -> List[Attachment]:
+    """从消息的多模态内容中取出附件（data URL 图片/文件，或 owner 通过 /v1/files 上传得到的 file id）"""
+    attachments: "OrderedDict[str, Attachment]" = OrderedDict()
+    for msg in messages:
+        if not isinstance(msg.content, list):
+            continue
+        for item in msg.content:
+            attachment = None
+            item_type = item.get("type")
+            if item_type == "image_url":
+                url = (item.get("image_url") or {}).get("url", "")
+                if url.startswith("file-"):
+                    attachment = get_stored_attachment(url, owner)
+                elif url.startswith("data:"):
+                    attachment = store_data_url(url, owner=owner)
+            elif item_type == "file":
+                file_part = item.get("file") or {}
+                if file_part.get("file_id"):
+                    attachment = get_stored_attachment(file_part["file_id"], owner)
+                elif file_part.get("file_data"):
+                    attachment = store_data_url(file_part["file_data"], file_part.get("filename", ""), owner)
+            if attachment is not None:
+                attachments.setdefault(attachment.sha256, attachment)
+    return list(attachments.values())
+
+
+class UploadCache:
+    """(账户, 内容哈希) -> 上游 fileUploadId 的 LRU 缓存，带过期时间"""
+
+    def __init__(self, max_size: int = UPLOAD_CACHE_SIZE, ttl: int = UPLOAD_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[Tuple[str, str], Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, sha256: str) -> Optional[str]:
+        key = (session_id, sha256)
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            upload_id, stored_at = item
+            if time.time() - stored_at > self.ttl:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return upload_id
+
+    def put(self, session_id: str, sha256: str, upload_id: str):
+        with self._lock:
+            self._items[(session_id, sha256)] = (upload_id, time.time())
+            self._items.move_to_end((session_id, sha256))
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+
+upload_cache = UploadCache()
+
+
+def upload_attachment(attachment: Attachment, session_id: str) -> str:
+    """把附件分块流式上传到 Tenbin，返回 fileUploadId；同一账户下相同内容只上传一次"""
+    cached = upload_cache.get(session_id, attachment.sha256)
+    if cached:
+        return cached
+
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/137.0.0.0 Safari/537.36",
+        "Content-Type": attachment.mime_type,
+        "X-File-Name": attachment.filename or attachment.sha256,
+        "Cookie": f"sessionId={session_id}",
+    }
+    # 直接传入文件对象，requests 会按文件大小设置 Content-Length 并分块发送
+    with open(attachment.path, "rb") as f:
+        response = requests.post(TENBIN_UPLOAD_URL, data=f, headers=headers, timeout=UPLOAD_TIMEOUT)
+    response.raise_for_status()
+    data = response.json()
+    upload_id = data.get("fileUploadId") or data.get("id")
+    if not upload_id:
+        raise ValueError(f"Upload response did not contain a file upload id: {data}")
+    upload_cache.put(session_id, attachment.sha256, upload_id)
+    return upload_id
+
+
+def upload_attachments(attachments: List[Attachment], session_id: str) -> List[str]:
+    return [upload_attachment(attachment, session_id) for attachment in attachments]
+
+
+# 创建路由器
+files_router = APIRouter(prefix="/v1/files", tags=["files"])
+
+
+@files_router.post("")
+async def create_file(request: Request):
+    """流式接收原始文件内容并保存，返回可在消息中引用的 file id"""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes.")
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in request.stream():
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail=f"File exceeds {MAX_UPLOAD_BYTES} bytes.")
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    if size == 0:
+        os.remove(tmp_path)
+        raise HTTPException(status_code=400, detail="Empty file.")
+
+    filename = unquote(request.headers.get("x-filename", ""))
+    mime_type = request.headers.get("content-type", "application/octet-stream")
+    owner = getattr(request.state, "client_id", None)
+    attachment = _commit_to_store(tmp_path, digest.hexdigest(), size, mime_type, filename, owner)
+    return {
+        "id": attachment.file_id,
+        "object": "file",
+        "bytes": attachment.size,
+        "created_at": int(time.time()),
+        "filename": attachment.filename,
+        "purpose": "user_data",
+    }
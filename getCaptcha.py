@@ -1,26 +1,32 @@
 import requests
 import time
 
-def getTaskId():
+CAPTCHA_TIMEOUT = 120  # 秒，未指定超时时等待验证码结果的最长时间
+POLL_INTERVAL = 1
+
+
+def getTaskId(timeout=CAPTCHA_TIMEOUT):
     url = "http://127.0.0.1:5000/turnstile?url=https://tenbin.ai/workspace&sitekey=0x4AAAAAABGR2exxRproizri&action=issue_execution_token"
 
-    response = requests.get(url)
+    response = requests.get(url, timeout=timeout)
     response.raise_for_status()
     return response.json()['task_id']
 
-def getCaptcha(task_id):
+def getCaptcha(task_id, timeout=CAPTCHA_TIMEOUT):
 
     url = f"http://127.0.0.1:5000/result?id={task_id}"
-    
+    deadline = time.monotonic() + timeout
+
     while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"Captcha task {task_id} not solved within {timeout:g}s")
         try:
-            response = requests.get(url)
+            response = requests.get(url, timeout=remaining)
             response.raise_for_status()
             captcha = response.json().get('value', None)
             if captcha:
                 return captcha
-            else:
-                time.sleep(1)
         except Exception as e:
             print(e)
-            time.sleep(1)
\ No newline at end of file
+        time.sleep(min(POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
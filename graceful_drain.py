@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+优雅排空与平滑重启
+收到 SIGTERM（或管理员调用 POST /admin/drain）后进入排空模式：
+- 新请求立即返回 503（带 Retry-After 和 Connection: close），客户端或负载均衡器转去其他实例重试
+- 已在处理的请求和 SSE 流继续运行，直到全部结束或超过 DRAIN_GRACE_SECONDS
+- /health 返回 503 "draining"，GET /admin/drain 报告剩余的请求数、活动流和剩余时间
+- 排空完成后进程退出；排空期间再收到一次 SIGTERM / SIGINT 则立即退出
+
+SERVER_REUSEPORT=true 时监听套接字带 SO_REUSEPORT，同一端口可以同时有多个进程监听；
+开始排空时立即关闭本进程的监听套接字，新连接全部交给新进程。supervisor.py 利用这一点实现不中断的重启。
+批处理任务不等待：开始排空时立即停止（状态保持 in_progress），由新进程或下次启动时从检查点续跑。
+"""
+
+import asyncio
+import os
+import signal
+import socket
+import time
+from typing import Callable, Dict, Optional
+
+from fastapi import APIRouter
+from starlette.responses import JSONResponse
+
+from batch_jobs import shutdown_batches
+from log_pipeline import get_logger
+from stream_registry import stream_registry
+
+DRAIN_GRACE_SECONDS = float(os.environ.get("DRAIN_GRACE_SECONDS", "120"))
+DRAIN_RETRY_AFTER = int(os.environ.get("DRAIN_RETRY_AFTER", "2"))  # 503 响应中的 Retry-After 秒数
+DRAIN_LOG_INTERVAL = 5.0
+SERVER_REUSEPORT = os.environ.get("SERVER_REUSEPORT", "false").lower() == "true"
+READY_FD_ENV = "SUPERVISOR_READY_FD"  # supervisor 传入的管道写端，启动完成后写入一行通知
+
+# 排空期间仍然放行的路径：健康检查、管理和诊断接口、断线续传
+EXEMPT_PREFIXES = ("/health", "/admin/", "/debug")
+RESUME_SUFFIX = "/events"
+
+logger = get_logger("drain")
+
+
+class DrainController:
+    """记录排空状态和进行中的请求数，只在事件循环线程中修改"""
+
+    def __init__(self, grace_seconds: float = DRAIN_GRACE_SECONDS):
+        self.grace_seconds = grace_seconds
+        self.draining = False
+        self.started_at: Optional[float] = None
+        self.inflight = 0  # 已进入应用、尚未完成的 HTTP 请求（流式请求在最后一个事件发出后才算完成）
+        self.rejected = 0
+        self.on_drained: Optional[Callable[[], None]] = None  # 由运行服务器的一方设置，排空完成后调用
+        self._task: Optional[asyncio.Task] = None
+        self._batches_task: Optional[asyncio.Task] = None
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at if self.started_at is not None else 0.0
+
+    @property
+    def drained(self) -> bool:
+        return self.draining and self.inflight == 0
+
+    def begin(self, reason: str = "signal") -> bool:
+        """进入排空模式并启动等待任务；已在排空时返回 False"""
+        if self.draining:
+            return False
+        self.draining = True
+        self.started_at = time.monotonic()
+        logger.warning(
+            "Draining (%s): %d requests in flight, %d active streams, grace %.0fs",
+            reason, self.inflight, len(stream_registry.streams), self.grace_seconds,
+        )
+        loop = asyncio.get_running_loop()
+        # 平滑重启时新进程已经在恢复同样的批次，旧进程尽快停下交出批次锁
+        self._batches_task = loop.create_task(shutdown_batches())
+        self._task = loop.create_task(self._wait())
+        return True
+
+    async def _wait(self):
+        last_log = time.monotonic()
+        while not self.drained and self.elapsed < self.grace_seconds:
+            await asyncio.sleep(0.2)
+            if time.monotonic() - last_log >= DRAIN_LOG_INTERVAL:
+                last_log = time.monotonic()
+                logger.info(
+                    "Draining: %d requests in flight, %d active streams, %.0fs left",
+                    self.inflight, len(stream_registry.streams), self.grace_seconds - self.elapsed,
+                )
+        if self.drained:
+            logger.warning("Drain completed in %.1fs, %d requests rejected", self.elapsed, self.rejected)
+        else:
+            logger.warning(
+                "Drain grace period expired with %d requests in flight, %d active streams",
+                self.inflight, len(stream_registry.streams),
+            )
+        if self.on_drained is not None:
+            self.on_drained()
+
+    def status(self) -> Dict:
+        return {
+            "draining": self.draining,
+            "drained": self.drained,
+            "elapsed": round(self.elapsed, 1),
+            "grace_seconds": self.grace_seconds,
+            "remaining": round(max(self.grace_seconds - self.elapsed, 0.0), 1) if self.draining else None,
+            "inflight_requests": self.inflight,
+            "active_streams": len(stream_registry.streams),
+            "rejected": self.rejected,
+            "exit_on_drained": self.on_drained is not None,
+        }
+
+
+drain_controller = DrainController()
+
+
+def is_exempt(scope) -> bool:
+    path = scope["path"]
+    if path.startswith(EXEMPT_PREFIXES):
+        return True
+    if path.startswith("/v1/chat/completions"):
+        # GET /v1/chat/completions/{id}/events 和带 Last-Event-ID 的重连只读取已有流的缓冲，不产生新的上游调用
+        if path.endswith(RESUME_SUFFIX):
+            return True
+        return any(name == b"last-event-id" for name, _ in scope["headers"])
+    return False
+
+
+class DrainMiddleware:
+    """纯 ASGI 中间件：统计进行中的请求，排空期间拒绝新请求"""
+
+    def __init__(self, app, controller: DrainController = drain_controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        controller = self.controller
+        if controller.draining and not is_exempt(scope):
+            controller.rejected += 1
+            response = JSONResponse(
+                {"detail": "Server is draining for restart, please retry."},
+                status_code=503,
+                headers={"Retry-After": str(DRAIN_RETRY_AFTER), "Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+        controller.inflight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            controller.inflight -= 1
+
+
+# 创建路由器
+drain_router = APIRouter(prefix="/admin/drain", tags=["admin"])
+
+
+@drain_router.get("")
+async def drain_status():
+    return drain_controller.status()
+
+
+@drain_router.post("")
+async def start_drain():
+    """开始排空；由 serve() 运行时排空完成后进程退出，否则只停止接收新请求"""
+    drain_controller.begin("admin")
+    return drain_controller.status()
+
+
+def reuseport_socket(host: str, port: int) -> socket.socket:
+    """创建带 SO_REUSEPORT 的监听套接字，允许新旧进程同时监听同一端口"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def notify_ready():
+    """通知 supervisor 本进程已完成启动并开始监听"""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"ready\n")
+        os.close(int(fd))
+    except OSError as e:
+        logger.warning("Could not notify supervisor: %s", e)
+
+
+def serve(app, host: str = "0.0.0.0", port: int = 8401, reuse_port: bool = SERVER_REUSEPORT):
+    """运行 uvicorn，第一次 SIGTERM 触发排空而不是立即退出"""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        async def startup(self, sockets=None):
+            self._loop = asyncio.get_running_loop()
+            await super().startup(sockets=sockets)
+            notify_ready()
+
+        def handle_exit(self, sig, frame):
+            if sig != signal.SIGTERM or drain_controller.draining or not hasattr(self, "_loop"):
+                # SIGINT、启动前的信号和排空期间的第二次信号：按 uvicorn 默认行为立即退出
+                drain_controller.on_drained = None
+                if drain_controller.draining:
+                    self.force_exit = True
+                super().handle_exit(sig, frame)
+                return
+            self._loop.call_soon_threadsafe(self._begin_drain)
+
+        def _begin_drain(self, reason: str = "SIGTERM"):
+            if drain_controller.begin(reason) and reuse_port:
+                # 停止接受新连接，让同端口上的新进程接手；已建立的连接不受影响
+                for server in getattr(self, "servers", []):
+                    server.close()
+
+        def _drained(self):
+            self.should_exit = True
+
+    # 超过宽限期仍未结束的连接，在退出时再给几秒后强制关闭
+    config = uvicorn.Config(app, host=host, port=port, timeout_graceful_shutdown=5)
+    server = DrainingServer(config)
+    drain_controller.on_drained = server._drained
+    if reuse_port:
+        sock = reuseport_socket(host, port)
+        server.run(sockets=[sock])
+    else:
+        server.run()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+异步结构化日志管道
+日志记录进入有界队列，由后台线程批量格式化后写入 NDJSON 滚动文件和标准输出，
+请求路径上只做级别检查和入队，消息的格式化推迟到写线程中完成。
+"""
+
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import traceback
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+LOG_DIR = os.environ.get("LOG_DIR", "logs")
+LOG_FILE = os.environ.get("LOG_FILE", "tenbin.ndjson")
+LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个日志文件最大字节数
+LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "5"))
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))  # 队列满时直接丢弃，不阻塞调用方
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 0.2  # 秒
+LOG_TO_FILE = os.environ.get("LOG_TO_FILE", "true").lower() == "true"
+
+ROOT_LOGGER = "tenbin"
+
+_STOP = object()
+
+
+class RotatingNDJSONWriter:
+    """按大小滚动的 NDJSON 文件写入器，只在写线程中使用"""
+
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+        self._size = 0
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._size = self._file.tell()
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f"{self.path}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{i + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, lines: List[str]):
+        if self._file is None:
+            self._open()
+        data = "".join(lines)
+        if self.max_bytes and self._size and self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class AsyncQueueHandler(logging.Handler):
+    """把日志记录原样放入队列，不在调用线程中格式化"""
+
+    def __init__(self, record_queue: "queue.Queue"):
+        super().__init__()
+        self.queue = record_queue
+        self.dropped = 0
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """后台日志写线程：批量取出记录，格式化为 NDJSON 并写入文件和标准输出"""
+
+    def __init__(self, to_file: bool = LOG_TO_FILE, to_stdout: bool = True):
+        self.queue: "queue.Queue" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.handler = AsyncQueueHandler(self.queue)
+        self.to_stdout = to_stdout
+        self.writer = (
+            RotatingNDJSONWriter(os.path.join(LOG_DIR, LOG_FILE), LOG_MAX_BYTES, LOG_BACKUP_COUNT)
+            if to_file
+            else None
+        )
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="log-pipeline", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 2.0):
+        """写完队列中剩余的记录后停止写线程"""
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        self._thread = None
+        if self.writer:
+            self.writer.close()
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                continue
+            batch = [first]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = any(record is _STOP for record in batch)
+            self._write([record for record in batch if record is not _STOP])
+            if stopping:
+                return
+
+    def _write(self, records: List[logging.LogRecord]):
+        if not records:
+            return
+        json_lines = []
+        text_lines = []
+        for record in records:
+            try:
+                entry = format_record(record)
+            except Exception as e:
+                entry = {"ts": record.created, "level": "ERROR", "logger": record.name, "msg": f"log format error: {e}"}
+            if self.writer:
+                json_lines.append(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+            if self.to_stdout:
+                text_lines.append(format_text(entry))
+        try:
+            if self.writer:
+                self.writer.write(json_lines)
+            if self.to_stdout:
+                sys.stdout.write("".join(text_lines))
+                sys.stdout.flush()
+        except Exception as e:
+            sys.stderr.write(f"log pipeline write error: {e}\n")
+
+
+def format_record(record: logging.LogRecord) -> Dict:
+    """把日志记录转换为结构化字典（在写线程中调用）"""
+    entry = {
+        "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+        "level": record.levelname,
+        "logger": record.name,
+        "msg": record.getMessage(),
+        "thread": record.threadName,
+    }
+    fields = getattr(record, "fields", None)
+    if fields:
+        entry.update(fields)
+    if record.exc_info:
+        entry["exc"] = "".join(traceback.format_exception(*record.exc_info))
+    return entry
+
+
+def format_text(entry: Dict) -> str:
+    """标准输出使用的单行文本格式"""
+    extra = " ".join(
+        f"{k}={v}" for k, v in entry.items() if k not in ("ts", "level", "logger", "msg", "thread", "exc")
+    )
+    line = f"[{entry['level']}] {entry['msg']}"
+    if extra:
+        line += f" {extra}"
+    if "exc" in entry:
+        line += "\n" + entry["exc"].rstrip("\n")
+    return line + "\n"
+
+
+_pipeline: Optional[LogPipeline] = None
+_pipeline_lock = threading.Lock()
+
+
+def configure_logging(level: int = logging.INFO) -> LogPipeline:
+    """启动日志管道并挂载到 tenbin 根日志器，重复调用只生效一次"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LogPipeline()
+            root = logging.getLogger(ROOT_LOGGER)
+            root.addHandler(_pipeline.handler)
+            root.setLevel(level)
+            root.propagate = False
+            _pipeline.start()
+        return _pipeline
+
+
+def shutdown_logging():
+    """停止日志管道，写完剩余记录"""
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is not None:
+            logging.getLogger(ROOT_LOGGER).removeHandler(_pipeline.handler)
+            _pipeline.stop()
+            _pipeline = None
+
+
+def get_logger(name: str = ROOT_LOGGER) -> logging.Logger:
+    """获取 tenbin 命名空间下的日志器"""
+    if name != ROOT_LOGGER and not name.startswith(ROOT_LOGGER + "."):
+        name = f"{ROOT_LOGGER}.{name}"
+    return logging.getLogger(name)
+
+
+def set_logger_level(name: str, level: str) -> str:
+    """运行时修改某个日志器的级别，返回生效的级别名"""
+    level_value = logging.getLevelName(level.upper())
+    if not isinstance(level_value, int):
+        raise ValueError(f"Unknown log level: {level}")
+    get_logger(name).setLevel(level_value)
+    return logging.getLevelName(level_value)
+
+
+def get_logger_levels() -> Dict[str, str]:
+    """列出 tenbin 命名空间下所有日志器的级别"""
+    levels = {ROOT_LOGGER: logging.getLevelName(logging.getLogger(ROOT_LOGGER).level)}
+    for name, logger in logging.root.manager.loggerDict.items():
+        if isinstance(logger, logging.Logger) and name.startswith(ROOT_LOGGER + "."):
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def get_pipeline_stats() -> Dict[str, int]:
+    """队列积压和丢弃计数"""
+    if _pipeline is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _pipeline.queue.qsize(), "dropped": _pipeline.handler.dropped}
+
@@ -1,20 +1,68 @@
-﻿import json
+﻿import asyncio
+import hashlib
+import json
+import logging
 import os
+import socket
 import time
 import uuid
 import threading
-from typing import Any, Dict, List, Optional, TypedDict, Union
+from typing import Any, Dict, List, Optional, Tuple, TypedDict, Union
 
 import requests
 import websocket
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 
 from getCaptcha import getCaptcha, getTaskId
-from config_manager import config_router
+from batch_jobs import batch_router, configure_batch_runner, resume_pending_batches, shutdown_batches
+from config_manager import config_router, conversation_router, conversation_store
+from debug_tools import debug_router, loop_lag_monitor
+from graceful_drain import DrainMiddleware, drain_controller, drain_router, serve
+from conversation_state import (
+    CONVERSATION_STATE_ENABLED,
+    CONVERSATION_STATE_FIRST_TOKEN_TIMEOUT,
+    ConversationRecorder,
+    conversation_cache,
+)
+from context_window import (
+    CONTEXT_WINDOW_ENABLED,
+    context_window_headers,
+    fit_messages,
+    get_prompt_budget,
+    load_model_capabilities,
+)
+from request_ingest import ChatRequestDecoder
+from model_router import alias_names, load_model_aliases, model_router, resolve_model_alias, router_stats
+from output_limits import MAX_STOP_SEQUENCES, OutputLimiter, normalize_stop
+from file_uploads import TENBIN_UPLOAD_URL, attachment_placeholder, extract_attachments, files_router, upload_attachments
+from stream_registry import STREAMING, WAITING, stream_registry, streams_router
+from stream_replay import SSE_HEADERS, SSE_RESUME_ENABLED, replay_registry, resume_response, stream_replay_router
+from tracing import (
+    TracingMiddleware,
+    configure_tracing,
+    current_span,
+    shutdown_tracing,
+    span,
+    start_span,
+    tracing_stats,
+    use_span,
+)
+from ws_capture import RecordingTransport, should_capture
+from log_pipeline import (
+    configure_logging,
+    get_logger,
+    get_logger_levels,
+    get_pipeline_stats,
+    set_logger_level,
+    shutdown_logging,
+)
+from circuit_breaker import breaker_states, stream_breaker, token_breaker
+from deadline import REQUEST_DEADLINE, STREAM_IDLE_TIMEOUT, Deadline, DeadlineExceeded, request_deadline
+from upstream_stats import HEDGE_ENABLED, hedge_budget, hedge_delay, hedge_metrics, ttft_tracker
 
 
 # Tenbin Account Management
@@ -27,6 +75,7 @@ class TenbinAccount(TypedDict):
 
 # Global variables
 VALID_CLIENT_KEYS: set = set()
+VALID_ADMIN_KEYS: set = set()
 TENBIN_ACCOUNTS: List[TenbinAccount] = []
 TENBIN_MODELS: Dict[str, str] = {}  # Ä£ÐÍÓ³Éä±í£¬key ÊÇÄ£ÐÍÃû³Æ£¬value ÊÇÄÚ²¿Ä£ÐÍ ID
 account_rotation_lock = threading.Lock()
@@ -34,6 +83,15 @@ MAX_ERROR_COUNT = 3
 ERROR_COOLDOWN = 300  # 5 minutes cooldown for accounts with errors
 DEBUG_MODE = os.environ.get("DEBUG_MODE", "false").lower() == "true"
 REQUEST_TIMEOUT = 120.0  # ÇëÇó³¬Ê±Ê±¼ä£¬Ãë
+STREAM_COALESCE_MS = int(os.environ.get("STREAM_COALESCE_MS", "0"))  # SSE 增量合并窗口，毫秒，0 表示关闭
+STREAM_COALESCE_BYTES = int(os.environ.get("STREAM_COALESCE_BYTES", "4096"))  # 单个合并事件的最大字节数
+# 请求中 coalesce_ms / coalesce_bytes 的上限：合并缓冲按流占用内存，并推迟增量发出
+STREAM_COALESCE_MAX_MS = int(os.environ.get("STREAM_COALESCE_MAX_MS", "1000"))
+STREAM_COALESCE_MAX_BYTES = int(os.environ.get("STREAM_COALESCE_MAX_BYTES", str(64 * 1024)))
+STREAM_MAX_RESPONSE_CHARS = int(os.environ.get("STREAM_MAX_RESPONSE_CHARS", str(4 * 1024 * 1024)))  # 单个流接收的最大字符数，0 表示不限制
+STREAM_HEARTBEAT_INTERVAL = float(os.environ.get("STREAM_HEARTBEAT_INTERVAL", "5"))  # 等待首个增量时的心跳间隔，秒，0 表示关闭
+CHOICES_MAX = int(os.environ.get("CHOICES_MAX", "8"))  # 单个请求 n 的上限，每个选项占用一个上游会话
+replay_registry.heartbeat = STREAM_HEARTBEAT_INTERVAL
 
 
 # Pydantic Models
@@ -48,9 +106,19 @@ class ChatCompletionRequest(BaseModel):
     messages: List[ChatMessage]
     stream: bool = True
     temperature: Optional[float] = None
-    max_tokens: Optional[int] = None
+    n: int = 1  # 选项数，并发运行 n 个上游会话
+    max_tokens: Optional[int] = None  # 在本地按估算的 token 数截断，达到后取消上游
+    stop: Optional[Union[str, List[str]]] = None  # 在本地匹配的停止序列，最多 4 个
     top_p: Optional[float] = None
     raw_response: bool = False  # ÊÇ·ñ·µ»ØÔ­Ê¼ÏìÓ¦
+    coalesce_ms: Optional[int] = Field(None, ge=0, le=STREAM_COALESCE_MAX_MS)  # 覆盖服务器的 SSE 增量合并窗口
+    coalesce_bytes: Optional[int] = Field(None, ge=0, le=STREAM_COALESCE_MAX_BYTES)  # 覆盖服务器的合并事件最大字节数
+    context_window: Optional[bool] = None  # 是否按模型 token 预算裁剪历史，默认跟随服务器配置
+    hedge: Optional[bool] = None  # 首字过慢时是否用另一个账户对冲，默认跟随服务器配置
+    timeout: Optional[float] = None  # 请求总时间预算，秒，也可用 X-Request-Timeout 请求头指定
+    reuse_state: Optional[bool] = None  # 是否复用上游会话状态只发送新的用户消息，默认跟随服务器配置
+    conversation_id: Optional[str] = None  # 服务端保存的对话，其历史拼接在 messages 之前
+    conversation_before: Optional[int] = None  # 只使用序号小于该值的历史，用于重新生成等场景
 
 
 class ModelInfo(BaseModel):
@@ -103,6 +171,11 @@ class StreamResponse(BaseModel):
 # FastAPI App
 app = FastAPI(title="Tenbin OpenAI API Adapter")
 
+# 排空期间拒绝新请求；放在 CORS 内层，使浏览器能读到 503
+app.add_middleware(DrainMiddleware)
+# 聊天请求的根 span，覆盖到流式响应结束
+app.add_middleware(TracingMiddleware)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -118,10 +191,15 @@ security = HTTPBearer(auto_error=False)
 app.include_router(config_router)
 
 
-def log_debug(message: str):
+logger = get_logger()
+stream_logger = get_logger("stream")  # 逐帧日志，量大，可单独调整级别
+upstream_logger = get_logger("upstream")
+
+
+def log_debug(message: str, *args, **fields):
     """DebugÈÕÖ¾º¯Êý"""
-    if DEBUG_MODE:
-        print(f"[DEBUG] {message}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message, *args, extra={"fields": fields} if fields else None)
 
 
 def load_client_api_keys():
@@ -140,6 +218,27 @@ def load_client_api_keys():
         VALID_CLIENT_KEYS = set()
 
 
+def load_admin_api_keys():
+    """Load admin API keys from the ADMIN_API_KEYS env var (comma separated) or admin_api_keys.json"""
+    global VALID_ADMIN_KEYS
+    env_keys = os.environ.get("ADMIN_API_KEYS", "")
+    if env_keys:
+        VALID_ADMIN_KEYS = {key.strip() for key in env_keys.split(",") if key.strip()}
+        print(f"Successfully loaded {len(VALID_ADMIN_KEYS)} admin API keys from ADMIN_API_KEYS.")
+        return
+    try:
+        with open("admin_api_keys.json", "r", encoding="utf-8") as f:
+            keys = json.load(f)
+            VALID_ADMIN_KEYS = set(keys) if isinstance(keys, list) else set()
+            print(f"Successfully loaded {len(VALID_ADMIN_KEYS)} admin API keys.")
+    except FileNotFoundError:
+        print("admin_api_keys.json not found. Admin endpoints are disabled.")
+        VALID_ADMIN_KEYS = set()
+    except Exception as e:
+        print(f"Error loading admin_api_keys.json: {e}")
+        VALID_ADMIN_KEYS = set()
+
+
 def load_tenbin_accounts():
     """Load Tenbin accounts from tenbin.json"""
     global TENBIN_ACCOUNTS
@@ -214,63 +313,115 @@ def get_best_tenbin_account() -> Optional[TenbinAccount]:
         return account
 
 
+def render_prompt_segment(role: str, content: Union[str, List[Dict[str, Any]]]) -> str:
+    """把一条消息渲染为 Tenbin 提示中的一段"""
+    if isinstance(content, list):
+        # 图片/文件附件另行上传，提示中保留文件名和类型的说明，上传失败或未配置上传时不至于丢失附件
+        content = " ".join(
+            item.get("text", "") if item.get("type") == "text" else attachment_placeholder(item)
+            for item in content
+            if item.get("type") == "text" or attachment_placeholder(item)
+        )
+    
+    if role == "system":
+        # ÏµÍ³ÏûÏ¢×÷Îª Human ÏûÏ¢µÄÇ°×º
+        return f"\n\nHuman: <system>{content}</system>"
+    if role == "user":
+        return f"\n\nHuman: {content}"
+    if role == "assistant":
+        return f"\n\nAssistant: {content}"
+    # ºöÂÔÆäËû½ÇÉ«
+    return ""
+
+
 def build_tenbin_prompt(messages: List[ChatMessage]) -> str:
     """½« OpenAI ¸ñÊ½µÄÏûÏ¢ÁÐ±í×ª»»Îª Tenbin ¸ñÊ½µÄµ¥¸ö×Ö·û´®"""
-    prompt = ""
-    for msg in messages:
-        role = msg.role
-        content = msg.content
-        if isinstance(content, list):
-            # ¼òµ¥´¦Àí¶àÄ£Ì¬ÄÚÈÝ£¬Ö»ÌáÈ¡ÎÄ±¾²¿·Ö
-            content = " ".join([
-                item.get("text", "") 
-                for item in content 
-                if item.get("type") == "text"
-            ])
-        
-        # Ìí¼Óµ½ÌáÊ¾ÖÐ
-        if role == "system":
-            # ÏµÍ³ÏûÏ¢×÷Îª Human ÏûÏ¢µÄÇ°×º
-            prompt += f"\n\nHuman: <system>{content}</system>"
-        elif role == "user":
-            prompt += f"\n\nHuman: {content}"
-        elif role == "assistant":
-            prompt += f"\n\nAssistant: {content}"
-        # ºöÂÔÆäËû½ÇÉ«
+    segments = [render_prompt_segment(msg.role, msg.content) for msg in messages]
     
     # Ìí¼Ó×îºóµÄ "Assistant:" ÌáÊ¾
-    prompt += "\n\nAssistant:"
-    return prompt
+    segments.append("\n\nAssistant:")
+    return "".join(segments)
 
 
 async def authenticate_client(
+    request: Request,
     auth: Optional[HTTPAuthorizationCredentials] = Depends(security),
 ):
-    """Authenticate client based on API key in Authorization header"""
-    if not VALID_CLIENT_KEYS:
+    """Authenticate client based on API key in Authorization header
+
+    认证通过后把 API Key 的哈希记为 request.state.client_id，批次、对话等按它区分所属客户端。
+    """
+    with span("auth"):
+        if not VALID_CLIENT_KEYS:
+            raise HTTPException(
+                status_code=503,
+                detail="Service unavailable: Client API keys not configured on server.",
+            )
+
+        if not auth or not auth.credentials:
+            raise HTTPException(
+                status_code=401,
+                detail="API key required in Authorization header.",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+        if auth.credentials not in VALID_CLIENT_KEYS:
+            raise HTTPException(status_code=403, detail="Invalid client API key.")
+        request.state.client_id = client_id_for_key(auth.credentials)
+
+
+def client_id_for_key(api_key: str) -> str:
+    """客户端标识：API Key 的哈希，保存到磁盘的数据中不出现 Key 本身"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+
+
+async def authenticate_admin(
+    auth: Optional[HTTPAuthorizationCredentials] = Depends(security),
+):
+    """Authenticate operator access to the admin and diagnostics endpoints"""
+    if not VALID_ADMIN_KEYS:
         raise HTTPException(
             status_code=503,
-            detail="Service unavailable: Client API keys not configured on server.",
+            detail="Service unavailable: Admin API keys not configured on server.",
         )
 
     if not auth or not auth.credentials:
         raise HTTPException(
             status_code=401,
-            detail="API key required in Authorization header.",
+            detail="Admin API key required in Authorization header.",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    if auth.credentials not in VALID_CLIENT_KEYS:
-        raise HTTPException(status_code=403, detail="Invalid client API key.")
+    if auth.credentials not in VALID_ADMIN_KEYS:
+        raise HTTPException(status_code=403, detail="Invalid admin API key.")
+
+
+# 附件上传和批处理路由，需要客户端认证
+app.include_router(files_router, dependencies=[Depends(authenticate_client)])
+app.include_router(batch_router, dependencies=[Depends(authenticate_client)])
+app.include_router(stream_replay_router, dependencies=[Depends(authenticate_client)])
+app.include_router(conversation_router, dependencies=[Depends(authenticate_client)])
+# 运行时诊断路由，需要管理员认证
+app.include_router(debug_router, dependencies=[Depends(authenticate_admin)])
+app.include_router(streams_router, dependencies=[Depends(authenticate_admin)])
+app.include_router(drain_router, dependencies=[Depends(authenticate_admin)])
 
 
 @app.on_event("startup")
 async def startup():
     """Ó¦ÓÃÆô¶¯Ê±³õÊ¼»¯ÅäÖÃ"""
+    configure_logging(logging.DEBUG if DEBUG_MODE else logging.INFO)
+    configure_tracing()
     print("Starting Tenbin OpenAI API Adapter server...")
     load_client_api_keys()
+    load_admin_api_keys()
     load_tenbin_accounts()
     load_tenbin_models()
+    load_model_aliases(TENBIN_MODELS)
+    load_model_capabilities()
+    configure_batch_runner(run_batch_request)
+    resume_pending_batches()
+    loop_lag_monitor.start()
     print("Server initialization completed.")
 
 
@@ -284,6 +435,10 @@ def get_models_list_response() -> ModelList:
         )
         for model_id in TENBIN_MODELS.keys()
     ]
+    # 虚拟别名按延迟路由到一组真实模型
+    model_infos.extend(
+        ModelInfo(id=alias, created=int(time.time()), owned_by="tenbin-router") for alias in alias_names()
+    )
     return ModelList(data=model_infos)
 
 
@@ -299,20 +454,81 @@ async def list_models_no_auth():
     return get_models_list_response()
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    """停止批处理任务并写完剩余日志"""
+    loop_lag_monitor.stop()
+    await shutdown_batches()
+    shutdown_tracing()
+    shutdown_logging()
+
+
+@app.get("/health")
+async def health():
+    """健康检查：返回上游熔断器状态；排空期间返回 503，负载均衡器据此摘除本实例"""
+    breakers = breaker_states()
+    if drain_controller.draining:
+        return JSONResponse(
+            status_code=503, content={"status": "draining", "drain": drain_controller.status(), "breakers": breakers}
+        )
+    degraded = any(state["state"] != "closed" for state in breakers.values())
+    return {"status": "degraded" if degraded else "ok", "breakers": breakers}
+
+
 @app.get("/debug")
-async def toggle_debug(enable: bool = Query(None)):
-    """ÇÐ»»µ÷ÊÔÄ£Ê½"""
+async def toggle_debug(
+    enable: bool = Query(None),
+    logger_name: Optional[str] = Query(None, alias="logger"),
+    level: Optional[str] = Query(None),
+    _: None = Depends(authenticate_admin),
+):
+    """ÇÐ»»µ÷ÊÔÄ£Ê½
+
+    可在运行时打开包含用户提示的 DEBUG 日志并暴露内部状态，需要管理员认证。
+    """
     global DEBUG_MODE
     if enable is not None:
         DEBUG_MODE = enable
-    return {"debug_mode": DEBUG_MODE}
+        logger.setLevel(logging.DEBUG if DEBUG_MODE else logging.INFO)
+    if level is not None:
+        try:
+            set_logger_level(logger_name or logger.name, level)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return {
+        "debug_mode": DEBUG_MODE,
+        "loggers": get_logger_levels(),
+        "log_pipeline": get_pipeline_stats(),
+        "hedging": {"enabled": HEDGE_ENABLED, **hedge_metrics.snapshot()},
+        "ttft": ttft_tracker.snapshot(),
+        "sse_replay": replay_registry.stats(),
+        "conversation_state": conversation_cache.stats(),
+        "streams": stream_registry.stats(),
+        "model_router": router_stats(),
+        "drain": drain_controller.status(),
+        "tracing": tracing_stats(),
+    }
 
 
-@app.post("/v1/chat/completions")
-async def chat_completions(
-    request: ChatCompletionRequest, _: None = Depends(authenticate_client)
-):
-    """´´½¨ÁÄÌìÍê³É - Ê¹ÓÃ Tenbin API"""
+class UpstreamSession(TypedDict):
+    session_id: str
+    execution_token: str
+    file_upload_ids: List[str]
+    state_token: str  # 复用的上游会话状态，空串表示新会话
+
+
+def resolve_chat_request(request: ChatCompletionRequest) -> Tuple[str, List[ChatMessage], str, Dict[str, str]]:
+    """校验请求并构建提示，返回 (内部模型 ID, 消息, 提示, 响应头)
+
+    请求的是虚拟别名时，把 request.model 改为本次选中的真实模型，响应中的 model 即为实际使用的模型。
+    """
+    context_headers = {}
+    routed_model = resolve_model_alias(request.model)
+    if routed_model is not None:
+        log_debug("Routing alias %s to %s", request.model, routed_model)
+        context_headers = {"X-Model-Alias": request.model, "X-Routed-Model": routed_model}
+        request.model = routed_model
+    
     # ¼ì²éÄ£ÐÍÊÇ·ñ´æÔÚ
     if request.model not in TENBIN_MODELS:
         raise HTTPException(status_code=404, detail=f"Model '{request.model}' not found.")
@@ -323,15 +539,129 @@ async def chat_completions(
     if not request.messages:
         raise HTTPException(status_code=400, detail="No messages provided in the request.")
     
-    log_debug(f"Processing request for model: {request.model} (internal ID: {internal_model_id})")
+    if request.max_tokens is not None and request.max_tokens < 1:
+        raise HTTPException(status_code=400, detail="max_tokens must be at least 1.")
+    if not 1 <= request.n <= CHOICES_MAX:
+        raise HTTPException(status_code=400, detail=f"n must be between 1 and {CHOICES_MAX}.")
+    if len(normalize_stop(request.stop)) > MAX_STOP_SEQUENCES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STOP_SEQUENCES} stop sequences are supported.")
     
-    # ¹¹½¨ Tenbin ¸ñÊ½µÄÌáÊ¾
-    prompt = build_tenbin_prompt(request.messages)
-    log_debug(f"Built prompt with length: {len(prompt)}")
+    log_debug("Processing request for model: %s (internal ID: %s)", request.model, internal_model_id)
+    current_span().set_attributes(
+        {"model": request.model, "model.alias": context_headers.get("X-Model-Alias", ""), "stream": request.stream, "n": request.n}
+    )
     
+    with span("prompt.build", messages=len(request.messages)) as build_span:
+        # 按模型预算裁剪过长的历史
+        messages = request.messages
+        use_context_window = CONTEXT_WINDOW_ENABLED if request.context_window is None else request.context_window
+        if use_context_window:
+            fitted, context_stats = fit_messages(messages, get_prompt_budget(request.model))
+            # 占位消息以字典给出；原有消息可能是 ChatMessage 或快速解析得到的结构体，原样保留
+            messages = [ChatMessage(**m) if isinstance(m, dict) else m for m in fitted]
+            context_headers.update(context_window_headers(context_stats))
+            log_debug("Context window applied", model=request.model, **context_stats)
+        
+        # ¹¹½¨ Tenbin ¸ñÊ½µÄÌáÊ¾
+        prompt = build_tenbin_prompt(messages)
+        build_span.set_attributes({"messages.kept": len(messages), "prompt.chars": len(prompt)})
+    log_debug("Built prompt with length: %d", len(prompt))
+    return internal_model_id, messages, prompt, context_headers
+
+
+async def load_conversation_history(request: ChatCompletionRequest, client_id: Optional[str]):
+    """请求带 conversation_id 时，把服务端保存的历史插到请求消息之前（开头的系统消息之后）
+
+    客户端只需发送新一轮的消息，不必每轮上传完整历史。只能读取 client_id 自己的对话。
+    """
+    if not request.conversation_id:
+        return
+    try:
+        history = await asyncio.to_thread(
+            conversation_store.history, request.conversation_id, request.conversation_before, owner=client_id
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Conversation '{request.conversation_id}' not found.")
+    stored = [
+        ChatMessage.model_construct(
+            role=m["role"], content=m["content"], reasoning_content=m.get("reasoning_content")
+        )
+        for m in history
+    ]
+    messages = list(request.messages)
+    system_count = 0
+    while system_count < len(messages) and messages[system_count].role == "system":
+        system_count += 1
+    request.messages = messages[:system_count] + stored + messages[system_count:]
+    log_debug("Loaded conversation history", conversation_id=request.conversation_id, messages=len(stored))
+
+
+async def load_attachments(messages: List[ChatMessage], client_id: Optional[str] = None):
+    """取出图片/文件附件，解码后保存到本地，稍后按账户上传；file id 只解析 client_id 上传过的附件"""
+    try:
+        attachments = await asyncio.to_thread(extract_attachments, messages, client_id)
+    except ValueError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if attachments:
+        log_debug("Found %d attachments", len(attachments))
+    return attachments
+
+
+def record_account_error(account: TenbinAccount, error_detail: str):
+    """记录账户错误，认证错误直接标记账户无效"""
+    session_id = account["session_id"]
+    with account_rotation_lock:
+        # Ôö¼Ó´íÎó¼ÆÊý
+        account["error_count"] += 1
+        log_debug("Account ...%s error count: %d", session_id[-4:], account["error_count"])
+        
+        # Èç¹û´íÎó¿´ÆðÀ´ÊÇÈÏÖ¤ÎÊÌâ£¬±ê¼ÇÕË»§ÎªÎÞÐ§
+        if "authentication" in error_detail.lower() or "unauthorized" in error_detail.lower():
+            account["is_valid"] = False
+            log_debug("Account ...%s marked as invalid due to auth error.", session_id[-4:])
+
+
+def find_tenbin_account(session_id: str) -> Optional[TenbinAccount]:
+    """按 session_id 查找仍然有效的账户"""
+    with account_rotation_lock:
+        for acc in TENBIN_ACCOUNTS:
+            if acc["session_id"] == session_id and acc["is_valid"] and acc["error_count"] < MAX_ERROR_COUNT:
+                acc["last_used"] = time.time()
+                return acc
+    return None
+
+
+def upload_attachments_or_skip(attachments, session_id: str) -> List[str]:
+    """上传附件；上传接口未配置或上传失败时只发送文本，不计为账户错误，也不换账户重试"""
+    if not attachments:
+        return []
+    if not TENBIN_UPLOAD_URL:
+        log_debug("TENBIN_UPLOAD_URL is not configured, sending %d attachments as text only", len(attachments))
+        return []
+    try:
+        with span("upstream.upload", attachments=len(attachments)):
+            return upload_attachments(attachments, session_id)
+    except Exception as e:
+        upstream_logger.warning("Attachment upload failed, sending text only: %s", e)
+        return []
+
+
+def acquire_upstream_session(
+    internal_model_id: str, attachments, deadline: Deadline, session_id: Optional[str] = None
+) -> Optional[UpstreamSession]:
+    """轮询账户获取执行令牌并上传附件，所有账户都失败时返回 None
+
+    指定 session_id 时只尝试该账户（复用会话状态），账户不可用时返回 None。
+    """
+    pinned = session_id
     # ³¢ÊÔËùÓÐÕË»§
-    for attempt in range(len(TENBIN_ACCOUNTS)):
-        account = get_best_tenbin_account()
+    for attempt in range(1 if pinned else len(TENBIN_ACCOUNTS)):
+        deadline.check("token issuance")
+        account = find_tenbin_account(pinned) if pinned else get_best_tenbin_account()
+        if not account and pinned:
+            return None
         if not account:
             raise HTTPException(
                 status_code=503, 
@@ -339,57 +669,142 @@ async def chat_completions(
             )
 
         session_id = account["session_id"]
-        log_debug(f"Using account with session_id ending in ...{session_id[-4:]}")
+        log_debug("Using account with session_id ending in ...%s", session_id[-4:])
         
+        # 熔断器打开时直接返回 503，不再逐个账户等待超时
+        token_breaker.before_call()
+        started = time.monotonic()
         try:
             # »ñÈ¡Ö´ÐÐÁîÅÆ
-            execution_token = get_tenbin_execution_token(internal_model_id, session_id)
-            
-            if request.stream:
-                log_debug("Returning stream response")
-                return StreamingResponse(
-                    tenbin_stream_generator(request.model, prompt, session_id, execution_token),
-                    media_type="text/event-stream",
-                    headers={
-                        "Cache-Control": "no-cache",
-                        "Connection": "keep-alive",
-                        "X-Accel-Buffering": "no",
-                    },
-                )
-            else:
-                log_debug("Building non-stream response")
-                return build_tenbin_non_stream_response(request.model, prompt, session_id, execution_token)
+            try:
+                with span("upstream.token", account=f"...{session_id[-4:]}", attempt=attempt):
+                    execution_token = get_tenbin_execution_token(internal_model_id, session_id, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                token_breaker.record_failure(time.monotonic() - started)
+                raise
+            token_breaker.record_success(time.monotonic() - started)
+            file_upload_ids = upload_attachments_or_skip(attachments, session_id)
+            return {
+                "session_id": session_id,
+                "execution_token": execution_token,
+                "file_upload_ids": file_upload_ids,
+                "state_token": "",
+            }
 
+        except DeadlineExceeded:
+            # 预算用完，换账户重试也来不及
+            raise
         except Exception as e:
             error_detail = str(e)
-            log_debug(f"Tenbin API error: {error_detail}")
+            log_debug("Tenbin API error: %s", error_detail)
+            record_account_error(account, error_detail)
 
-            with account_rotation_lock:
-                # Ôö¼Ó´íÎó¼ÆÊý
-                account["error_count"] += 1
-                log_debug(f"Account ...{session_id[-4:]} error count: {account['error_count']}")
-                
-                # Èç¹û´íÎó¿´ÆðÀ´ÊÇÈÏÖ¤ÎÊÌâ£¬±ê¼ÇÕË»§ÎªÎÞÐ§
-                if "authentication" in error_detail.lower() or "unauthorized" in error_detail.lower():
-                    account["is_valid"] = False
-                    log_debug(f"Account ...{session_id[-4:]} marked as invalid due to auth error.")
+    return None
 
-    # ËùÓÐ³¢ÊÔ¶¼Ê§°Ü
+
+async def open_upstream(model: str, internal_model_id: str, attachments, deadline: Deadline) -> UpstreamSession:
+    """获取上游会话；获取执行令牌会阻塞数秒，放到线程池中执行
+
+    失败（没有可用账户、令牌获取失败、超时）时按公开模型名记入别名路由的错误率，
+    否则令牌阶段总是失败的模型永远没有样本，会一直被当作未尝试的模型选中。
+    """
+    try:
+        upstream = await asyncio.to_thread(acquire_upstream_session, internal_model_id, attachments, deadline)
+    except Exception:
+        model_router.record_result(model, False)
+        raise
+    if upstream is None:
+        # ËùÓÐ³¢ÊÔ¶¼Ê§°Ü
+        model_router.record_result(model, False)
+        raise HTTPException(status_code=503, detail="All attempts to contact Tenbin API failed.")
+    return upstream
+
+
+async def run_chat_completion(request: ChatCompletionRequest, client_id: Optional[str] = None) -> ChatCompletionResponse:
+    """非流式执行一个聊天请求，供批处理等内部调用使用；client_id 为发起请求的客户端"""
+    await load_conversation_history(request, client_id)
+    internal_model_id, messages, prompt, _ = resolve_chat_request(request)
+    deadline = request_deadline(request.timeout)
+    attachments = await load_attachments(messages, client_id)
+    stream_breaker.before_call()
+    return await complete_non_stream(request, internal_model_id, prompt, attachments, deadline, client_id)
+
+
+async def run_batch_request(body: Dict[str, Any], client_id: Optional[str] = None) -> Dict[str, Any]:
+    """执行批处理中的一行请求，以创建批次的客户端的身份读取对话历史"""
+    try:
+        request = ChatCompletionRequest(**{**body, "stream": False})
+    except ValidationError as e:
+        raise ValueError(str(e))
+    response = await run_chat_completion(request, client_id)
+    return response.model_dump()
+
+
+chat_request_decoder = ChatRequestDecoder(ChatCompletionRequest)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(
+    response: Response,
+    raw_request: Request,
+    x_request_timeout: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None),
+    _: None = Depends(authenticate_client),
+):
+    """´´½¨ÁÄÌìÍê³É - Ê¹ÓÃ Tenbin API"""
+    # 认证通过后才读取请求体，超过 MAX_REQUEST_BODY_BYTES 时不再继续缓冲
+    request = await chat_request_decoder.read(raw_request)
+    client_id = getattr(raw_request.state, "client_id", None)
+    if last_event_id and request.stream and SSE_RESUME_ENABLED:
+        # 断线重连：从回放缓冲继续输出，不重新生成
+        return resume_response(last_event_id, client_id)
+    deadline = request_deadline(request.timeout, x_request_timeout)
+    await load_conversation_history(request, client_id)
+    internal_model_id, messages, prompt, context_headers = resolve_chat_request(request)
+    response.headers.update(context_headers)
+    attachments = await load_attachments(messages, client_id)
+    
+    # 订阅通道熔断时不必先花数秒获取执行令牌
+    stream_breaker.before_call()
+    
     if request.stream:
+        # 响应头发出后就无法再返回 503：令牌熔断已打开时先拒绝，这里只读状态，不占用半开探测名额
+        token_breaker.check()
+        # 立即开始响应，获取执行令牌等准备工作在流内进行
+        log_debug("Returning stream response")
+        stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+        events = stream_completion_events(
+            request, internal_model_id, prompt, attachments, deadline, stream_id, client_label(raw_request), client_id
+        )
+        if SSE_RESUME_ENABLED:
+            # 上游在后台任务中写入回放缓冲，本连接只是读者之一，断开后可带 Last-Event-ID 重连
+            events = replay_registry.read(replay_registry.start(stream_id, events, client_id))
         return StreamingResponse(
-            error_stream_generator("All attempts to contact Tenbin API failed.", 503),
+            events,
             media_type="text/event-stream",
-            status_code=503,
+            headers={**SSE_HEADERS, "X-Stream-Id": stream_id, **context_headers},
         )
-    else:
-        raise HTTPException(status_code=503, detail="All attempts to contact Tenbin API failed.")
+    
+    log_debug("Building non-stream response")
+    return await complete_non_stream(request, internal_model_id, prompt, attachments, deadline, client_id)
+
 
+def client_label(raw_request: Request) -> str:
+    """用于活动流列表的客户端标识：API Key 的首尾几位和来源地址"""
+    host = raw_request.client.host if raw_request.client else "unknown"
+    key = raw_request.headers.get("authorization", "").partition(" ")[2]
+    return f"{key[:6]}...{key[-4:]}@{host}" if len(key) > 12 else f"{key}@{host}"
 
-def get_tenbin_execution_token(model: str, session_id: str) -> str:
+
+def get_tenbin_execution_token(model: str, session_id: str, deadline: Deadline) -> str:
     """»ñÈ¡ Tenbin Ö´ÐÐÁîÅÆ"""
+    stage = "token provider call"
     try:
-        task_id = getTaskId()
-        captcha = getCaptcha(task_id)
+        task_id = getTaskId(timeout=deadline.timeout(stage))
+        captcha = getCaptcha(task_id, timeout=deadline.timeout(stage))
+        stage = "token issuance"
         url = "https://graphql.tenbin.ai/graphql"
 
         payload = {
@@ -408,25 +823,206 @@ def get_tenbin_execution_token(model: str, session_id: str) -> str:
             "Cookie": f"sessionId={session_id}",
         }
 
-        log_debug(f"Getting execution token for model: {model}")
-        response = requests.post(url, data=json.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT)
+        upstream_logger.debug("Getting execution token for model: %s", model)
+        response = requests.post(
+            url, data=json.dumps(payload), headers=headers, timeout=deadline.timeout(stage, REQUEST_TIMEOUT)
+        )
         response.raise_for_status()
         
         execution_token = response.json()["data"]["executionTokens"][0]
-        log_debug(f"Got execution token: {execution_token[:10]}...")
+        upstream_logger.debug("Got execution token: %.10s...", execution_token)
         return execution_token
+    except (TimeoutError, requests.Timeout):
+        # 超时是因为预算用完时报告具体阶段
+        deadline.check(stage)
+        raise
     except Exception as e:
-        log_debug(f"Error getting execution token: {e}")
+        upstream_logger.debug("Error getting execution token: %s", e)
         raise
 
 
-def tenbin_stream_generator(model: str, prompt: str, session_id: str, execution_token: str):
-    """Tenbin WebSocket Á÷Ê½ÏìÓ¦Éú³ÉÆ÷"""
-    stream_id = f"chatcmpl-{uuid.uuid4().hex}"
-    created_time = int(time.time())
-    
-    # ·¢ËÍ³õÊ¼½ÇÉ«ÔöÁ¿
-    yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'role': 'assistant'})]).json()}\n\n"
+def encode_stream_chunk(
+    stream_id: str,
+    created: int,
+    model: str,
+    delta: Dict[str, Any],
+    finish_reason: Optional[str] = None,
+    index: int = 0,
+) -> str:
+    """将一个增量编码为 SSE 事件
+
+    输出与 StreamResponse.model_dump_json() 相同，但不为每个增量创建 pydantic 对象。
+    """
+    chunk = {
+        "id": stream_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": model,
+        "choices": [{"delta": delta, "index": index, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+
+def decode_upstream_frame(msg: str) -> Optional[Dict[str, Any]]:
+    """解析上游 graphql-transport-ws 帧，返回 startConversation 数据，非 next 帧返回 None"""
+    data = json.loads(msg)
+    if data.get("type") != "next":
+        return None
+    payload_data = data.get("payload", {}).get("data") or {}
+    return payload_data.get("startConversation") or {}
+
+
+class ReasoningSplitter:
+    """按思考/回答分隔符拆分思考模型的输出，产出 (delta 字段, 文本) 片段"""
+
+    SEPARATOR = "\n\n---\n\n"
+
+    def __init__(self, enabled: bool):
+        self.answering = not enabled
+        self._parts: List[str] = []
+        self._tail = ""  # 已累积内容的末尾，长度小于分隔符，用于发现跨 token 的分隔符
+
+    def feed(self, token: str) -> List[Tuple[str, str]]:
+        if self.answering:
+            return [("content", token)]
+
+        window = self._tail + token
+        index = window.find(self.SEPARATOR)
+        if index < 0:
+            # 继续累积思考内容；只保存片段列表，避免每个 token 复制一次全部思考内容
+            self._parts.append(token)
+            self._tail = window[-(len(self.SEPARATOR) - 1):]
+            return []
+
+        # 找到分隔符，切换到回答模式
+        combined = "".join(self._parts) + token
+        index += len(combined) - len(window)
+        thinking_content = combined[:index]
+        answer_content = combined[index + len(self.SEPARATOR):]
+        self.answering = True
+        self._parts = []
+        self._tail = ""
+        segments = []
+        if thinking_content:
+            segments.append(("reasoning_content", thinking_content))
+        if answer_content:
+            segments.append(("content", answer_content))
+        return segments
+
+    def finish(self) -> List[Tuple[str, str]]:
+        """返回尚未发送的思考内容"""
+        if self.answering or not self._parts:
+            return []
+        thinking = "".join(self._parts)
+        self._parts = []
+        self._tail = ""
+        return [("reasoning_content", thinking)]
+
+
+class DeltaCoalescer:
+    """合并相邻的同类增量（content / reasoning_content），减少 SSE 事件和 socket 写入次数
+
+    max_delay_ms 为 0 时关闭合并；max_bytes 为 0 时不限制单个事件的大小。
+    """
+
+    def __init__(self, max_delay_ms: int = 0, max_bytes: int = 0):
+        self.max_delay = max(max_delay_ms, 0) / 1000.0
+        self.max_bytes = max(max_bytes, 0)
+        self._kind: Optional[str] = None
+        self._parts: List[str] = []
+        self._size = 0
+        self._started = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_delay > 0
+
+    def push(self, kind: str, text: str) -> List[Tuple[str, str]]:
+        """加入一个增量，返回需要立即发送的片段"""
+        if not self.enabled:
+            return [(kind, text)]
+
+        ready = []
+        if self._parts and kind != self._kind:
+            ready.extend(self.flush())
+        if not self._parts:
+            self._kind = kind
+            self._started = time.monotonic()
+
+        self._parts.append(text)
+        self._size += len(text.encode("utf-8"))
+        if (self.max_bytes and self._size >= self.max_bytes) or self.time_left() == 0:
+            ready.extend(self.flush())
+        return ready
+
+    def time_left(self) -> Optional[float]:
+        """距离必须发送缓冲内容还剩多少秒，缓冲为空时返回 None"""
+        if not self._parts:
+            return None
+        return max(0.0, self._started + self.max_delay - time.monotonic())
+
+    def flush(self) -> List[Tuple[str, str]]:
+        if not self._parts:
+            return []
+        segment = (self._kind, "".join(self._parts))
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        return [segment]
+
+
+class UpstreamHandle:
+    """上游会话句柄，用于从其他线程取消正在进行的订阅"""
+
+    def __init__(self):
+        self.ws = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        ws = self.ws
+        if ws is None:
+            return
+        try:
+            # abort 会唤醒阻塞在 recv 上的线程
+            abort = getattr(ws, "abort", None)
+            if abort is not None:
+                abort()
+            else:
+                ws.close()
+        except Exception:
+            pass
+
+
+def iter_tenbin_segments(
+    model: str,
+    prompt: str,
+    session_id: str,
+    execution_token: str,
+    coalesce_ms: Optional[int] = None,
+    coalesce_bytes: Optional[int] = None,
+    transport=None,
+    file_upload_ids: Optional[List[str]] = None,
+    handle: Optional[UpstreamHandle] = None,
+    deadline: Optional[Deadline] = None,
+    state_token: str = "",
+):
+    """读取 Tenbin WebSocket 订阅，产出 (类型, 值) 片段
+
+    类型为 content / reasoning_content（增量文本）、state（上游返回的 newStateToken）、
+    finish（结束原因）、error（错误信息）、timeout（超出时间预算的说明）或 limit（超出单流内存上限的说明）。
+    """
+    # 请求指定的值限制在服务器上限内；请求中的 0 字节表示不限制，按上限处理
+    if coalesce_ms is not None:
+        coalesce_ms = min(coalesce_ms, STREAM_COALESCE_MAX_MS)
+    if coalesce_bytes is not None:
+        coalesce_bytes = min(coalesce_bytes or STREAM_COALESCE_MAX_BYTES, STREAM_COALESCE_MAX_BYTES)
+    coalescer = DeltaCoalescer(
+        STREAM_COALESCE_MS if coalesce_ms is None else coalesce_ms,
+        STREAM_COALESCE_BYTES if coalesce_bytes is None else coalesce_bytes,
+    )
+    handle = handle or UpstreamHandle()
+    deadline = deadline or Deadline(REQUEST_DEADLINE)
     
     # Á¬½Ó WebSocket
     url = "wss://graphql.tenbin.ai/graphql"
@@ -447,13 +1043,39 @@ def tenbin_stream_generator(model: str, prompt: str, session_id: str, execution_
         "Sec-WebSocket-Protocol": "graphql-transport-ws",
     }
     
+    # 订阅结果只向熔断器记录一次：首个增量到达为成功（耗时即首字时间），此前出错为失败
+    started = time.monotonic()
+    settled = False
+
+    def settle(failed: bool):
+        nonlocal settled
+        if not settled:
+            settled = True
+            stream_breaker.record(time.monotonic() - started, failed)
+
     ws = None
     try:
-        log_debug("Connecting to WebSocket...")
-        ws = websocket.create_connection(url, header=headers)
-        ws.send(json.dumps({"type": "connection_init"}))
-        init_response = ws.recv()
-        log_debug(f"WebSocket init response: {init_response}")
+        try:
+            if transport is not None:
+                # 使用调用方提供的连接（例如回放抓包）
+                ws = transport
+            else:
+                log_debug("Connecting to WebSocket...")
+                with span("ws.connect"):
+                    ws = websocket.create_connection(url, header=headers, timeout=deadline.timeout("connect"))
+                if should_capture():
+                    ws = RecordingTransport(ws, model)
+                    log_debug("Recording upstream frames to %s", ws.path)
+            handle.ws = ws
+            if handle.cancelled:
+                return
+            with span("ws.init"):
+                ws.send(json.dumps({"type": "connection_init"}))
+                ws.settimeout(deadline.timeout("connect"))
+                init_response = ws.recv()
+            stream_logger.debug("WebSocket init response: %s", init_response)
+        except (websocket.WebSocketTimeoutException, socket.timeout):
+            raise DeadlineExceeded("connect", deadline.seconds)
         
         # ·¢ËÍ¶©ÔÄÇëÇó
         payload = {
@@ -463,7 +1085,8 @@ def tenbin_stream_generator(model: str, prompt: str, session_id: str, execution_
                 "variables": {
                     "prompt": prompt,
                     "executionToken": execution_token,
-                    "stateToken": "",
+                    "stateToken": state_token,
+                    **({"fileUploadIds": file_upload_ids} if file_upload_ids else {}),
                 },
                 "extensions": {},
                 "operationName": "StartConversation",
@@ -472,96 +1095,119 @@ def tenbin_stream_generator(model: str, prompt: str, session_id: str, execution_
         }
         
         log_debug("Sending subscription request...")
-        ws.send(json.dumps(payload))
+        with span("ws.subscribe", prompt_chars=len(prompt), stateful=bool(state_token)):
+            ws.send(json.dumps(payload))
         
-        # ´¦ÀíÏìÓ¦
-        accumulated_thinking = ""
-        thinking_mode = False
-        thinking_separator = "\n\n---\n\n"
-        is_thinking_model = model == "Claude-3.7-Sonnet-Extended"
+        # 处理响应
+        splitter = ReasoningSplitter(model == "Claude-3.7-Sonnet-Extended")
+        last_token_at = None
+        received_chars = 0
         
         while True:
             try:
+                # 首字前只受总预算约束，之后两个增量的间隔还不能超过 STREAM_IDLE_TIMEOUT
+                now = time.monotonic()
+                limit_at = deadline.expires_at
+                if last_token_at is not None:
+                    limit_at = min(limit_at, last_token_at + STREAM_IDLE_TIMEOUT)
+                if now >= limit_at:
+                    if last_token_at is None:
+                        raise DeadlineExceeded("first-token wait", deadline.seconds)
+                    if limit_at < deadline.expires_at:
+                        raise DeadlineExceeded("inter-token idle", STREAM_IDLE_TIMEOUT, "Idle timeout")
+                    raise DeadlineExceeded("streaming", deadline.seconds)
+                # 合并缓冲非空时，最多等待到合并窗口结束
+                wait = coalescer.time_left()
+                if wait == 0:
+                    yield from coalescer.flush()
+                    wait = None
+                ws.settimeout(limit_at - now if wait is None else min(wait, limit_at - now))
                 msg = ws.recv()
-                log_debug(f"Received message: {msg[:100]}..." if len(msg) > 100 else msg)
+                stream_logger.debug("Received message: %.100s", msg)
                 
                 if msg.endswith('"type":"complete"}'):
                     log_debug("Received complete message")
+                    settle(False)
+                    yield from coalescer.flush()
                     break
                 
                 try:
-                    data = json.loads(msg)
-                    if data.get("type") != "next":
+                    conversation = decode_upstream_frame(msg)
+                    if conversation is None:
                         continue
                     
-                    payload_data = data.get("payload", {}).get("data", {})
-                    conversation = payload_data.get("startConversation", {})
-                    
                     delta_token = conversation.get("deltaToken", "")
                     is_finished = conversation.get("isFinished", False)
                     
                     if delta_token:
-                        if is_thinking_model:
-                            # ¼ì²éÊÇ·ñ°üº¬Ë¼¿¼/»Ø´ð·Ö¸ô·û
-                            if thinking_separator in accumulated_thinking + delta_token:
-                                # ÕÒµ½·Ö¸ô·û£¬ÇÐ»»µ½»Ø´ðÄ£Ê½
-                                if not thinking_mode:
-                                    # Èç¹ûÖ®Ç°Ã»ÓÐ·¢ËÍ¹ýË¼¿¼ÄÚÈÝ£¬ÏÈ·¢ËÍÀÛ»ýµÄË¼¿¼ÄÚÈÝ
-                                    parts = (accumulated_thinking + delta_token).split(thinking_separator, 1)
-                                    thinking_content = parts[0]
-                                    answer_content = parts[1] if len(parts) > 1 else ""
-                                    
-                                    if thinking_content:
-                                        yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'reasoning_content': thinking_content})]).json()}\n\n"
-                                    
-                                    if answer_content:
-                                        yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'content': answer_content})]).json()}\n\n"
-                                    
-                                    thinking_mode = True
-                                    accumulated_thinking = ""
-                                else:
-                                    # ÒÑ¾­ÔÚ»Ø´ðÄ£Ê½£¬Ö±½Ó·¢ËÍÄÚÈÝ
-                                    yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'content': delta_token})]).json()}\n\n"
-                            else:
-                                # Ã»ÓÐÕÒµ½·Ö¸ô·û
-                                if thinking_mode:
-                                    # ÒÑ¾­ÔÚ»Ø´ðÄ£Ê½£¬Ö±½Ó·¢ËÍÄÚÈÝ
-                                    yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'content': delta_token})]).json()}\n\n"
-                                else:
-                                    # ¼ÌÐøÀÛ»ýË¼¿¼ÄÚÈÝ
-                                    accumulated_thinking += delta_token
-                        else:
-                            # ·ÇË¼¿¼Ä£ÐÍ£¬Ö±½Ó·¢ËÍÄÚÈÝ
-                            yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'content': delta_token})]).json()}\n\n"
+                        settle(False)
+                        last_token_at = time.monotonic()
+                        received_chars += len(delta_token)
+                        if STREAM_MAX_RESPONSE_CHARS and received_chars > STREAM_MAX_RESPONSE_CHARS:
+                            # 思考内容和非流式回复都在内存中累积，超过上限时结束本流
+                            log_debug("Stream exceeded %d chars, aborting", STREAM_MAX_RESPONSE_CHARS)
+                            yield from coalescer.flush()
+                            yield ("limit", f"Response exceeded the per-stream limit of {STREAM_MAX_RESPONSE_CHARS} characters.")
+                            break
+                        for kind, text in splitter.feed(delta_token):
+                            yield from coalescer.push(kind, text)
                     
                     if is_finished:
-                        # Èç¹û»¹ÓÐÎ´·¢ËÍµÄË¼¿¼ÄÚÈÝ£¬·¢ËÍËü
-                        if is_thinking_model and not thinking_mode and accumulated_thinking:
-                            yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={'reasoning_content': accumulated_thinking})]).json()}\n\n"
+                        settle(False)
+                        # 如果还有未发送的思考内容，发送它
+                        for kind, text in splitter.finish():
+                            yield from coalescer.push(kind, text)
+                        yield from coalescer.flush()
+                        new_state_token = conversation.get("newStateToken")
+                        if new_state_token:
+                            yield ("state", new_state_token)
                         
-                        # ·¢ËÍÍê³ÉÐÅºÅ
+                        # 发送完成信号
                         log_debug("Stream finished")
-                        yield f"data: {StreamResponse(id=stream_id, created=created_time, model=model, choices=[StreamChoice(delta={}, finish_reason='stop')]).json()}\n\n"
-                        yield "data: [DONE]\n\n"
+                        yield ("finish", "stop")
                         break
                         
                 except json.JSONDecodeError as e:
-                    log_debug(f"JSON decode error: {e}")
+                    log_debug("JSON decode error: %s", e)
                     continue
+            
+            except websocket.WebSocketTimeoutException:
+                # 合并窗口到期，发送缓冲内容；阶段超时在下一轮循环开头判断
+                yield from coalescer.flush()
                     
             except websocket.WebSocketConnectionClosedException:
                 log_debug("WebSocket connection closed")
+                if not handle.cancelled:
+                    settle(True)
+                    yield from coalescer.flush()
                 break
                 
+            except DeadlineExceeded:
+                raise
+                
             except Exception as e:
-                log_debug(f"Error processing message: {e}")
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                if handle.cancelled:
+                    break
+                log_debug("Error processing message: %s", e)
+                settle(True)
+                yield from coalescer.flush()
+                yield ("error", str(e))
                 break
     
+    except DeadlineExceeded as e:
+        if not handle.cancelled:
+            log_debug("Stream aborted: %s", e.detail)
+            # 是否计为慢调用由耗时决定，不算作上游错误
+            settle(False)
+            yield from coalescer.flush()
+            yield ("timeout", e.detail)
+    
     except Exception as e:
-        log_debug(f"WebSocket error: {e}")
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        yield "data: [DONE]\n\n"
+        if not handle.cancelled:
+            log_debug("WebSocket error: %s", e)
+            settle(True)
+            yield from coalescer.flush()
+            yield ("error", str(e))
     
     finally:
         if ws:
@@ -572,57 +1218,566 @@ def tenbin_stream_generator(model: str, prompt: str, session_id: str, execution_
                 pass
 
 
-def build_tenbin_non_stream_response(model: str, prompt: str, session_id: str, execution_token: str) -> ChatCompletionResponse:
-    """¹¹½¨·ÇÁ÷Ê½ÏìÓ¦"""
-    full_content = ""
-    full_reasoning_content = None
-    
-    # Ê¹ÓÃÁ÷Ê½Éú³ÉÆ÷£¬µ«ÀÛ»ýËùÓÐÄÚÈÝ
-    for chunk in tenbin_stream_generator(model, prompt, session_id, execution_token):
-        if not chunk.startswith("data: ") or chunk.strip() == "data: [DONE]":
-            continue
-            
-        try:
-            data = json.loads(chunk[6:])  # È¥µô "data: " Ç°×º
-            if "choices" not in data:
-                continue
-                
-            delta = data["choices"][0].get("delta", {})
-            
-            if "content" in delta and delta["content"]:
-                full_content += delta["content"]
-                
-            if "reasoning_content" in delta and delta["reasoning_content"]:
-                if full_reasoning_content is None:
-                    full_reasoning_content = ""
-                full_reasoning_content += delta["reasoning_content"]
-                
-        except json.JSONDecodeError:
-            continue
+# 流中途出错时错误事件里的 code，与同类错误在响应开始前返回的状态码一致
+SEGMENT_ERROR_STATUS = {"error": 502, "timeout": 504, "limit": 502}
+
+
+def encode_segment(stream_id: str, created: int, model: str, kind: str, value: str) -> str:
+    """把一个上游片段编码为 SSE 文本，结束和错误片段后附带 [DONE]"""
+    if kind == "finish":
+        return encode_stream_chunk(stream_id, created, model, {}, finish_reason=value) + "data: [DONE]\n\n"
+    if kind in SEGMENT_ERROR_STATUS:
+        return encode_stream_error(value, SEGMENT_ERROR_STATUS[kind])
+    return encode_stream_chunk(stream_id, created, model, {kind: value})
+
+
+def tenbin_stream_generator(
+    model: str,
+    prompt: str,
+    session_id: str,
+    execution_token: str,
+    **kwargs,
+):
+    """Tenbin WebSocket Á÷Ê½ÏìÓ¦Éú³ÉÆ÷"""
+    stream_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created_time = int(time.time())
     
+    # 发送初始角色增量
+    yield encode_stream_chunk(stream_id, created_time, model, {"role": "assistant"})
+    for kind, value in iter_tenbin_segments(model, prompt, session_id, execution_token, **kwargs):
+        if kind != "state":
+            yield encode_segment(stream_id, created_time, model, kind, value)
+
+
+def aggregate_segments(segments) -> Tuple[str, Optional[str]]:
+    """把上游片段累积为完整的回答和思考内容"""
+    content_parts: List[str] = []
+    reasoning_parts: Optional[List[str]] = None
+    for kind, value in segments:
+        if kind == "content":
+            content_parts.append(value)
+        elif kind == "reasoning_content":
+            if reasoning_parts is None:
+                reasoning_parts = []
+            reasoning_parts.append(value)
+    full_reasoning_content = "".join(reasoning_parts) if reasoning_parts is not None else None
+    return "".join(content_parts), full_reasoning_content
+
+
+def build_completion_response(
+    model: str, content: str, reasoning_content: Optional[str], finish_reason: str = "stop"
+) -> ChatCompletionResponse:
     return ChatCompletionResponse(
         model=model,
         choices=[
             ChatCompletionChoice(
                 message=ChatMessage(
                     role="assistant",
-                    content=full_content,
-                    reasoning_content=full_reasoning_content,
-                )
+                    content=content,
+                    reasoning_content=reasoning_content,
+                ),
+                finish_reason=finish_reason,
             )
         ],
     )
 
 
-async def error_stream_generator(error_detail: str, status_code: int):
-    """Generate error stream response"""
-    yield f'data: {json.dumps({"error": {"message": error_detail, "type": "tenbin_api_error", "code": status_code}})}\n\n'
-    yield "data: [DONE]\n\n"
+def build_tenbin_non_stream_response(
+    model: str,
+    prompt: str,
+    session_id: str,
+    execution_token: str,
+    **kwargs,
+) -> ChatCompletionResponse:
+    """¹¹½¨·ÇÁ÷Ê½ÏìÓ¦"""
+    full_content, full_reasoning_content = aggregate_segments(
+        iter_tenbin_segments(model, prompt, session_id, execution_token, **kwargs)
+    )
+    return build_completion_response(model, full_content, full_reasoning_content)
+
+
+class UpstreamAttempt:
+    """在独立线程中运行一次上游会话，把片段转交给事件循环中的异步队列"""
+
+    def __init__(self, model: str, prompt: str, upstream: UpstreamSession, label: str = "primary", **kwargs):
+        self.model = model
+        self.prompt = prompt
+        self.upstream = upstream
+        self.label = label
+        self.kwargs = kwargs
+        self.handle = UpstreamHandle()
+        self.started_at = 0.0
+        self.first_token_at: Optional[float] = None
+        self.finished = False
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self.ready: Optional[asyncio.Event] = None  # 收到首个增量或会话结束时置位
+        self.deltas = 0
+        self.bytes = 0
+        self.span = self.phase_span = None  # 追踪：整个会话 / 当前阶段（等待首个增量、输出）
+
+    @property
+    def has_token(self) -> bool:
+        return self.first_token_at is not None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self.ready = asyncio.Event()
+        self.started_at = time.monotonic()
+        self.span = start_span("upstream.session", upstream=self.label, model=self.model, prompt_chars=len(self.prompt))
+        self.phase_span = start_span("upstream.first_delta", parent=self.span)
+        threading.Thread(target=self._run, name=f"upstream-{self.label}", daemon=True).start()
+
+    def _run(self):
+        try:
+            # 线程不继承调用方的追踪上下文，连接和订阅的 span 挂在本会话的 span 下
+            with use_span(self.span):
+                for segment in iter_tenbin_segments(
+                    self.model,
+                    self.prompt,
+                    self.upstream["session_id"],
+                    self.upstream["execution_token"],
+                    file_upload_ids=self.upstream["file_upload_ids"],
+                    state_token=self.upstream.get("state_token", ""),
+                    handle=self.handle,
+                    **self.kwargs,
+                ):
+                    self._post(segment)
+        except Exception as e:
+            self._post(("error", str(e)))
+        finally:
+            self._post(None)
 
+    def _post(self, segment):
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, segment)
+        except RuntimeError:
+            # 事件循环已关闭（进程退出中）
+            self.handle.cancel()
+
+    def _deliver(self, segment):
+        if segment is None:
+            self.finished = True
+            self.ready.set()
+            self._end_spans()
+        elif segment[0] in ("content", "reasoning_content"):
+            self.deltas += 1
+            self.bytes += len(segment[1])
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+                ttft_tracker.record(self.model, self.first_token_at - self.started_at)
+                model_router.record_ttft(self.model, self.first_token_at - self.started_at)
+                self.ready.set()
+                self.phase_span.end()
+                self.phase_span = start_span("upstream.streaming", parent=self.span)
+        elif segment[0] == "finish":
+            model_router.record_result(self.model, True)
+            self.span.set_attribute("finish_reason", segment[1])
+        elif segment[0] in ("error", "timeout"):
+            model_router.record_result(self.model, False)
+            self.span.set_error(f"{segment[0]}: {segment[1]}")
+        self._queue.put_nowait(segment)
+
+    def _end_spans(self):
+        self.phase_span.set_attributes({"deltas": self.deltas, "bytes": self.bytes})
+        self.phase_span.end()
+        self.span.set_attributes({"deltas": self.deltas, "bytes": self.bytes, "cancelled": self.handle.cancelled})
+        self.span.end()
+
+    def cancel(self):
+        if not self.finished:
+            self.handle.cancel()
+
+    async def segments(self):
+        while True:
+            segment = await self._queue.get()
+            if segment is None:
+                return
+            yield segment
+
+
+async def first_responder(attempts: List[UpstreamAttempt]) -> UpstreamAttempt:
+    """等待第一个产出增量的会话；全部结束都没有增量时返回第一个（由它输出错误）"""
+    waiters = {asyncio.ensure_future(attempt.ready.wait()): attempt for attempt in attempts}
+    try:
+        while waiters:
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in done:
+                attempt = waiters.pop(waiter)
+                if attempt.has_token:
+                    return attempt
+        return attempts[0]
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+
+
+async def start_completion(
+    request: ChatCompletionRequest,
+    internal_model_id: str,
+    prompt: str,
+    attachments,
+    upstream: UpstreamSession,
+    deadline: Deadline,
+    attempts: List[UpstreamAttempt],
+) -> UpstreamAttempt:
+    """启动上游会话；开启对冲时，首个增量迟迟不到就用另一个账户再发起一次，先出字的胜出
+
+    启动的所有会话都会加入 attempts，调用方负责在结束时取消它们。
+    """
+    stream_kwargs = {"coalesce_ms": request.coalesce_ms, "coalesce_bytes": request.coalesce_bytes, "deadline": deadline}
+    primary = UpstreamAttempt(request.model, prompt, upstream, **stream_kwargs)
+    attempts.append(primary)
+    primary.start()
+
+    use_hedge = HEDGE_ENABLED if request.hedge is None else request.hedge
+    if not use_hedge or request.n > 1:
+        # n 个选项已经各占一个上游会话，不再为每个选项追加对冲请求
+        return primary
+
+    hedge_metrics.incr("requests")
+    hedge_budget.record_request()
+    delay = hedge_delay(request.model)
+    try:
+        await asyncio.wait_for(primary.ready.wait(), delay)
+        return primary
+    except asyncio.TimeoutError:
+        pass
+
+    if not hedge_budget.try_acquire():
+        hedge_metrics.incr("skipped_budget")
+        return primary
+
+    log_debug("No first token after %.2fs, launching hedge request", delay, model=request.model)
+    try:
+        hedge_upstream = await asyncio.to_thread(acquire_upstream_session, internal_model_id, attachments, deadline)
+    except HTTPException:
+        # 没有可用账户或熔断器已打开
+        hedge_upstream = None
+    if hedge_upstream is None:
+        hedge_metrics.incr("skipped_no_account")
+        return primary
+    if primary.has_token:
+        return primary
+
+    hedge = UpstreamAttempt(request.model, prompt, hedge_upstream, label="hedge", **stream_kwargs)
+    attempts.append(hedge)
+    hedge.start()
+    hedge_metrics.incr("fired")
+
+    winner = await first_responder([primary, hedge])
+    for attempt in attempts:
+        if attempt is not winner:
+            attempt.cancel()
+    if winner is hedge:
+        hedge_metrics.incr("won")
+    log_debug("Hedge finished, winner: %s", winner.label, model=request.model)
+    return winner
+
+
+async def launch_completion(
+    request: ChatCompletionRequest,
+    internal_model_id: str,
+    prompt: str,
+    attachments,
+    deadline: Deadline,
+    attempts: List[UpstreamAttempt],
+    client_id: Optional[str] = None,
+) -> UpstreamAttempt:
+    """获取上游会话并启动；历史命中 client_id 已知的会话状态时只发送新的用户消息，状态不可用、被拒绝或迟迟没有回复时发送完整提示"""
+    known = (
+        conversation_cache.lookup(request.model, request.messages, client_id) if uses_conversation_state(request) else None
+    )
+    if known is not None:
+        key, state = known
+        upstream = await asyncio.to_thread(
+            acquire_upstream_session, internal_model_id, attachments, deadline, state.session_id
+        )
+        if upstream is not None:
+            upstream["state_token"] = state.state_token
+            log_debug("Reusing conversation state, sending only the new user turn", model=request.model)
+            attempt = UpstreamAttempt(
+                request.model,
+                build_tenbin_prompt(request.messages[-1:]),
+                upstream,
+                label="stateful",
+                coalesce_ms=request.coalesce_ms,
+                coalesce_bytes=request.coalesce_bytes,
+                deadline=deadline,
+            )
+            attempts.append(attempt)
+            attempt.start()
+            try:
+                # 单独限时，状态令牌在上游失效后卡住时不会耗尽整个请求的预算
+                await asyncio.wait_for(attempt.ready.wait(), CONVERSATION_STATE_FIRST_TOKEN_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            if attempt.has_token:
+                return attempt
+            # 上游拒绝了状态令牌（或会话出错、超时），丢弃该状态并退回完整提示
+            attempt.cancel()
+            log_debug("Conversation state rejected, falling back to the full prompt", model=request.model)
+        conversation_cache.discard(key)
+        conversation_cache.incr("fallbacks")
+
+    upstream = await open_upstream(request.model, internal_model_id, attachments, deadline)
+    return await start_completion(request, internal_model_id, prompt, attachments, upstream, deadline, attempts)
+
+
+async def output_segments(request: ChatCompletionRequest, attempt: UpstreamAttempt):
+    """胜出会话的片段；请求带 max_tokens 或 stop 时在本地执行，触发后立即取消上游订阅"""
+    limiter = OutputLimiter(request.max_tokens, request.stop)
+    if not limiter.enabled:
+        async for segment in attempt.segments():
+            yield segment
+        return
+    async for kind, value in attempt.segments():
+        for segment in limiter.feed(kind, value):
+            yield segment
+        if limiter.finish_reason is not None:
+            log_debug(
+                "Output limit reached (%s), cancelling upstream", limiter.finish_reason,
+                model=request.model, completion_tokens=limiter.completion_tokens,
+            )
+            attempt.cancel()
+            return
+
+
+def uses_conversation_state(request: ChatCompletionRequest) -> bool:
+    if request.n > 1:
+        # 多个选项时无法确定客户端会把哪一个作为下一轮的历史，各选项也不应共用同一个状态令牌
+        return False
+    return CONVERSATION_STATE_ENABLED if request.reuse_state is None else request.reuse_state
+
+
+def conversation_recorder(request: ChatCompletionRequest, client_id: Optional[str] = None) -> Optional[ConversationRecorder]:
+    if not uses_conversation_state(request):
+        return None
+    return conversation_cache.recorder(request.model, request.messages, client_id)
+
+
+async def heartbeats_until(future: asyncio.Future):
+    """在 future 完成前按间隔产出 SSE 注释心跳，防止代理和客户端因长时间无数据而断开"""
+    interval = STREAM_HEARTBEAT_INTERVAL if STREAM_HEARTBEAT_INTERVAL > 0 else None
+    while not future.done():
+        await asyncio.wait({future}, timeout=interval)
+        if not future.done():
+            yield ": keep-alive\n\n"
+
+
+async def stream_completion_events(
+    request: ChatCompletionRequest,
+    internal_model_id: str,
+    prompt: str,
+    attachments,
+    deadline: Deadline,
+    stream_id: Optional[str] = None,
+    client: str = "",
+    client_id: Optional[str] = None,
+):
+    """异步 SSE 生成器：立即发送角色增量，在流内获取上游会话，再转发胜出会话的片段
+
+    n > 1 时并发启动 n 个上游会话，各选项的增量按到达顺序交错输出，用 index 区分。
+    流在整个生命周期内登记在 stream_registry 中，管理员取消时输出错误事件后结束。
+    """
+    stream_id = stream_id or f"chatcmpl-{uuid.uuid4().hex}"
+    created_time = int(time.time())
+    active = stream_registry.add(stream_id, request.model, client)
+    for index in range(request.n):
+        event = encode_stream_chunk(stream_id, created_time, request.model, {"role": "assistant"}, index=index)
+        active.sent(event)
+        yield event
+
+    attempts: List[UpstreamAttempt] = active.attempts
+
+    setup_tasks = [
+        asyncio.ensure_future(
+            launch_completion(request, internal_model_id, prompt, attachments, deadline, attempts, client_id)
+        )
+        for _ in range(request.n)
+    ]
+    setup_task = setup_tasks[0] if request.n == 1 else asyncio.gather(*setup_tasks)
+    active.setup_task = setup_task
+    first_token = None
+    try:
+        async for heartbeat in heartbeats_until(setup_task):
+            yield heartbeat
+        if active.cancelled:
+            yield encode_stream_error("Stream cancelled by administrator.", 503)
+            return
+        try:
+            winner = setup_task.result()
+        except HTTPException as e:
+            yield encode_stream_error(e.detail, e.status_code)
+            return
+        except Exception as e:
+            log_debug("Stream setup failed: %s", e)
+            yield encode_stream_error(str(e), 500)
+            return
+
+        if request.n > 1:
+            active.phase = STREAMING
+            active.upstream = ",".join(attempt.label for attempt in winner)
+            async for event in interleave_choices(request, winner, stream_id, created_time):
+                active.sent(event)
+                yield event
+            if active.cancelled:
+                yield encode_stream_error("Stream cancelled by administrator.", 503)
+            return
+
+        active.phase = WAITING
+        active.upstream = winner.label
+        first_token = asyncio.ensure_future(winner.ready.wait())
+        async for heartbeat in heartbeats_until(first_token):
+            yield heartbeat
+        recorder = conversation_recorder(request, client_id)
+        async for kind, value in output_segments(request, winner):
+            if recorder is not None:
+                recorder.feed(kind, value)
+            if kind == "finish":
+                current_span().add_event("finish", {"finish_reason": value})
+            if kind != "state":
+                if active.first_token_at is None and kind in ("content", "reasoning_content"):
+                    active.first_token_at = time.monotonic()
+                    active.phase = STREAMING
+                event = encode_segment(stream_id, created_time, request.model, kind, value)
+                active.sent(event)
+                yield event
+        if active.cancelled:
+            yield encode_stream_error("Stream cancelled by administrator.", 503)
+        elif recorder is not None:
+            recorder.commit(winner.upstream["session_id"])
+    finally:
+        # 客户端断开、出错或被取消时停止准备工作并关闭所有上游订阅
+        stream_registry.remove(active)
+        current_span().set_attributes(
+            {"sse.events": active.events, "sse.bytes": active.bytes, "cancelled": active.cancelled}
+        )
+        for task in setup_tasks:
+            task.cancel()
+        if first_token is not None:
+            first_token.cancel()
+        for attempt in attempts:
+            attempt.cancel()
+
+
+async def interleave_choices(
+    request: ChatCompletionRequest,
+    winners: List[UpstreamAttempt],
+    stream_id: str,
+    created: int,
+):
+    """把 n 个选项的片段按到达顺序编码为同一个 SSE 流；任一选项出错时输出错误并结束整个流"""
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def pump(index: int, attempt: UpstreamAttempt):
+        try:
+            async for kind, value in output_segments(request, attempt):
+                queue.put_nowait((index, kind, value))
+        finally:
+            queue.put_nowait((index, None, None))
+
+    pumps = [asyncio.ensure_future(pump(index, attempt)) for index, attempt in enumerate(winners)]
+    interval = STREAM_HEARTBEAT_INTERVAL if STREAM_HEARTBEAT_INTERVAL > 0 else None
+    running = len(pumps)
+    try:
+        while running:
+            try:
+                index, kind, value = await asyncio.wait_for(queue.get(), interval)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if kind is None:
+                running -= 1
+            elif kind == "finish":
+                yield encode_stream_chunk(stream_id, created, request.model, {}, finish_reason=value, index=index)
+            elif kind in SEGMENT_ERROR_STATUS:
+                yield encode_segment(stream_id, created, request.model, kind, value)
+                return
+            elif kind != "state":
+                yield encode_stream_chunk(stream_id, created, request.model, {kind: value}, index=index)
+        yield "data: [DONE]\n\n"
+    finally:
+        for task in pumps:
+            task.cancel()
+
+
+# 非流式请求遇到这些片段时不返回部分结果，而是返回对应的错误状态码
+FATAL_SEGMENT_STATUS = {"timeout": 504, "limit": 502}
+
+
+async def collect_choice(
+    request: ChatCompletionRequest,
+    internal_model_id: str,
+    prompt: str,
+    attachments,
+    deadline: Deadline,
+    attempts: List[UpstreamAttempt],
+    client_id: Optional[str] = None,
+) -> Tuple[List[Tuple[str, str]], UpstreamAttempt]:
+    """运行一个选项，返回 (全部片段, 胜出会话)"""
+    winner = await launch_completion(request, internal_model_id, prompt, attachments, deadline, attempts, client_id)
+    return [segment async for segment in output_segments(request, winner)], winner
+
+
+async def complete_non_stream(
+    request: ChatCompletionRequest,
+    internal_model_id: str,
+    prompt: str,
+    attachments,
+    deadline: Deadline,
+    client_id: Optional[str] = None,
+) -> ChatCompletionResponse:
+    """非流式完成：并发运行 n 个选项，分别累积胜出会话的全部片段；client_id 为会话状态所属的客户端"""
+    attempts: List[UpstreamAttempt] = []
+    tasks = [
+        asyncio.ensure_future(
+            collect_choice(request, internal_model_id, prompt, attachments, deadline, attempts, client_id)
+        )
+        for _ in range(request.n)
+    ]
+    try:
+        results = await asyncio.gather(*tasks)
+        recorder = conversation_recorder(request, client_id)
+        if recorder is not None:
+            segments, winner = results[0]
+            for kind, value in segments:
+                recorder.feed(kind, value)
+            recorder.commit(winner.upstream["session_id"])
+    finally:
+        # 某个选项失败时停止其余选项
+        for task in tasks:
+            task.cancel()
+        for attempt in attempts:
+            attempt.cancel()
+    choices = []
+    for index, (segments, _) in enumerate(results):
+        for kind, value in segments:
+            if kind in FATAL_SEGMENT_STATUS:
+                raise HTTPException(status_code=FATAL_SEGMENT_STATUS[kind], detail=value)
+        content, reasoning_content = aggregate_segments(segments)
+        finish_reason = next((value for kind, value in reversed(segments) if kind == "finish"), "stop")
+        current_span().add_event("finish", {"index": index, "finish_reason": finish_reason, "chars": len(content)})
+        choices.append(
+            ChatCompletionChoice(
+                message=ChatMessage(role="assistant", content=content, reasoning_content=reasoning_content),
+                index=index,
+                finish_reason=finish_reason,
+            )
+        )
+    return ChatCompletionResponse(model=request.model, choices=choices)
+
+
+def encode_stream_error(error_detail: str, status_code: int) -> str:
+    """Encode an error event followed by [DONE]"""
+    return (
+        f'data: {json.dumps({"error": {"message": error_detail, "type": "tenbin_api_error", "code": status_code}})}\n\n'
+        "data: [DONE]\n\n"
+    )
 
-if __name__ == "__main__":
-    import uvicorn
 
+if __name__ == "__main__":
     # ÉèÖÃ»·¾³±äÁ¿ÒÔÆôÓÃµ÷ÊÔÄ£Ê½
     if os.environ.get("DEBUG_MODE", "").lower() == "true":
         DEBUG_MODE = True
@@ -657,8 +1812,11 @@ if __name__ == "__main__":
         print("Created dummy models.json.")
 
     load_client_api_keys()
+    load_admin_api_keys()
     load_tenbin_accounts()
     load_tenbin_models()
+    load_model_aliases(TENBIN_MODELS)
+    load_model_capabilities()
 
     print("\n--- Tenbin OpenAI API Adapter ---")
     print(f"Debug Mode: {DEBUG_MODE}")
@@ -666,9 +1824,18 @@ if __name__ == "__main__":
     print("  GET  /v1/models (Client API Key Auth)")
     print("  GET  /models (No Auth)")
     print("  POST /v1/chat/completions (Client API Key Auth)")
-    print("  GET  /debug?enable=[true|false] (Toggle Debug Mode)")
+    print("  POST /v1/files (Client API Key Auth, raw file body)")
+    print("  POST /v1/batches?concurrency=N (Client API Key Auth, JSONL body)")
+    print("  GET  /health (Upstream Circuit Breaker State)")
+    print("  GET  /debug?enable=[true|false] (Toggle Debug Mode, Admin API Key Auth)")
+    print("  GET  /debug?logger=<name>&level=<LEVEL> (Set Logger Level, Admin API Key Auth)")
+    print("  POST /debug/profile/start?mode=[sampling|cprofile]&seconds=N (Admin API Key Auth)")
+    print("  GET  /debug/profile, /debug/loop-lag, /debug/threadpool, /debug/stacks (Admin API Key Auth)")
+    print("  GET  /admin/streams, DELETE /admin/streams/{id} (Admin API Key Auth)")
+    print("  GET  /admin/drain, POST /admin/drain (Admin API Key Auth, SIGTERM also drains)")
 
     print(f"\nClient API Keys: {len(VALID_CLIENT_KEYS)}")
+    print(f"Admin API Keys: {len(VALID_ADMIN_KEYS)}")
     if TENBIN_ACCOUNTS:
         print(f"Tenbin Accounts: {len(TENBIN_ACCOUNTS)}")
     else:
@@ -681,4 +1848,4 @@ if __name__ == "__main__":
         print("Tenbin Models: None loaded. Check models.json.")
     print("------------------------------------")
 
-    uvicorn.run(app, host="0.0.0.0", port=8401)
\ No newline at end of file
+    serve(app, host="0.0.0.0", port=int(os.environ.get("PORT", "8401")))
\ No newline at end of file
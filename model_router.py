@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+按延迟路由的虚拟模型别名
+model_aliases.json 把虚拟模型名（例如 fast-chat）映射到 TENBIN_MODELS 中一组可互换的真实模型。
+每个真实模型维护首字时间（TTFT）和错误率的指数加权移动平均（EWMA），请求别名时选择得分最低的健康模型：
+    得分 = TTFT EWMA × (1 + ROUTER_ERROR_PENALTY × 错误率 EWMA)
+还没有首字样本的模型作为探测优先尝试，但同一时间只放行一个探测请求，探测出结果（或超过
+ROUTER_PROBE_TIMEOUT）之前按最差处理，不会因为迟迟没有样本而一直被选中；另有 ROUTER_EXPLORE_RATE 的概率在整个池中随机选择（包括不健康的模型），
+使落后模型的统计得以更新，不健康的模型恢复后也能重新被选中。
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+ALIASES_FILE = os.environ.get("MODEL_ALIASES_FILE", "model_aliases.json")
+ROUTER_EWMA_ALPHA = float(os.environ.get("ROUTER_EWMA_ALPHA", "0.2"))  # 新样本的权重
+ROUTER_EXPLORE_RATE = float(os.environ.get("ROUTER_EXPLORE_RATE", "0.05"))  # 随机选择的概率
+ROUTER_ERROR_PENALTY = float(os.environ.get("ROUTER_ERROR_PENALTY", "4.0"))
+ROUTER_MAX_ERROR_RATE = float(os.environ.get("ROUTER_MAX_ERROR_RATE", "0.5"))  # 错误率超过该值视为不健康
+ROUTER_PROBE_TIMEOUT = float(os.environ.get("ROUTER_PROBE_TIMEOUT", "60"))  # 探测请求迟迟没有结果时，超过该秒数再放行下一个
+
+MODEL_ALIASES: Dict[str, List[str]] = {}
+
+
+def load_model_aliases(known_models) -> Dict[str, List[str]]:
+    """Load virtual model aliases from model_aliases.json, keeping only models present in known_models"""
+    global MODEL_ALIASES
+    try:
+        with open(ALIASES_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        print(f"{ALIASES_FILE} not found. No virtual model aliases configured.")
+        MODEL_ALIASES = {}
+        return MODEL_ALIASES
+    except Exception as e:
+        print(f"Error loading {ALIASES_FILE}: {e}")
+        MODEL_ALIASES = {}
+        return MODEL_ALIASES
+
+    aliases = {}
+    for alias, models in (data.items() if isinstance(data, dict) else ()):
+        if alias in known_models:
+            print(f"Warning: alias '{alias}' shadows a real model and is ignored.")
+            continue
+        pool = [model for model in models if model in known_models]
+        missing = [model for model in models if model not in known_models]
+        if missing:
+            print(f"Warning: alias '{alias}' refers to unknown models: {', '.join(missing)}")
+        if pool:
+            aliases[alias] = pool
+    MODEL_ALIASES = aliases
+    print(f"Successfully loaded {len(MODEL_ALIASES)} model aliases.")
+    return MODEL_ALIASES
+
+
+class ModelHealth:
+    __slots__ = ("ttft", "error_rate", "samples", "failures", "probe_started")
+
+    def __init__(self):
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.failures = 0
+        self.probe_started = 0.0  # 没有首字样本时正在进行的探测请求的开始时间，0 表示没有
+
+
+class ModelRouter:
+    """按模型记录 TTFT 和错误率的 EWMA，为别名选择当前最快的健康模型"""
+
+    def __init__(
+        self,
+        alpha: float = ROUTER_EWMA_ALPHA,
+        explore_rate: float = ROUTER_EXPLORE_RATE,
+        error_penalty: float = ROUTER_ERROR_PENALTY,
+        max_error_rate: float = ROUTER_MAX_ERROR_RATE,
+        probe_timeout: float = ROUTER_PROBE_TIMEOUT,
+    ):
+        self.alpha = alpha
+        self.explore_rate = explore_rate
+        self.error_penalty = error_penalty
+        self.max_error_rate = max_error_rate
+        self.probe_timeout = probe_timeout
+        self._health: Dict[str, ModelHealth] = {}
+        self._routed: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def _get(self, model: str) -> ModelHealth:
+        health = self._health.get(model)
+        if health is None:
+            health = self._health[model] = ModelHealth()
+        return health
+
+    def record_ttft(self, model: str, ttft: float):
+        with self._lock:
+            health = self._get(model)
+            health.ttft = ttft if health.ttft is None else health.ttft + self.alpha * (ttft - health.ttft)
+            health.probe_started = 0.0
+
+    def record_result(self, model: str, ok: bool):
+        with self._lock:
+            health = self._get(model)
+            health.samples += 1
+            health.probe_started = 0.0
+            if not ok:
+                health.failures += 1
+            health.error_rate += self.alpha * ((0.0 if ok else 1.0) - health.error_rate)
+
+    def score(self, model: str, now: Optional[float] = None) -> float:
+        health = self._health.get(model)
+        if health is None or health.ttft is None:
+            # 没有首字样本的模型作为探测优先尝试；探测还在进行中，或只失败过、从未出字的模型排在最后
+            if health is not None and (health.failures or self._probing(health, now)):
+                return float("inf")
+            return 0.0
+        return health.ttft * (1 + self.error_penalty * health.error_rate)
+
+    def _probing(self, health: ModelHealth, now: Optional[float]) -> bool:
+        if not health.probe_started:
+            return False
+        return (time.monotonic() if now is None else now) - health.probe_started < self.probe_timeout
+
+    def choose(self, alias: str, pool: List[str]) -> str:
+        with self._lock:
+            healthy = [model for model in pool if self._get(model).error_rate <= self.max_error_rate] or pool
+            if len(pool) > 1 and self._random.random() < self.explore_rate:
+                # 不健康的模型只有被选中才会有新样本，探索时不排除它们，否则错误率永远降不下来
+                model = self._random.choice(pool)
+            else:
+                now = time.monotonic()
+                # 得分相同（例如都还没有首字样本）时选失败次数少的：探测中的模型好过只失败过的模型
+                model = min(healthy, key=lambda candidate: (self.score(candidate, now), self._get(candidate).failures))
+            health = self._get(model)
+            if health.ttft is None and not health.probe_started:
+                health.probe_started = time.monotonic()
+            routed = self._routed.setdefault(alias, {})
+            routed[model] = routed.get(model, 0) + 1
+            return model
+
+    def snapshot(self, aliases: Dict[str, List[str]]) -> Dict[str, Dict]:
+        with self._lock:
+            result = {}
+            for alias, pool in aliases.items():
+                routed = self._routed.get(alias, {})
+                models = {}
+                for model in pool:
+                    health = self._health.get(model) or ModelHealth()
+                    models[model] = {
+                        "ttft_ewma": round(health.ttft, 3) if health.ttft is not None else None,
+                        "error_rate": round(health.error_rate, 3),
+                        "samples": health.samples,
+                        "failures": health.failures,
+                        "routed": routed.get(model, 0),
+                    }
+                result[alias] = models
+            return result
+
+
+model_router = ModelRouter()
+
+
+def resolve_model_alias(model: str) -> Optional[str]:
+    """model 是别名时返回本次选中的真实模型，否则返回 None"""
+    pool = MODEL_ALIASES.get(model)
+    if not pool:
+        return None
+    return model_router.choose(model, pool)
+
+
+def alias_names() -> List[str]:
+    return list(MODEL_ALIASES)
+
+
+def router_stats() -> Dict[str, Dict]:
+    return model_router.snapshot(MODEL_ALIASES)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地执行 max_tokens 和 stop
+上游不支持这两个参数，这里在输出阶段逐片段处理：按与 context_window.estimate_tokens 相同的规则累计
+completion token 数（回答和思考内容都计入），并在回答内容中匹配停止序列。停止序列可能跨越片段边界，
+因此片段末尾可能构成某个停止序列前缀的部分先扣留，等下一个片段到来再决定。
+达到限制时截断输出并给出 finish_reason（length / stop），调用方随即取消上游订阅。
+"""
+
+import math
+from typing import Iterator, List, Optional, Tuple, Union
+
+MAX_STOP_SEQUENCES = 4
+END_KINDS = ("finish", "error", "timeout", "limit")  # 之后不会再有内容的片段
+
+Segment = Tuple[str, str]
+
+
+def normalize_stop(stop: Union[str, List[str], None]) -> List[str]:
+    """把请求中的 stop 统一为非空字符串列表"""
+    if stop is None:
+        return []
+    if isinstance(stop, str):
+        stop = [stop]
+    return [sequence for sequence in stop if sequence]
+
+
+def text_units(text: str) -> float:
+    """ASCII 每字符 1/4 个 token，其他字符按 UTF-8 字节数 / 3"""
+    if text.isascii():
+        return len(text) / 4
+    return len(text.encode("utf-8")) / 3
+
+
+class OutputLimiter:
+    """对上游片段序列执行 max_tokens 和 stop，只在一个流内使用"""
+
+    def __init__(self, max_tokens: Optional[int] = None, stop: Union[str, List[str], None] = None):
+        self.max_units = float(max_tokens) if max_tokens else None
+        self.stop = normalize_stop(stop)
+        self.units = 0.0
+        self.held = ""  # 可能是停止序列开头的回答内容，尚未输出
+        self.finish_reason: Optional[str] = None  # 本地限制触发时为 "length" 或 "stop"
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_units is not None or bool(self.stop)
+
+    @property
+    def completion_tokens(self) -> int:
+        return math.ceil(self.units)
+
+    def feed(self, kind: str, value: str) -> Iterator[Segment]:
+        """处理一个上游片段，产出应输出的片段；本地限制触发后产出 finish 片段，之后的输入全部丢弃"""
+        if self.finish_reason is not None:
+            return
+        if kind == "content":
+            yield from self._content(value)
+        elif kind == "reasoning_content":
+            text, exhausted = self._take(value)
+            if text:
+                yield kind, text
+            if exhausted:
+                yield from self._finish("length")
+        else:
+            if kind in END_KINDS and self.held:
+                # 上游结束（正常或出错），扣留的部分不再可能组成停止序列，先输出再传递结束片段
+                text, exhausted = self._take(self.held)
+                self.held = ""
+                if text:
+                    yield "content", text
+                if exhausted:
+                    yield from self._finish("length")
+                    return
+            yield kind, value
+
+    def _content(self, value: str) -> Iterator[Segment]:
+        text = self.held + value
+        self.held = ""
+        reason = None
+        if self.stop:
+            cut = min((index for index in (text.find(sequence) for sequence in self.stop) if index >= 0), default=-1)
+            if cut >= 0:
+                text, reason = text[:cut], "stop"
+            else:
+                keep = self._partial_stop(text)
+                if keep:
+                    text, self.held = text[:-keep], text[-keep:]
+        text, exhausted = self._take(text)
+        if exhausted:
+            reason = "length"
+        if text:
+            yield "content", text
+        if reason is not None:
+            yield from self._finish(reason)
+
+    def _partial_stop(self, text: str) -> int:
+        """text 末尾能作为某个停止序列开头的最长长度"""
+        longest = 0
+        for sequence in self.stop:
+            for size in range(min(len(sequence) - 1, len(text)), longest, -1):
+                if sequence.startswith(text[-size:]):
+                    longest = size
+                    break
+        return longest
+
+    def _take(self, text: str) -> Tuple[str, bool]:
+        """计入 token 预算，返回预算内的部分以及预算是否已用完"""
+        if self.max_units is None or not text:
+            return text, False
+        units = text_units(text)
+        if self.units + units < self.max_units:
+            self.units += units
+            return text, False
+        # 本片段越过预算，逐字符找到截断位置（每个流最多发生一次）
+        for index, char in enumerate(text):
+            char_units = 0.25 if char.isascii() else len(char.encode("utf-8")) / 3
+            if self.units + char_units > self.max_units:
+                return text[:index], True
+            self.units += char_units
+        return text, True
+
+    def _finish(self, reason: str) -> Iterator[Segment]:
+        self.held = ""
+        self.finish_reason = reason
+        yield "finish", reason
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天请求的快速解析
+/v1/chat/completions 不再让 FastAPI 先 json.loads 成字典、再由 pydantic 逐条校验成 ChatMessage，而是：
+- 先按 Content-Length 和实际读取的字节数检查 MAX_REQUEST_BODY_BYTES，超过时在缓冲整个请求体之前返回 413
+- 安装了 msgspec 时用它一次遍历请求体完成解码和校验，消息直接解码成只读的轻量结构体
+  （字段与 ChatMessage 相同），不再构造 pydantic 对象；长对话的解析开销约为 pydantic 的十分之一
+- 否则用 pydantic 的 model_validate_json 直接校验原始字节，不生成中间字典
+
+校验失败与 FastAPI 默认行为一致，返回 422。
+"""
+
+import os
+from typing import Any, Dict, List, Optional, Union
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+try:
+    import msgspec
+except ImportError:  # 可选依赖，缺少时使用 pydantic
+    msgspec = None
+
+MAX_REQUEST_BODY_BYTES = int(os.environ.get("MAX_REQUEST_BODY_BYTES", str(32 * 1024 * 1024)))
+INGEST_MSGSPEC = os.environ.get("INGEST_MSGSPEC", "true").lower() == "true"  # 安装了 msgspec 时是否使用
+
+
+async def read_body(request: Request, max_bytes: int = MAX_REQUEST_BODY_BYTES) -> bytes:
+    """读取请求体，超过上限时立即返回 413，不继续缓冲"""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes} bytes.")
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Request body exceeds {max_bytes} bytes.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def body_error(kind: str, message: str) -> RequestValidationError:
+    return RequestValidationError([{"type": kind, "loc": ("body",), "msg": message, "input": None}])
+
+
+class ChatRequestDecoder:
+    """把请求体解码为 request_model 实例
+
+    msgspec 路径按 request_model 的字段和默认值生成对应的结构体，解码后用 model_construct
+    包装成 request_model（不再次校验），其中 messages 是带 role / content / reasoning_content 的结构体。
+    """
+
+    def __init__(self, request_model, use_msgspec: bool = INGEST_MSGSPEC):
+        self.request_model = request_model
+        self._decoder = self._build_msgspec_decoder() if use_msgspec and msgspec is not None else None
+
+    @property
+    def backend(self) -> str:
+        return "msgspec" if self._decoder is not None else "pydantic"
+
+    def _build_msgspec_decoder(self):
+        message_struct = msgspec.defstruct(
+            "ChatMessageStruct",
+            [
+                ("role", str),
+                ("content", Union[str, List[Dict[str, Any]]]),
+                ("reasoning_content", Optional[str], None),
+            ],
+            frozen=True,
+        )
+        fields = []
+        for name, field in self.request_model.model_fields.items():
+            annotation = List[message_struct] if name == "messages" else field.annotation
+            fields.append((name, annotation) if field.is_required() else (name, annotation, field.default))
+        request_struct = msgspec.defstruct("ChatRequestStruct", fields, kw_only=True)
+        # strict=False 与 pydantic 的宽松模式一致，例如接受 "1" 作为整数
+        return msgspec.json.Decoder(request_struct, strict=False)
+
+    def decode(self, body: bytes):
+        if self._decoder is None:
+            try:
+                return self.request_model.model_validate_json(body)
+            except ValidationError as e:
+                raise RequestValidationError(
+                    [{**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)]
+                )
+        try:
+            decoded = self._decoder.decode(body)
+        except msgspec.ValidationError as e:
+            raise body_error("value_error", str(e))
+        except msgspec.DecodeError as e:
+            raise body_error("json_invalid", str(e))
+        return self.request_model.model_construct(
+            **{name: getattr(decoded, name) for name in self.request_model.model_fields}
+        )
+
+    async def read(self, request: Request, max_bytes: int = MAX_REQUEST_BODY_BYTES):
+        return self.decode(await read_body(request, max_bytes))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+活动流登记表
+每个流式请求在开始时登记、结束时注销（按流 ID 存入字典，增删都是 O(1)），
+记录模型、客户端、所处阶段、已输出的事件数和字节数，供容量问题排查时查看。
+管理员可以按 ID 取消一个流：停止准备工作、关闭上游订阅，并向客户端发送错误事件后结束。
+"""
+
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from fastapi import APIRouter, HTTPException
+
+SETUP = "setup"  # 获取执行令牌、建立上游会话
+WAITING = "waiting"  # 已订阅，等待首个增量
+STREAMING = "streaming"
+
+
+class ActiveStream:
+    """一个进行中的流，只在事件循环线程中修改"""
+
+    __slots__ = (
+        "stream_id", "model", "client", "created", "started_at", "first_token_at",
+        "phase", "events", "bytes", "upstream", "cancelled", "attempts", "setup_task",
+    )
+
+    def __init__(self, stream_id: str, model: str, client: str):
+        self.stream_id = stream_id
+        self.model = model
+        self.client = client
+        self.created = int(time.time())
+        self.started_at = time.monotonic()
+        self.first_token_at: Optional[float] = None
+        self.phase = SETUP
+        self.events = 0
+        self.bytes = 0
+        self.upstream: Optional[str] = None  # 胜出的上游会话（primary / hedge / stateful）
+        self.cancelled = False
+        self.attempts: List = []  # 该流启动的所有 UpstreamAttempt
+        self.setup_task: Optional[asyncio.Future] = None
+
+    def sent(self, text: str):
+        self.events += 1
+        self.bytes += len(text)
+
+    def cancel(self):
+        """停止准备工作并关闭所有上游订阅；生成器随后输出错误事件并结束"""
+        self.cancelled = True
+        if self.setup_task is not None:
+            self.setup_task.cancel()
+        for attempt in self.attempts:
+            attempt.cancel()
+
+    def snapshot(self, now: float) -> Dict:
+        return {
+            "id": self.stream_id,
+            "model": self.model,
+            "client": self.client,
+            "created": self.created,
+            "age": round(now - self.started_at, 2),
+            "phase": self.phase,
+            "upstream": self.upstream,
+            "upstream_attempts": len(self.attempts),
+            "ttft": round(self.first_token_at - self.started_at, 3) if self.first_token_at else None,
+            "events": self.events,
+            "bytes": self.bytes,
+            "cancelled": self.cancelled,
+        }
+
+
+class StreamRegistry:
+    """流 ID -> ActiveStream"""
+
+    def __init__(self):
+        self.streams: Dict[str, ActiveStream] = {}
+        self.counters = {"started": 0, "finished": 0, "cancelled": 0}
+
+    def add(self, stream_id: str, model: str, client: str) -> ActiveStream:
+        stream = ActiveStream(stream_id, model, client)
+        self.streams[stream_id] = stream
+        self.counters["started"] += 1
+        return stream
+
+    def remove(self, stream: ActiveStream):
+        if self.streams.pop(stream.stream_id, None) is not None:
+            self.counters["finished"] += 1
+
+    def get(self, stream_id: str) -> Optional[ActiveStream]:
+        return self.streams.get(stream_id)
+
+    def cancel(self, stream_id: str) -> Optional[ActiveStream]:
+        stream = self.streams.get(stream_id)
+        if stream is not None and not stream.cancelled:
+            stream.cancel()
+            self.counters["cancelled"] += 1
+        return stream
+
+    def list(self, model: Optional[str] = None, client: Optional[str] = None) -> List[Dict]:
+        now = time.monotonic()
+        return [
+            stream.snapshot(now)
+            for stream in self.streams.values()
+            if (model is None or stream.model == model) and (client is None or stream.client == client)
+        ]
+
+    def stats(self) -> Dict:
+        phases = {SETUP: 0, WAITING: 0, STREAMING: 0}
+        for stream in self.streams.values():
+            phases[stream.phase] += 1
+        return {"active": len(self.streams), **phases, **self.counters}
+
+
+stream_registry = StreamRegistry()
+
+
+# 创建路由器
+streams_router = APIRouter(prefix="/admin/streams", tags=["admin"])
+
+
+@streams_router.get("")
+async def list_streams(model: Optional[str] = None, client: Optional[str] = None, limit: int = 100):
+    """列出活动流，最老的在前"""
+    streams = sorted(stream_registry.list(model, client), key=lambda s: s["age"], reverse=True)
+    return {"object": "list", "stats": stream_registry.stats(), "data": streams[:max(limit, 0)]}
+
+
+@streams_router.get("/{stream_id}")
+async def get_stream(stream_id: str):
+    stream = stream_registry.get(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or already finished.")
+    return stream.snapshot(time.monotonic())
+
+
+@streams_router.delete("/{stream_id}")
+async def cancel_stream(stream_id: str):
+    """取消一个流并关闭其上游订阅"""
+    stream = stream_registry.cancel(stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or already finished.")
+    return stream.snapshot(time.monotonic())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+可续传的 SSE 流（默认关闭，SSE_RESUME_ENABLED=true 开启）
+上游会话在后台任务中运行，产出的每个 SSE 事件带上 "id: <流 ID>:<序号>" 写入该流的回放缓冲，
+客户端连接只是缓冲的一个读者。断线后带 Last-Event-ID 重连即可从断点继续读取，上游不受影响。
+开启后客户端断开不会立即取消上游，而是在没有读者 SSE_REPLAY_DETACH_TIMEOUT 秒后才取消。
+
+每个缓冲有事件数和字节数上限，超出时丢弃最早的、所有已连接读者都读过的事件；
+已连接读者还没读到的事件不丢，读者跟不上时暂停读取上游，和不走缓冲时由 TCP 背压的效果一样。
+所有缓冲（进行中和已结束）的总字节数不超过 SSE_REPLAY_TOTAL_BYTES：超出时先丢弃最早结束的缓冲，
+再丢弃进行中缓冲里已读过的事件，仍然超出时有读者落后的流暂停读取上游。结束的缓冲保留 SSE_REPLAY_TTL 秒。
+缓冲记录发起请求的客户端，其他客户端用同一个流 ID 重连时按流不存在处理（404）。
+"""
+
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from fastapi import APIRouter, Header, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+
+SSE_RESUME_ENABLED = os.environ.get("SSE_RESUME_ENABLED", "false").lower() == "true"
+SSE_REPLAY_MAX_EVENTS = int(os.environ.get("SSE_REPLAY_MAX_EVENTS", "4096"))  # 每个流最多保留的事件数
+SSE_REPLAY_MAX_BYTES = int(os.environ.get("SSE_REPLAY_MAX_BYTES", str(1024 * 1024)))  # 每个流最多保留的字节数
+SSE_REPLAY_TOTAL_BYTES = int(os.environ.get("SSE_REPLAY_TOTAL_BYTES", str(64 * 1024 * 1024)))  # 所有缓冲的总字节数上限
+SSE_REPLAY_TTL = float(os.environ.get("SSE_REPLAY_TTL", "300"))  # 秒，结束后保留多久
+SSE_REPLAY_DETACH_TIMEOUT = float(os.environ.get("SSE_REPLAY_DETACH_TIMEOUT", "60"))  # 秒，无读者多久后取消上游
+
+HEARTBEAT_EVENT = ": keep-alive\n\n"
+
+
+def error_event(message: str, code: int) -> str:
+    return (
+        f'data: {json.dumps({"error": {"message": message, "type": "tenbin_api_error", "code": code}})}\n\n'
+        "data: [DONE]\n\n"
+    )
+
+
+def parse_event_id(event_id: str) -> Tuple[str, int]:
+    """把 "<流 ID>:<序号>" 拆成 (流 ID, 序号)"""
+    stream_id, _, seq = (event_id or "").strip().rpartition(":")
+    if not stream_id or not seq.isdigit():
+        raise HTTPException(status_code=400, detail="Last-Event-ID must look like '<stream id>:<sequence>'.")
+    return stream_id, int(seq)
+
+
+class ReplayBuffer:
+    """一个流的回放缓冲，只在事件循环线程中访问"""
+
+    def __init__(
+        self,
+        stream_id: str,
+        max_events: int = SSE_REPLAY_MAX_EVENTS,
+        max_bytes: int = SSE_REPLAY_MAX_BYTES,
+        registry: Optional["ReplayRegistry"] = None,
+        owner: Optional[str] = None,
+    ):
+        self.stream_id = stream_id
+        self.owner = owner  # 发起请求的客户端，只有它可以重连
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.events: Deque[Tuple[int, str]] = deque()
+        self.bytes = 0
+        self.last_seq = 0
+        self.finished = False
+        self.finished_at = 0.0
+        self.positions: Dict[int, int] = {}  # 已连接读者 → 已读到的序号
+        self.detached_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.registry = registry  # 计入总字节数的注册表，缓冲被丢弃后置为 None
+        self._changed = asyncio.Event()
+        self._progress = asyncio.Event()
+
+    @property
+    def readers(self) -> int:
+        return len(self.positions)
+
+    def _resize(self, delta: int):
+        self.bytes += delta
+        if self.registry is not None:
+            self.registry.bytes += delta
+
+    def append(self, text: str):
+        """写入生成器产出的文本，按空行拆成事件并编号；注释（心跳）不写入"""
+        for event in text.split("\n\n"):
+            if not event or event.startswith(":"):
+                continue
+            self.last_seq += 1
+            framed = f"id: {self.stream_id}:{self.last_seq}\n{event}\n\n"
+            self.events.append((self.last_seq, framed))
+            self._resize(len(framed))
+        self.trim()
+        self._notify()
+
+    def unread_seq(self) -> int:
+        """已连接读者还没读到的最早序号；没有读者时为 last_seq + 1"""
+        return min(self.positions.values(), default=self.last_seq) + 1
+
+    def trim(self, max_bytes: Optional[int] = None):
+        """丢弃超出上限的最早事件，已连接读者还没读到的事件保留"""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        keep_from = self.unread_seq()
+        while self.events and self.events[0][0] < keep_from and (
+            len(self.events) > self.max_events or self.bytes > max_bytes
+        ):
+            _, dropped = self.events.popleft()
+            self._resize(-len(dropped))
+
+    def over_limit(self) -> bool:
+        return len(self.events) > self.max_events or self.bytes > self.max_bytes
+
+    def advance(self, reader: int, seq: int):
+        """记录读者的进度，唤醒等待读者的上游"""
+        self.positions[reader] = seq
+        self._progress.set()
+
+    def finish(self):
+        self.finished = True
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def events_after(self, seq: int):
+        """返回序号大于 seq 的事件；所需事件已被挤出缓冲时返回 None"""
+        if seq >= self.last_seq:
+            return []
+        first_seq = self.events[0][0] if self.events else self.last_seq + 1
+        if seq + 1 < first_seq:
+            return None
+        # 读者通常只落后几个事件，从尾部往前找
+        new_events = []
+        for item in reversed(self.events):
+            if item[0] <= seq:
+                break
+            new_events.append(item)
+        new_events.reverse()
+        return new_events
+
+    async def wait(self, timeout: Optional[float]) -> bool:
+        """等待新事件或结束，超时返回 False"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_for_readers(self):
+        """缓冲超出上限时等待落后的读者读走事件，读者全部断开后不再等待"""
+        while True:
+            self.trim()
+            over_total = self.registry is not None and self.registry.over_budget()
+            if over_total:
+                self.registry.prune()
+                self.trim(0)
+                over_total = self.registry.over_budget()
+            lagging = self.unread_seq() <= self.last_seq
+            if not lagging or not (self.over_limit() or over_total):
+                return
+            self._progress.clear()
+            await self._progress.wait()
+
+
+class ReplayRegistry:
+    """活动和最近结束的流的回放缓冲"""
+
+    def __init__(self, total_bytes: int = SSE_REPLAY_TOTAL_BYTES, ttl: float = SSE_REPLAY_TTL):
+        self.total_bytes = total_bytes
+        self.ttl = ttl
+        self.active: Dict[str, ReplayBuffer] = {}
+        self.finished: "OrderedDict[str, ReplayBuffer]" = OrderedDict()  # 按结束时间排序
+        self.bytes = 0  # 所有仍在注册表中的缓冲的总字节数
+        self.heartbeat: Optional[float] = None  # 读者空闲时的心跳间隔，秒，由 main.py 设置
+
+    def over_budget(self) -> bool:
+        return self.bytes > self.total_bytes
+
+    def get(self, stream_id: str) -> Optional[ReplayBuffer]:
+        self.prune()
+        return self.active.get(stream_id) or self.finished.get(stream_id)
+
+    def start(self, stream_id: str, events: AsyncIterator[str], owner: Optional[str] = None) -> ReplayBuffer:
+        """在后台任务中运行事件生成器，把输出写入新的回放缓冲；owner 为发起请求的客户端"""
+        self.prune()
+        buffer = ReplayBuffer(stream_id, SSE_REPLAY_MAX_EVENTS, SSE_REPLAY_MAX_BYTES, registry=self, owner=owner)
+        self.active[stream_id] = buffer
+
+        async def produce():
+            try:
+                async for text in events:
+                    buffer.append(text)
+                    await buffer.wait_for_readers()
+            except Exception as e:
+                buffer.append(error_event(str(e), 500))
+            finally:
+                buffer.finish()
+                self._retire(buffer)
+
+        buffer.task = asyncio.ensure_future(produce())
+        return buffer
+
+    def _retire(self, buffer: ReplayBuffer):
+        self.active.pop(buffer.stream_id, None)
+        if buffer.registry is self:
+            self.finished[buffer.stream_id] = buffer
+        self.prune()
+
+    def prune(self):
+        """丢弃过期的结束缓冲，总字节数超出上限时从最早结束的开始丢弃"""
+        now = time.monotonic()
+        while self.finished:
+            stream_id, buffer = next(iter(self.finished.items()))
+            if now - buffer.finished_at < self.ttl and not self.over_budget():
+                break
+            del self.finished[stream_id]
+            # 仍在读的连接继续持有缓冲，但它不再计入总字节数
+            self.bytes -= buffer.bytes
+            buffer.registry = None
+
+    def _detach(self, buffer: ReplayBuffer, reader: int):
+        buffer.positions.pop(reader, None)
+        buffer._progress.set()
+        if buffer.readers == 0 and not buffer.finished:
+            buffer.detached_at = time.monotonic()
+            asyncio.get_running_loop().call_later(SSE_REPLAY_DETACH_TIMEOUT, self._cancel_if_abandoned, buffer)
+
+    def _cancel_if_abandoned(self, buffer: ReplayBuffer):
+        if buffer.finished or buffer.readers or buffer.detached_at is None:
+            return
+        if time.monotonic() - buffer.detached_at >= SSE_REPLAY_DETACH_TIMEOUT:
+            buffer.task.cancel()
+
+    async def read(self, buffer: ReplayBuffer, after_seq: int = 0):
+        """从 after_seq 之后开始读取缓冲，直到流结束；空闲时按心跳间隔发送 SSE 注释"""
+        reader = object()
+        reader_id = id(reader)
+        buffer.positions[reader_id] = after_seq
+        buffer.detached_at = None
+        try:
+            seq = after_seq
+            while True:
+                events = buffer.events_after(seq)
+                if events is None:
+                    yield error_event("Resume position is no longer buffered.", 410)
+                    return
+                for seq, framed in events:
+                    yield framed
+                    buffer.advance(reader_id, seq)
+                if buffer.finished and seq >= buffer.last_seq:
+                    return
+                if not await buffer.wait(self.heartbeat if self.heartbeat and self.heartbeat > 0 else None):
+                    yield HEARTBEAT_EVENT
+        finally:
+            self._detach(buffer, reader_id)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active_streams": len(self.active),
+            "active_bytes": sum(buffer.bytes for buffer in self.active.values()),
+            "finished_streams": len(self.finished),
+            "finished_bytes": sum(buffer.bytes for buffer in self.finished.values()),
+            "total_bytes": self.bytes,
+        }
+
+
+replay_registry = ReplayRegistry()
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
+
+
+def resume_response(last_event_id: str, owner: Optional[str] = None) -> StreamingResponse:
+    """按 Last-Event-ID 从回放缓冲继续输出，只有发起请求的客户端 owner 可以重连"""
+    stream_id, seq = parse_event_id(last_event_id)
+    buffer = replay_registry.get(stream_id)
+    if buffer is None or buffer.owner != owner:
+        raise HTTPException(status_code=404, detail=f"Stream '{stream_id}' not found or expired.")
+    return StreamingResponse(
+        replay_registry.read(buffer, seq),
+        media_type="text/event-stream",
+        headers={**SSE_HEADERS, "X-Stream-Id": stream_id},
+    )
+
+
+# 创建路由器
+stream_replay_router = APIRouter(prefix="/v1/chat/completions", tags=["chat"])
+
+
+@stream_replay_router.get("/{stream_id}/events")
+async def resume_stream(
+    stream_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Header(None),
+    after: int = Query(0, ge=0),
+):
+    """重新连接一个流：优先使用 Last-Event-ID 请求头，否则从 after 指定的序号之后开始（EventSource 首次连接）"""
+    return resume_response(last_event_id or f"{stream_id}:{after}", getattr(request.state, "client_id", None))
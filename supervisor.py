@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+不中断服务的进程管理器
+以 SERVER_REUSEPORT=true 启动 main.py，多个进程可以同时监听同一端口：
+- SIGHUP：启动新进程，等它完成启动后再向旧进程发送 SIGTERM；旧进程关闭监听套接字、
+  把已有的流输出完后退出（见 graceful_drain.py），期间新连接全部由新进程处理
+- SIGTERM / SIGINT：转发 SIGTERM 给所有子进程并等待它们排空退出；再收到一次则子进程立即退出
+- 子进程意外退出时自动重启
+
+用法：python3 supervisor.py，之后用 kill -HUP <pid> 平滑重启（例如更新了代码或 models.json）。
+"""
+
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+from graceful_drain import READY_FD_ENV
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+SUPERVISOR_READY_TIMEOUT = float(os.environ.get("SUPERVISOR_READY_TIMEOUT", "120"))
+SUPERVISOR_RESTART_DELAY = float(os.environ.get("SUPERVISOR_RESTART_DELAY", "2"))
+
+
+class Supervisor:
+    def __init__(self, command: List[str]):
+        self.command = command
+        self.current: Optional[subprocess.Popen] = None
+        self.retiring: List[subprocess.Popen] = []  # 已发送 SIGTERM、正在排空的旧进程
+        self.reload_requested = False
+        self.stop_signals = 0
+        self.forwarded = 0
+
+    def log(self, message: str):
+        print(f"[supervisor {os.getpid()}] {message}", flush=True)
+
+    def spawn(self) -> Optional[subprocess.Popen]:
+        """启动一个子进程并等待其就绪，失败时返回 None"""
+        read_fd, write_fd = os.pipe()
+        env = dict(os.environ, SERVER_REUSEPORT="true", **{READY_FD_ENV: str(write_fd)})
+        proc = subprocess.Popen(self.command, env=env, pass_fds=(write_fd,))
+        os.close(write_fd)
+        self.log(f"started worker {proc.pid}")
+        try:
+            if self.wait_ready(proc, read_fd):
+                self.log(f"worker {proc.pid} is ready")
+                return proc
+        finally:
+            os.close(read_fd)
+        self.log(f"worker {proc.pid} failed to become ready")
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        return None
+
+    def wait_ready(self, proc: subprocess.Popen, read_fd: int) -> bool:
+        deadline = time.monotonic() + SUPERVISOR_READY_TIMEOUT
+        while time.monotonic() < deadline and not self.stop_signals:
+            readable, _, _ = select.select([read_fd], [], [], 0.5)
+            if readable:
+                # 读到 EOF 说明子进程未通知就退出了
+                return bool(os.read(read_fd, 64))
+            if proc.poll() is not None:
+                return False
+        return False
+
+    def reload(self):
+        new = self.spawn()
+        if new is None:
+            self.log("reload aborted, keeping the current worker")
+            return
+        old, self.current = self.current, new
+        if old is not None and old.poll() is None:
+            self.log(f"draining worker {old.pid}")
+            old.send_signal(signal.SIGTERM)
+            self.retiring.append(old)
+
+    def forward_stop(self):
+        for proc in [self.current, *self.retiring]:
+            if proc is not None and proc.poll() is None:
+                proc.send_signal(signal.SIGTERM)
+
+    def run(self) -> int:
+        def on_reload(sig, frame):
+            self.reload_requested = True
+
+        def on_stop(sig, frame):
+            self.stop_signals += 1
+
+        signal.signal(signal.SIGHUP, on_reload)
+        signal.signal(signal.SIGTERM, on_stop)
+        signal.signal(signal.SIGINT, on_stop)
+
+        self.current = self.spawn()
+        if self.current is None and not self.stop_signals:
+            return 1
+        while True:
+            for proc in self.retiring:
+                if proc.poll() is not None:
+                    self.log(f"worker {proc.pid} exited with {proc.returncode}")
+            self.retiring = [proc for proc in self.retiring if proc.returncode is None]
+
+            if self.stop_signals:
+                if self.forwarded < self.stop_signals:
+                    # 第一次转发开始排空，之后每次转发都让子进程立即退出
+                    self.log("stopping workers")
+                    self.forward_stop()
+                    self.forwarded = self.stop_signals
+                alive = [proc for proc in [self.current, *self.retiring] if proc is not None and proc.poll() is None]
+                if not alive:
+                    self.log("all workers exited")
+                    return 0
+            elif self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            elif self.current is None or self.current.poll() is not None:
+                if self.current is not None:
+                    self.log(f"worker {self.current.pid} exited unexpectedly with {self.current.returncode}")
+                time.sleep(SUPERVISOR_RESTART_DELAY)
+                if not self.stop_signals:
+                    self.current = self.spawn()
+            time.sleep(0.2)
+
+
+if __name__ == "__main__":
+    sys.exit(Supervisor([sys.executable, MAIN_SCRIPT, *sys.argv[1:]]).run())
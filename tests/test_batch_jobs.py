@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""批次按创建它的客户端隔离，同一批次同一时间只在一个进程中执行"""
+
+import asyncio
+import os
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+import batch_jobs
+import main
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, "BATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(batch_jobs, "_batches", {})
+    monkeypatch.setattr(batch_jobs, "_tasks", {})
+    monkeypatch.setattr(main, "VALID_CLIENT_KEYS", {"key-a", "key-b"})
+
+    async def runner(body, owner):
+        return {"echo": body}
+
+    monkeypatch.setattr(batch_jobs, "_runner", runner)
+    app = FastAPI()
+    app.include_router(batch_jobs.batch_router, dependencies=[Depends(main.authenticate_client)])
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def auth(key):
+    return {"Authorization": f"Bearer {key}"}
+
+
+def test_batches_are_only_visible_to_their_owner(client, tmp_path):
+    response = client.post("/v1/batches", content=b'{"model": "m"}\n', headers=auth("key-a"))
+    assert response.status_code == 200
+    batch = response.json()
+    assert "owner" not in batch
+    batch_id = batch["id"]
+
+    assert [item["id"] for item in client.get("/v1/batches", headers=auth("key-a")).json()["data"]] == [batch_id]
+    assert client.get("/v1/batches", headers=auth("key-b")).json()["data"] == []
+
+    for method, path in [
+        ("get", f"/v1/batches/{batch_id}"),
+        ("get", f"/v1/batches/{batch_id}/output"),
+        ("post", f"/v1/batches/{batch_id}/cancel"),
+        ("post", f"/v1/batches/{batch_id}/resume"),
+    ]:
+        assert getattr(client, method)(path, headers=auth("key-b")).status_code == 404
+    assert client.get(f"/v1/batches/{batch_id}", headers=auth("key-a")).status_code == 200
+
+    # 磁盘上只保存 Key 的哈希
+    assert "key-a" not in (tmp_path / f"{batch_id}.json").read_text(encoding="utf-8")
+
+
+def test_batch_waits_for_the_lock_held_by_another_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_jobs, "BATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(batch_jobs, "BATCH_LOCK_RETRY_INTERVAL", 0.01)
+    monkeypatch.setattr(batch_jobs, "_tasks", {})
+
+    async def runner(body, owner):
+        return {"echo": body}
+
+    monkeypatch.setattr(batch_jobs, "_runner", runner)
+    batch_id = "batch_locked"
+    (tmp_path / f"{batch_id}.input.jsonl").write_text('{"model": "m"}\n{"model": "m"}\n', encoding="utf-8")
+    batch = {
+        "id": batch_id, "status": "in_progress", "concurrency": 2, "in_progress_at": None, "completed_at": None,
+        "request_counts": {"total": 2, "completed": 0, "failed": 0}, "errors": None, "owner": None,
+    }
+    monkeypatch.setattr(batch_jobs, "_batches", {batch_id: batch})
+    # 模拟平滑重启时仍在执行该批次的旧进程
+    held = batch_jobs._try_lock(batch_id)
+    assert held is not None
+
+    async def scenario():
+        batch_jobs._start(batch_id)
+        await asyncio.sleep(0.1)
+        assert not (tmp_path / f"{batch_id}.output.jsonl").exists()
+        assert batch_jobs._try_lock(batch_id) is None
+        os.close(held)
+        await asyncio.wait_for(batch_jobs._tasks[batch_id], 5)
+
+    asyncio.run(scenario())
+    assert batch["status"] == "completed"
+    assert batch["request_counts"]["completed"] == 2
+    assert batch_id not in batch_jobs._tasks
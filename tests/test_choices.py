@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""n > 1：各选项的增量按 index 交错输出、只有一个 [DONE]，每个选项有自己的 finish_reason，stop/max_tokens 按选项执行"""
+
+import asyncio
+import json
+
+import pytest
+
+import main
+from deadline import Deadline
+
+
+class ScriptedAttempt:
+    """按脚本产出片段的上游会话替身，片段之间让出事件循环，使各选项交错"""
+
+    def __init__(self, index, script):
+        self.label = f"choice-{index}"
+        self.upstream = {"session_id": f"session-{index}"}
+        self.script = script
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    async def segments(self):
+        for segment in self.script:
+            if self.cancelled:
+                return
+            if segment[0] == "sleep":
+                await asyncio.sleep(segment[1])
+                continue
+            yield segment
+            await asyncio.sleep(0)
+
+
+@pytest.fixture
+def choices(monkeypatch):
+    """按调用顺序为每个选项分配脚本，返回创建的会话"""
+    scripts = []
+    launched = []
+
+    async def launch_completion(request, internal_model_id, prompt, attachments, deadline, attempts, client_id=None):
+        index = len(launched)
+        attempt = ScriptedAttempt(index, scripts[index])
+        launched.append(attempt)
+        attempts.append(attempt)
+        return attempt
+
+    monkeypatch.setattr(main, "launch_completion", launch_completion)
+    return scripts, launched
+
+
+def make_request(n, **kwargs):
+    return main.ChatCompletionRequest(model="m", messages=[{"role": "user", "content": "hi"}], n=n, **kwargs)
+
+
+def stream(request):
+    async def scenario():
+        events = main.stream_completion_events(request, "model-id", "prompt", [], Deadline(30))
+        return "".join([event async for event in events])
+
+    text = asyncio.run(scenario())
+    return [event[len("data: "):] for event in text.split("\n\n") if event.startswith("data: ")]
+
+
+def complete(request):
+    return asyncio.run(main.complete_non_stream(request, "model-id", "prompt", [], Deadline(30)))
+
+
+def choice_chunks(events):
+    return [json.loads(event)["choices"][0] for event in events if event != "[DONE]" and "choices" in json.loads(event)]
+
+
+def test_stream_interleaves_choices_by_index_with_a_single_done(choices):
+    scripts, _ = choices
+    scripts.extend([("content", f"{i}a"), ("content", f"{i}b"), ("finish", "stop")] for i in range(3))
+    events = stream(make_request(3))
+
+    assert events.count("[DONE]") == 1 and events[-1] == "[DONE]"
+    chunks = choice_chunks(events)
+    assert [chunk["index"] for chunk in chunks[:3]] == [0, 1, 2]
+    assert all(chunk["delta"] == {"role": "assistant"} for chunk in chunks[:3])
+    for index in range(3):
+        mine = [chunk for chunk in chunks[3:] if chunk["index"] == index]
+        assert "".join(chunk["delta"].get("content", "") for chunk in mine) == f"{index}a{index}b"
+        assert [chunk["finish_reason"] for chunk in mine if chunk["finish_reason"]] == ["stop"]
+    # 增量按到达顺序交错，而不是一个选项输出完再输出下一个
+    assert [chunk["index"] for chunk in chunks[3:6]] == [0, 1, 2]
+
+
+def test_stream_error_in_one_choice_keeps_finished_choices(choices):
+    scripts, launched = choices
+    scripts.append([("content", "done"), ("finish", "length")])
+    scripts.append([("content", "part"), ("sleep", 0.05), ("error", "upstream went away")])
+    events = stream(make_request(2))
+
+    chunks = choice_chunks(events)
+    finished = {chunk["index"]: chunk["finish_reason"] for chunk in chunks if chunk["finish_reason"]}
+    assert finished == {0: "length"}
+    assert json.loads(events[-2])["error"] == {"message": "upstream went away", "type": "tenbin_api_error", "code": 502}
+    assert events.count("[DONE]") == 1 and events[-1] == "[DONE]"
+    assert all(attempt.cancelled for attempt in launched)
+
+
+def test_non_stream_reports_finish_reason_per_choice(choices):
+    scripts, _ = choices
+    scripts.append([("content", "short"), ("finish", "stop")])
+    scripts.append([("reasoning_content", "think"), ("content", "long"), ("finish", "length")])
+    response = complete(make_request(2))
+
+    assert [choice.index for choice in response.choices] == [0, 1]
+    assert [choice.finish_reason for choice in response.choices] == ["stop", "length"]
+    assert [choice.message.content for choice in response.choices] == ["short", "long"]
+    assert response.choices[1].message.reasoning_content == "think"
+
+
+def test_non_stream_timeout_in_one_choice_fails_the_request(choices):
+    scripts, launched = choices
+    scripts.append([("content", "fine"), ("finish", "stop")])
+    scripts.append([("content", "slow"), ("timeout", "Request deadline exceeded")])
+    with pytest.raises(main.HTTPException) as excinfo:
+        complete(make_request(2))
+    assert excinfo.value.status_code == 504
+    assert all(attempt.cancelled for attempt in launched)
+
+
+def test_stop_and_max_tokens_apply_to_each_choice(choices):
+    scripts, launched = choices
+    scripts.append([("content", "abEND"), ("content", " more"), ("finish", "stop")])
+    scripts.append([("content", "abcdefghijkl"), ("finish", "stop")])
+    scripts.append([("content", "ab"), ("finish", "stop")])
+    response = complete(make_request(3, stop=["END"], max_tokens=2))
+
+    assert [choice.message.content for choice in response.choices] == ["ab", "abcdefgh", "ab"]
+    assert [choice.finish_reason for choice in response.choices] == ["stop", "length", "stop"]
+    # 触发 stop 或 max_tokens 的选项立即取消各自的上游
+    assert [attempt.cancelled for attempt in launched[:2]] == [True, True]
+
+    scripts.clear()
+    launched.clear()
+    scripts.append([("content", "xyEND"), ("finish", "stop")])
+    scripts.append([("content", "abcdefghijkl"), ("finish", "stop")])
+    chunks = choice_chunks(stream(make_request(2, stop=["END"], max_tokens=2)))
+    for index, (content, finish_reason) in enumerate([("xy", "stop"), ("abcdefgh", "length")]):
+        mine = [chunk for chunk in chunks if chunk["index"] == index]
+        assert "".join(chunk["delta"].get("content", "") for chunk in mine) == content
+        assert [chunk["finish_reason"] for chunk in mine if chunk["finish_reason"]] == [finish_reason]
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""熔断器的状态转换：closed → open → half-open → closed/open"""
+
+import types
+
+import pytest
+
+import circuit_breaker
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(circuit_breaker, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(circuit_breaker, "BREAKER_ENABLED", True)
+    return clock
+
+
+def make_breaker(**kwargs):
+    options = dict(slow_call_seconds=5, failure_rate=0.5, slow_call_rate=0.8, min_calls=4, window=60, open_seconds=30)
+    options.update(kwargs)
+    return CircuitBreaker("test", **options)
+
+
+def open_breaker(breaker):
+    for _ in range(breaker.min_calls):
+        breaker.record_failure(0.1)
+    assert breaker.state == OPEN
+
+
+def test_stays_closed_below_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure(0.1)
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_opens_on_failure_rate_and_rejects_with_retry_after(clock):
+    breaker = make_breaker()
+    breaker.record_success(0.1)
+    breaker.record_success(0.1)
+    breaker.record_failure(0.1)
+    assert breaker.state == CLOSED
+    breaker.record_failure(0.1)
+    assert breaker.state == OPEN and breaker.open_count == 1
+
+    clock.now += 10
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.before_call()
+    assert excinfo.value.status_code == 503
+    assert excinfo.value.headers["Retry-After"] == "20"
+
+
+def test_opens_on_slow_call_rate(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record_success(6)
+    assert breaker.state == OPEN
+
+
+def test_old_calls_leave_the_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure(0.1)
+    clock.now += 61
+    breaker.record_failure(0.1)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["calls"] == 1
+
+
+def test_half_open_allows_a_single_probe(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+    assert breaker.snapshot()["state"] == HALF_OPEN
+
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    # 探测结果迟迟不回来时允许重新探测
+    clock.now += 30
+    breaker.before_call()
+
+
+def test_successful_probe_closes(clock):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+    breaker.before_call()
+    breaker.record_success(0.1)
+    assert breaker.state == CLOSED
+    assert breaker.snapshot()["calls"] == 0
+    breaker.before_call()
+
+
+@pytest.mark.parametrize("failed, duration", [(True, 0.1), (False, 6)])
+def test_failed_or_slow_probe_reopens(clock, failed, duration):
+    breaker = make_breaker()
+    open_breaker(breaker)
+    clock.now += 30
+    breaker.before_call()
+    breaker.record(duration, failed)
+    assert breaker.state == OPEN and breaker.open_count == 2
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_disabled_breaker_never_rejects(clock, monkeypatch):
+    monkeypatch.setattr(circuit_breaker, "BREAKER_ENABLED", False)
+    breaker = make_breaker()
+    for _ in range(10):
+        breaker.record_failure(0.1)
+    assert breaker.state == CLOSED
+    breaker.before_call()
+
+
+def test_check_is_read_only(clock):
+    breaker = make_breaker()
+    breaker.check()
+    open_breaker(breaker)
+    with pytest.raises(CircuitOpenError) as excinfo:
+        breaker.check()
+    assert excinfo.value.headers["Retry-After"] == "30"
+
+    # 进入半开后 check 不占用探测名额，真正的调用仍能拿到探测机会
+    clock.now += 30
+    breaker.check()
+    breaker.check()
+    assert breaker.state == OPEN
+    breaker.before_call()
+    assert breaker.state == HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
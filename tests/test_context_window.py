@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""按 token 预算裁剪对话历史"""
+
+from types import SimpleNamespace
+
+from context_window import MESSAGE_OVERHEAD_TOKENS, estimate_tokens, fit_messages, message_tokens
+
+
+def message(role, words=100):
+    return SimpleNamespace(role=role, content=" ".join(["word"] * words))
+
+
+def conversation(turns):
+    messages = [message("system", 10)]
+    for _ in range(turns):
+        messages += [message("user"), message("assistant")]
+    messages.append(message("user"))
+    return messages
+
+
+def roles(messages):
+    return [m["role"] if isinstance(m, dict) else m.role for m in messages]
+
+
+def test_within_budget_is_unchanged():
+    messages = conversation(2)
+    fitted, stats = fit_messages(messages, 100000)
+    assert fitted is messages
+    assert stats["dropped_messages"] == 0
+
+
+def test_drops_whole_turns_from_the_oldest():
+    messages = conversation(5)
+    fitted, stats = fit_messages(messages, 600)
+    assert stats["dropped_messages"] % 2 == 0
+    assert stats["tokens"] <= 600
+    # system、占位说明，之后从 user 开始，每条 assistant 前面都有它的问题
+    kept = roles(fitted)
+    assert kept[:3] == ["system", "system", "user"]
+    assert fitted[1]["content"].startswith(f"[{stats['dropped_messages']} earlier messages")
+    assert all(kept[i - 1] == "user" for i, role in enumerate(kept) if role == "assistant")
+    assert fitted[-1] is messages[-1]
+
+
+def test_turn_with_several_replies_is_dropped_together():
+    messages = [message("user"), message("assistant"), message("assistant"), message("user"), message("assistant"), message("user")]
+    fitted, stats = fit_messages(messages, 450, keep_recent=2)
+    assert stats["dropped_messages"] == 3
+    assert roles(fitted) == ["system", "user", "assistant", "user"]
+
+
+def test_recent_turns_are_protected_even_over_budget():
+    messages = conversation(1)
+    fitted, stats = fit_messages(messages, 10, keep_recent=3)
+    # 最近 3 条消息覆盖了所有轮次，无可丢弃
+    assert fitted is messages
+    assert stats["tokens"] > 10
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("你好") == 2
+    assert message_tokens(SimpleNamespace(role="user", content="")) == MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""复用会话状态：状态按客户端和附件内容区分；状态令牌迟迟没有回复时改发完整提示，n > 1 时不复用"""
+
+import asyncio
+import base64
+import time
+
+import pytest
+
+import main
+from conversation_state import ConversationState, ConversationStateCache
+from deadline import Deadline
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    calls = {"lookup": 0, "discarded": []}
+
+    def lookup(model, messages, client_id=None):
+        calls["lookup"] += 1
+        return "known-key", ConversationState("state-token", "session-1")
+
+    def iter_segments(model, prompt, session_id, execution_token, state_token="", handle=None, **kwargs):
+        if state_token:
+            # 状态令牌失效后上游既不回复也不报错
+            while not handle.cancelled:
+                time.sleep(0.01)
+            return
+        yield ("content", "hello")
+        yield ("finish", "stop")
+
+    async def open_upstream(model, internal_model_id, attachments, deadline):
+        return {"session_id": "session-2", "execution_token": "t", "file_upload_ids": [], "state_token": ""}
+
+    monkeypatch.setattr(main.conversation_cache, "lookup", lookup)
+    monkeypatch.setattr(main.conversation_cache, "discard", lambda key: calls["discarded"].append(key))
+    monkeypatch.setattr(main, "acquire_upstream_session", lambda *args: {
+        "session_id": "session-1", "execution_token": "t", "file_upload_ids": [], "state_token": "",
+    })
+    monkeypatch.setattr(main, "iter_tenbin_segments", iter_segments)
+    monkeypatch.setattr(main, "open_upstream", open_upstream)
+    monkeypatch.setattr(main, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(main, "CONVERSATION_STATE_FIRST_TOKEN_TIMEOUT", 0.05)
+    return calls
+
+
+def launch(request):
+    async def scenario():
+        attempts = []
+        try:
+            winner = await main.launch_completion(request, "model-id", "prompt", [], Deadline(30), attempts)
+            await asyncio.wait_for(winner.ready.wait(), 5)
+            return winner, attempts
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    return asyncio.run(scenario())
+
+
+def make_request(**kwargs):
+    messages = [
+        {"role": "user", "content": "hi"},
+        {"role": "assistant", "content": "hello"},
+        {"role": "user", "content": "again"},
+    ]
+    return main.ChatCompletionRequest(model="Claude-3.7-Sonnet", messages=messages, reuse_state=True, **kwargs)
+
+
+def test_stalled_state_token_falls_back_to_the_full_prompt(fake_upstream):
+    winner, attempts = launch(make_request())
+    assert [attempt.label for attempt in attempts] == ["stateful", "primary"]
+    assert winner is attempts[-1] and winner.has_token
+    assert attempts[0].handle.cancelled
+    assert fake_upstream["discarded"] == ["known-key"]
+
+
+def test_multiple_choices_do_not_reuse_state(fake_upstream):
+    winner, attempts = launch(make_request(n=2))
+    assert fake_upstream["lookup"] == 0
+    assert [attempt.label for attempt in attempts] == ["primary"]
+
+
+def image_turn(text, data):
+    url = "data:image/png;base64," + base64.b64encode(data).decode("ascii")
+    return main.ChatMessage(role="user", content=[{"type": "text", "text": text}, {"type": "image_url", "image_url": {"url": url}}])
+
+
+def remember(cache, messages, client_id):
+    recorder = cache.recorder("m", messages, client_id)
+    for kind, value in (("content", "a cat"), ("state", "state-token"), ("finish", "stop")):
+        recorder.feed(kind, value)
+    recorder.commit("session-1")
+
+
+def next_turn(history):
+    return history + [main.ChatMessage(role="assistant", content="a cat"), main.ChatMessage(role="user", content="more")]
+
+
+def test_state_is_keyed_by_attachment_content():
+    cache = ConversationStateCache()
+    remember(cache, [image_turn("what is this?", b"cat.png")], "client-a")
+    assert cache.lookup("m", next_turn([image_turn("what is this?", b"cat.png")]), "client-a") is not None
+    # 文本相同、图片不同的历史不能沿用上游记住的图片
+    assert cache.lookup("m", next_turn([image_turn("what is this?", b"dog.png")]), "client-a") is None
+
+
+def test_state_is_keyed_by_client():
+    cache = ConversationStateCache()
+    history = [main.ChatMessage(role="user", content="hi")]
+    remember(cache, history, "client-a")
+    assert cache.lookup("m", next_turn(history), "client-b") is None
+    assert cache.lookup("m", next_turn(history), "client-a")[1] == ConversationState("state-token", "session-1")
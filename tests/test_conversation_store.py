@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""服务端对话存储：追加顺序与冲突、游标分页、删除标记、日志压缩、半行截断和按客户端隔离"""
+
+import asyncio
+import json
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+import config_manager
+import main
+from config_manager import ConversationConflict, ConversationStore
+
+OWNER = "owner-a"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ConversationStore(str(tmp_path))
+
+
+def messages(*contents, role="user"):
+    return [{"role": role, "content": content} for content in contents]
+
+
+def contents(page):
+    return [message["content"] for message in page["messages"]]
+
+
+def test_append_assigns_increasing_seqs(store):
+    first = store.append("c1", messages("a", "b"), owner=OWNER)
+    second = store.append("c1", messages("c"), owner=OWNER)
+    assert [m["seq"] for m in first["messages"] + second["messages"]] == [0, 1, 2]
+    assert second["conversation"]["message_count"] == 3
+    assert second["conversation"]["next_seq"] == 3
+    assert contents(store.page("c1", owner=OWNER)) == ["a", "b", "c"]
+
+
+def test_append_rejects_stale_seq_and_duplicate_ids(store):
+    store.append("c1", messages("a", "b"), owner=OWNER)
+    with pytest.raises(ConversationConflict):
+        store.append("c1", [{"role": "user", "content": "late", "seq": 1}], owner=OWNER)
+    with pytest.raises(ConversationConflict):
+        store.append("c1", [{"role": "user", "content": "dup", "id": "msg_c1_0"}], owner=OWNER)
+    # 冲突时整批都不写入
+    assert store.get("c1", OWNER)["message_count"] == 2
+    assert store.append("c1", [{"role": "user", "content": "gap", "seq": 5}], owner=OWNER)["conversation"]["next_seq"] == 6
+
+
+def test_cursor_paging(store):
+    store.append("c1", messages(*[str(i) for i in range(10)]), owner=OWNER)
+    latest = store.page("c1", limit=4, owner=OWNER)
+    assert contents(latest) == ["6", "7", "8", "9"]
+    assert latest["has_more"] and latest["next_before"] == 6
+
+    earlier = store.page("c1", before=latest["next_before"], limit=4, owner=OWNER)
+    assert contents(earlier) == ["2", "3", "4", "5"]
+    oldest = store.page("c1", before=earlier["next_before"], limit=4, owner=OWNER)
+    assert contents(oldest) == ["0", "1"]
+    assert not oldest["has_more"] and oldest["next_before"] is None
+
+    forward = store.page("c1", after=3, limit=3, owner=OWNER)
+    assert contents(forward) == ["4", "5", "6"]
+    assert forward["next_after"] == 6
+    assert contents(store.page("c1", after=forward["next_after"], limit=3, owner=OWNER)) == ["7", "8", "9"]
+
+
+def test_delete_and_clear_append_markers(store, tmp_path):
+    store.append("c1", messages("a", "b", "c"), owner=OWNER)
+    meta = store.delete_messages("c1", ["msg_c1_1", "missing"], owner=OWNER)
+    assert meta["message_count"] == 2
+    assert contents(store.page("c1", owner=OWNER)) == ["a", "c"]
+
+    store.clear("c1", owner=OWNER)
+    assert contents(store.page("c1", owner=OWNER)) == []
+    # 清空后序号继续递增
+    assert store.append("c1", messages("d"), owner=OWNER)["messages"][0]["seq"] == 3
+
+    records = [json.loads(line) for line in (tmp_path / "c1.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert {"op": "delete", "seqs": [1]} in records and {"op": "clear"} in records
+    # 新实例从日志重建索引，结果相同
+    assert contents(ConversationStore(str(tmp_path)).page("c1", owner=OWNER)) == ["d"]
+
+
+def test_compaction_rewrites_log_with_live_messages(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(config_manager, "CONVERSATION_COMPACT_MIN_BYTES", 0)
+    store.append("c1", messages(*["x" * 100 + str(i) for i in range(6)]), owner=OWNER)
+    meta = store.delete_messages("c1", [f"msg_c1_{i}" for i in range(4)], owner=OWNER)
+    assert meta["log_bytes"] == meta["bytes"]
+    log = (tmp_path / "c1.jsonl").read_bytes()
+    assert len(log) == meta["bytes"] and log.count(b"\n") == 2
+
+    expected = ["x" * 100 + "4", "x" * 100 + "5"]
+    assert contents(store.page("c1", owner=OWNER)) == expected
+    assert contents(ConversationStore(str(tmp_path)).page("c1", owner=OWNER)) == expected
+    assert store.append("c1", messages("y"), owner=OWNER)["messages"][0]["seq"] == 6
+
+
+def test_half_written_line_is_truncated(store, tmp_path):
+    store.append("c1", messages("a", "b"), owner=OWNER)
+    path = tmp_path / "c1.jsonl"
+    intact = path.read_bytes()
+    with open(path, "ab") as f:
+        f.write(b'{"id": "msg_c1_2", "seq": 2, "ro')
+
+    reopened = ConversationStore(str(tmp_path))
+    assert contents(reopened.page("c1", owner=OWNER)) == ["a", "b"]
+    assert path.read_bytes() == intact
+    reopened.append("c1", messages("c"), owner=OWNER)
+    assert contents(ConversationStore(str(tmp_path)).page("c1", owner=OWNER)) == ["a", "b", "c"]
+
+
+def test_conversations_are_isolated_by_owner(store):
+    store.append("c1", messages("secret"), owner=OWNER)
+    assert [meta["id"] for meta in store.list(owner=OWNER)] == ["c1"]
+    assert store.list(owner="owner-b") == []
+    assert store.get("c1", "owner-b") is None
+    for call in (
+        lambda: store.page("c1", owner="owner-b"),
+        lambda: store.history("c1", owner="owner-b"),
+        lambda: store.append("c1", messages("x"), owner="owner-b"),
+        lambda: store.upsert("c1", "stolen", owner="owner-b"),
+        lambda: store.delete_messages("c1", ["msg_c1_0"], owner="owner-b"),
+        lambda: store.clear("c1", owner="owner-b"),
+    ):
+        with pytest.raises(KeyError):
+            call()
+    assert store.delete("c1", owner="owner-b") is False
+    assert contents(store.page("c1", owner=OWNER)) == ["secret"]
+    assert store.get("c1", OWNER)["title"] == "新对话"
+
+
+@pytest.fixture
+def client(store, monkeypatch):
+    monkeypatch.setattr(config_manager, "conversation_store", store)
+    monkeypatch.setattr(main, "conversation_store", store)
+    monkeypatch.setattr(main, "VALID_CLIENT_KEYS", {"key-a", "key-b"})
+    app = FastAPI()
+    app.include_router(config_manager.conversation_router, dependencies=[Depends(main.authenticate_client)])
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+def auth(key):
+    return {"Authorization": f"Bearer {key}"}
+
+
+def test_routes_return_404_for_other_clients(client):
+    base = "/config/conversations/c1"
+    assert client.post(f"{base}/messages", json={"messages": messages("hi")}, headers=auth("key-a")).status_code == 200
+    assert [c["id"] for c in client.get("/config/conversations", headers=auth("key-a")).json()["data"]] == ["c1"]
+    assert client.get("/config/conversations", headers=auth("key-b")).json()["data"] == []
+
+    for method, path, body in [
+        ("get", f"{base}/messages", None),
+        ("post", f"{base}/messages", {"messages": messages("x")}),
+        ("put", base, {"title": "stolen"}),
+        ("post", f"{base}/messages/delete", {"ids": ["msg_c1_0"]}),
+        ("delete", f"{base}/messages", None),
+        ("delete", base, None),
+    ]:
+        kwargs = {"json": body} if body is not None else {}
+        assert client.request(method.upper(), path, headers=auth("key-b"), **kwargs).status_code == 404
+    assert contents(client.get(f"{base}/messages", headers=auth("key-a")).json()["data"]) == ["hi"]
+
+
+def test_chat_history_is_only_loaded_for_the_owner(store, monkeypatch):
+    monkeypatch.setattr(main, "conversation_store", store)
+    owner = main.client_id_for_key("key-a")
+    store.append("c1", messages("earlier"), owner=owner)
+
+    def request():
+        return main.ChatCompletionRequest(model="m", messages=messages("now"), conversation_id="c1")
+
+    loaded = request()
+    asyncio.run(main.load_conversation_history(loaded, owner))
+    assert [m.content for m in loaded.messages] == ["earlier", "now"]
+
+    with pytest.raises(main.HTTPException) as excinfo:
+        asyncio.run(main.load_conversation_history(request(), main.client_id_for_key("key-b")))
+    assert excinfo.value.status_code == 404
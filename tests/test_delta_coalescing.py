@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""增量合并：缓冲达到字节上限或合并窗口到期时发出，请求中的合并参数受服务器上限约束"""
+
+import json
+
+import pytest
+import websocket
+
+import main
+from circuit_breaker import CircuitBreaker
+
+TIMEOUT = object()  # 合并窗口内没有新帧
+
+
+class ScriptedSocket:
+    """按脚本返回上游帧的连接替身；遇到 TIMEOUT 时像真实连接一样抛出读超时"""
+
+    def __init__(self, frames):
+        self.frames = [json.dumps({"type": "connection_ack"})] + list(frames)
+        self.timeouts = []
+
+    def send(self, frame):
+        pass
+
+    def settimeout(self, timeout):
+        self.timeouts.append(timeout)
+
+    def recv(self):
+        frame = self.frames.pop(0)
+        if frame is TIMEOUT:
+            raise websocket.WebSocketTimeoutException("timed out")
+        return frame
+
+    def close(self):
+        pass
+
+
+def delta(token, finished=False):
+    conversation = {"deltaToken": token, "isFinished": finished}
+    return json.dumps({"type": "next", "payload": {"data": {"startConversation": conversation}}})
+
+
+@pytest.fixture(autouse=True)
+def fresh_breaker(monkeypatch):
+    monkeypatch.setattr(main, "stream_breaker", CircuitBreaker("websocket_subscription", 5))
+
+
+def segments(frames, **kwargs):
+    socket = ScriptedSocket(frames)
+    output = list(main.iter_tenbin_segments("m", "prompt", "", "", transport=socket, **kwargs))
+    return [value for kind, value in output if kind == "content"], socket
+
+
+def test_flushes_when_the_buffer_reaches_max_bytes():
+    contents, _ = segments(
+        [delta("ab"), delta("cd"), delta("ef"), delta("g", finished=True)], coalesce_ms=60000, coalesce_bytes=4
+    )
+    assert contents == ["abcd", "efg"]
+
+
+def test_flushes_when_the_window_expires():
+    contents, socket = segments(
+        [delta("ab"), delta("cd"), TIMEOUT, delta("ef", finished=True)], coalesce_ms=50, coalesce_bytes=4096
+    )
+    # 读超时即合并窗口到期：已缓冲的 "abcd" 先发出，不等后面的增量
+    assert contents == ["abcd", "ef"]
+    # 缓冲非空时读超时不超过合并窗口
+    assert 0 < min(socket.timeouts) <= 0.05
+
+
+def test_request_values_are_bounded():
+    with pytest.raises(main.ValidationError):
+        main.ChatCompletionRequest(model="m", messages=[], coalesce_ms=main.STREAM_COALESCE_MAX_MS + 1)
+    with pytest.raises(main.ValidationError):
+        main.ChatCompletionRequest(model="m", messages=[], coalesce_bytes=-1)
+    request = main.ChatCompletionRequest(model="m", messages=[], coalesce_ms=main.STREAM_COALESCE_MAX_MS)
+    assert request.coalesce_ms == main.STREAM_COALESCE_MAX_MS
+
+
+def test_direct_callers_are_clamped_to_server_limits(monkeypatch):
+    monkeypatch.setattr(main, "STREAM_COALESCE_MAX_MS", 50)
+    monkeypatch.setattr(main, "STREAM_COALESCE_MAX_BYTES", 4)
+    # 0 字节（不限制）和超出上限的值都按上限处理
+    contents, socket = segments(
+        [delta("ab"), delta("cd"), delta("e"), TIMEOUT, delta("f", finished=True)], coalesce_ms=60000, coalesce_bytes=0
+    )
+    assert contents == ["abcd", "e", "f"]
+    assert 0 < min(socket.timeouts) <= 0.05
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""附件目录回收、按上传客户端隔离 file id，以及上传失败时退回纯文本"""
+
+import os
+import time
+
+import pytest
+
+import file_uploads
+import main
+from deadline import Deadline
+
+
+@pytest.fixture
+def upload_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_uploads, "UPLOAD_DIR", str(tmp_path))
+    # 不让写入附件时触发后台回收
+    monkeypatch.setattr(file_uploads.upload_collector, "last_run", time.monotonic())
+    monkeypatch.setattr(file_uploads, "UPLOAD_GC_INTERVAL", 3600.0)
+    return tmp_path
+
+
+OWNER = "owner-a"
+
+
+def store(content: bytes, used_at: float):
+    attachment = file_uploads.store_chunks(iter([content]), "text/plain", "a.txt", owner=OWNER)
+    os.utime(attachment.path, (used_at, used_at))
+    return attachment
+
+
+def test_collect_removes_expired_attachments(upload_dir):
+    now = time.time()
+    old = store(b"old", now - 7200)
+    fresh = store(b"fresh", now - 60)
+    stale_part = upload_dir / "tmp123.part"
+    stale_part.write_bytes(b"x")
+    os.utime(stale_part, (now - 7200, now - 7200))
+
+    collector = file_uploads.UploadCollector(retention=3600, max_bytes=1 << 30)
+    assert collector.collect(now) == 1
+    assert not os.path.exists(old.path) and not os.path.exists(old.path + ".json")
+    assert os.path.exists(fresh.path)
+    assert not stale_part.exists()
+
+
+def test_collect_enforces_size_limit_least_recently_used_first(upload_dir):
+    now = time.time()
+    first = store(b"a" * 100, now - 30)
+    second = store(b"b" * 100, now - 20)
+    third = store(b"c" * 100, now - 10)
+
+    collector = file_uploads.UploadCollector(retention=3600, max_bytes=250)
+    assert collector.collect(now) == 1
+    assert not os.path.exists(first.path)
+    assert os.path.exists(second.path) and os.path.exists(third.path)
+
+
+def test_lookup_marks_attachment_as_used(upload_dir):
+    now = time.time()
+    attachment = store(b"reused", now - 7200)
+    assert file_uploads.get_stored_attachment(attachment.file_id, OWNER) is not None
+    assert file_uploads.UploadCollector(retention=3600).collect() == 0
+    assert os.path.exists(attachment.path)
+
+
+def test_file_ids_only_resolve_for_clients_that_uploaded_them(upload_dir):
+    attachment = store(b"private", time.time())
+    assert file_uploads.get_stored_attachment(attachment.file_id, "owner-b") is None
+    messages = [main.ChatMessage(role="user", content=[{"type": "file", "file": {"file_id": attachment.file_id}}])]
+    assert file_uploads.extract_attachments(messages, "owner-b") == []
+    assert [a.sha256 for a in file_uploads.extract_attachments(messages, OWNER)] == [attachment.sha256]
+
+    # 另一个客户端上传相同内容后同样可以引用，原来的客户端不受影响
+    file_uploads.store_chunks(iter([b"private"]), "text/plain", "b.txt", owner="owner-b")
+    assert file_uploads.get_stored_attachment(attachment.file_id, "owner-b") is not None
+    assert file_uploads.get_stored_attachment(attachment.file_id, OWNER) is not None
+
+
+def test_attachments_are_described_in_the_prompt():
+    content = [
+        {"type": "text", "text": "看看这些"},
+        {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        {"type": "file", "file": {"file_id": "file-" + "0" * 64, "filename": "report.pdf"}},
+    ]
+    prompt = main.build_tenbin_prompt([main.ChatMessage(role="user", content=content)])
+    assert "Human: 看看这些 [图片: (image/png)] [文件: report.pdf]" in prompt
+
+
+@pytest.fixture
+def one_account(monkeypatch):
+    account = {"session_id": "session-0001", "is_valid": True, "last_used": 0.0, "error_count": 0}
+    monkeypatch.setattr(main, "TENBIN_ACCOUNTS", [account])
+    monkeypatch.setattr(main, "get_tenbin_execution_token", lambda model, session_id, deadline: "exec-token")
+    return account
+
+
+def test_upload_failure_falls_back_to_text_without_account_error(upload_dir, one_account, monkeypatch):
+    def fail(attachments, session_id):
+        raise ConnectionError("upload endpoint unreachable")
+
+    monkeypatch.setattr(main, "TENBIN_UPLOAD_URL", "https://upload.invalid")
+    monkeypatch.setattr(main, "upload_attachments", fail)
+    attachment = store(b"image", time.time())
+
+    upstream = main.acquire_upstream_session("model", [attachment], Deadline(30))
+    assert upstream["execution_token"] == "exec-token"
+    assert upstream["file_upload_ids"] == []
+    assert one_account["error_count"] == 0
+
+
+def test_upload_skipped_when_endpoint_not_configured(upload_dir, one_account, monkeypatch):
+    monkeypatch.setattr(main, "TENBIN_UPLOAD_URL", "")
+    monkeypatch.setattr(main, "upload_attachments", lambda attachments, session_id: pytest.fail("should not upload"))
+    upstream = main.acquire_upstream_session("model", [store(b"image", time.time())], Deadline(30))
+    assert upstream["file_upload_ids"] == []
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""优雅排空：排空期间新请求返回 503，进行中的流在宽限期内继续输出，/admin/drain 开始排空并报告状态"""
+
+import asyncio
+
+import pytest
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+import graceful_drain
+import main
+from graceful_drain import DrainController, DrainMiddleware
+
+
+async def no_batches():
+    return None
+
+
+@pytest.fixture(autouse=True)
+def skip_batch_shutdown(monkeypatch):
+    monkeypatch.setattr(graceful_drain, "shutdown_batches", no_batches)
+
+
+class StreamingApp:
+    """ASGI 应用替身：先发出一个分块，等待放行后再发出最后一块"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"first ", "more_body": True})
+        self.started.set()
+        await self.release.wait()
+        await send({"type": "http.response.body", "body": b"last", "more_body": False})
+
+
+async def call(app, path, headers=()):
+    """发起一次 ASGI 请求，返回 (状态码, 响应头, 响应体)"""
+    scope = {"type": "http", "method": "POST", "path": path, "headers": list(headers), "query_string": b""}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = next(message for message in messages if message["type"] == "http.response.start")
+    body = b"".join(message.get("body", b"") for message in messages if message["type"] == "http.response.body")
+    return start["status"], dict(start["headers"]), body
+
+
+def test_new_requests_are_rejected_while_draining():
+    async def scenario():
+        inner = StreamingApp()
+        inner.release.set()
+        controller = DrainController(grace_seconds=0)
+        app = DrainMiddleware(inner, controller)
+        assert (await call(app, "/v1/chat/completions"))[0] == 200
+
+        controller.begin("test")
+        status, headers, body = await call(app, "/v1/chat/completions")
+        assert status == 503
+        assert headers[b"retry-after"] == str(graceful_drain.DRAIN_RETRY_AFTER).encode()
+        assert headers[b"connection"] == b"close"
+        assert b"draining" in body
+        assert controller.rejected == 1
+
+        # 健康检查、管理接口和断线续传仍然放行
+        for path, extra in [
+            ("/health", ()),
+            ("/admin/drain", ()),
+            ("/v1/chat/completions/chatcmpl-1/events", ()),
+            ("/v1/chat/completions", ((b"last-event-id", b"chatcmpl-1:3"),)),
+        ]:
+            assert (await call(app, path, extra))[0] == 200
+        assert controller.rejected == 1
+        await controller._task
+
+    asyncio.run(scenario())
+
+
+def test_inflight_stream_finishes_before_the_deadline():
+    async def scenario():
+        inner = StreamingApp()
+        controller = DrainController(grace_seconds=5)
+        drained = []
+        controller.on_drained = lambda: drained.append((controller.inflight, controller.elapsed))
+        app = DrainMiddleware(inner, controller)
+
+        request = asyncio.ensure_future(call(app, "/v1/chat/completions"))
+        await inner.started.wait()
+        controller.begin("test")
+        assert controller.inflight == 1 and not controller.drained
+        await asyncio.sleep(0.3)
+        assert drained == []
+
+        inner.release.set()
+        assert await request == (200, {}, b"first last")
+        await asyncio.wait_for(controller._task, 2)
+        inflight, elapsed = drained[0]
+        assert inflight == 0 and elapsed < controller.grace_seconds
+        assert controller.status()["drained"]
+
+    asyncio.run(scenario())
+
+
+def test_drain_gives_up_after_the_grace_period():
+    async def scenario():
+        inner = StreamingApp()
+        controller = DrainController(grace_seconds=0.3)
+        drained = []
+        controller.on_drained = lambda: drained.append(controller.inflight)
+        app = DrainMiddleware(inner, controller)
+
+        request = asyncio.ensure_future(call(app, "/v1/chat/completions"))
+        await inner.started.wait()
+        controller.begin("test")
+        await asyncio.wait_for(controller._task, 2)
+        assert drained == [1]
+        request.cancel()
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def admin_client(monkeypatch):
+    controller = DrainController(grace_seconds=0)
+    monkeypatch.setattr(graceful_drain, "drain_controller", controller)
+    monkeypatch.setattr(main, "VALID_ADMIN_KEYS", {"admin-key"})
+    app = FastAPI()
+    app.include_router(graceful_drain.drain_router, dependencies=[Depends(main.authenticate_admin)])
+    with TestClient(app) as client:
+        yield client, controller
+
+
+def test_admin_drain_route(admin_client):
+    client, controller = admin_client
+    admin = {"Authorization": "Bearer admin-key"}
+    assert client.post("/admin/drain", headers={"Authorization": "Bearer nope"}).status_code == 403
+    assert not controller.draining
+
+    status = client.get("/admin/drain", headers=admin).json()
+    assert status["draining"] is False and status["remaining"] is None
+
+    status = client.post("/admin/drain", headers=admin).json()
+    assert status["draining"] is True and status["grace_seconds"] == 0
+    assert controller.draining
+    assert client.get("/admin/drain", headers=admin).json()["draining"] is True
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""对冲请求：首字超过阈值才发起，先出字的会话胜出，落败的会话被取消，两边都失败时只输出一个错误"""
+
+import asyncio
+import time
+
+import pytest
+
+import main
+from deadline import Deadline
+from upstream_stats import HedgeBudget, HedgeMetrics
+
+HEDGE_DELAY = 0.05
+
+
+class FakeAttempt:
+    """按 label 取脚本的 UpstreamAttempt 替身：等待 delay 秒后产出全部片段"""
+
+    scripts = {}
+
+    def __init__(self, model, prompt, upstream, label="primary", **kwargs):
+        self.label = label
+        self.upstream = upstream
+        self.delay, self.script = self.scripts[label]
+        self.first_token_at = None
+        self.finished = False
+        self.cancelled = False
+        self.ready = None
+        self.task = None
+
+    @property
+    def has_token(self):
+        return self.first_token_at is not None
+
+    def start(self):
+        self.ready = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(self.delay)
+        if any(kind == "content" for kind, _ in self.script):
+            self.first_token_at = time.monotonic()
+        self.finished = True
+        self.ready.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self.task.cancel()
+
+    async def segments(self):
+        for segment in self.script:
+            yield segment
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    calls = {"hedge_acquired_after": None}
+    metrics = HedgeMetrics()
+    monkeypatch.setattr(main, "UpstreamAttempt", FakeAttempt)
+    monkeypatch.setattr(main, "hedge_delay", lambda model: HEDGE_DELAY)
+    monkeypatch.setattr(main, "hedge_budget", HedgeBudget(max_rate=1.0))
+    monkeypatch.setattr(main, "hedge_metrics", metrics)
+
+    def acquire(*args):
+        calls["hedge_acquired_after"] = time.monotonic() - calls["started"]
+        return {"session_id": "session-2", "execution_token": "t", "file_upload_ids": [], "state_token": ""}
+
+    monkeypatch.setattr(main, "acquire_upstream_session", acquire)
+    calls["metrics"] = metrics
+    return calls
+
+
+def run(calls, primary, hedge=None):
+    FakeAttempt.scripts = {"primary": primary, "hedge": hedge}
+    request = main.ChatCompletionRequest(model="m", messages=[{"role": "user", "content": "hi"}], hedge=True)
+    upstream = {"session_id": "session-1", "execution_token": "t", "file_upload_ids": [], "state_token": ""}
+
+    async def scenario():
+        attempts = []
+        calls["started"] = time.monotonic()
+        winner = await main.start_completion(request, "model-id", "prompt", [], upstream, Deadline(30), attempts)
+        output = [segment async for segment in main.output_segments(request, winner)]
+        return winner, attempts, output
+
+    return asyncio.run(scenario())
+
+
+def test_fast_primary_does_not_hedge(hedging):
+    winner, attempts, _ = run(hedging, primary=(0.01, [("content", "hi"), ("finish", "stop")]))
+    assert [attempt.label for attempt in attempts] == ["primary"]
+    assert winner.label == "primary"
+    assert hedging["hedge_acquired_after"] is None
+    assert hedging["metrics"].counters["fired"] == 0
+
+
+def test_hedge_fires_after_the_delay_and_the_first_to_respond_wins(hedging):
+    winner, attempts, output = run(
+        hedging,
+        primary=(5, [("content", "slow"), ("finish", "stop")]),
+        hedge=(0.01, [("content", "fast"), ("finish", "stop")]),
+    )
+    assert hedging["hedge_acquired_after"] >= HEDGE_DELAY
+    assert [attempt.label for attempt in attempts] == ["primary", "hedge"]
+    assert winner.label == "hedge"
+    assert output == [("content", "fast"), ("finish", "stop")]
+    # 落败的主会话被取消
+    assert attempts[0].cancelled and not attempts[1].cancelled
+    assert hedging["metrics"].counters["fired"] == 1 and hedging["metrics"].counters["won"] == 1
+
+
+def test_primary_that_answers_first_after_the_hedge_fired_wins(hedging):
+    winner, attempts, output = run(
+        hedging,
+        primary=(HEDGE_DELAY + 0.05, [("content", "primary"), ("finish", "stop")]),
+        hedge=(5, [("content", "hedge"), ("finish", "stop")]),
+    )
+    assert winner.label == "primary"
+    assert output[0] == ("content", "primary")
+    assert attempts[1].cancelled
+    assert hedging["metrics"].counters["won"] == 0
+
+
+def test_both_failing_outputs_a_single_error(hedging):
+    winner, attempts, output = run(
+        hedging,
+        primary=(HEDGE_DELAY + 0.02, [("error", "primary failed")]),
+        hedge=(0.01, [("error", "hedge failed")]),
+    )
+    # 都没有出字时由主会话输出错误，对冲会话被取消
+    assert winner.label == "primary"
+    assert output == [("error", "primary failed")]
+    assert attempts[1].cancelled
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""日志管道：有界队列满时丢弃新记录、NDJSON 文件按大小滚动、写线程批量写入、运行时修改日志级别"""
+
+import json
+import logging
+import queue
+
+import pytest
+
+import log_pipeline
+from log_pipeline import AsyncQueueHandler, LogPipeline, RotatingNDJSONWriter
+
+
+def make_record(msg, **fields):
+    record = logging.LogRecord("tenbin.test", logging.INFO, __file__, 1, msg, None, None)
+    if fields:
+        record.fields = fields
+    return record
+
+
+def test_full_queue_drops_new_records_without_blocking():
+    handler = AsyncQueueHandler(queue.Queue(maxsize=2))
+    for i in range(5):
+        handler.emit(make_record(f"message {i}"))
+    assert handler.dropped == 3
+    kept = [handler.queue.get_nowait().getMessage() for _ in range(handler.queue.qsize())]
+    assert kept == ["message 0", "message 1"]
+
+
+def test_writer_rotates_by_size_and_keeps_backup_count(tmp_path):
+    path = tmp_path / "logs" / "app.ndjson"
+    writer = RotatingNDJSONWriter(str(path), max_bytes=25, backup_count=2)
+    for i in range(5):
+        writer.write([f'{{"n": {i}, "pad": "xxx"}}\n'])
+    writer.close()
+
+    # 每个文件放不下两行：最新一行在当前文件，更早的依次在 .1、.2，再早的被丢弃
+    assert json.loads(path.read_text(encoding="utf-8"))["n"] == 4
+    assert json.loads((tmp_path / "logs" / "app.ndjson.1").read_text(encoding="utf-8"))["n"] == 3
+    assert json.loads((tmp_path / "logs" / "app.ndjson.2").read_text(encoding="utf-8"))["n"] == 2
+    assert not (tmp_path / "logs" / "app.ndjson.3").exists()
+
+
+def test_writer_without_backups_truncates(tmp_path):
+    path = tmp_path / "app.ndjson"
+    writer = RotatingNDJSONWriter(str(path), max_bytes=10, backup_count=0)
+    writer.write(["first line\n"])
+    writer.write(["second\n"])
+    writer.close()
+    assert path.read_text(encoding="utf-8") == "second\n"
+    assert [p.name for p in tmp_path.iterdir()] == ["app.ndjson"]
+
+
+def test_pipeline_writes_structured_records_to_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_pipeline, "LOG_DIR", str(tmp_path))
+    pipeline = LogPipeline(to_file=True, to_stdout=False)
+    pipeline.start()
+    pipeline.handler.emit(make_record("hello", request_id="req-1"))
+    pipeline.handler.emit(make_record("second"))
+    pipeline.stop()
+
+    lines = (tmp_path / log_pipeline.LOG_FILE).read_text(encoding="utf-8").splitlines()
+    entries = [json.loads(line) for line in lines]
+    assert [entry["msg"] for entry in entries] == ["hello", "second"]
+    assert entries[0]["request_id"] == "req-1" and entries[0]["logger"] == "tenbin.test"
+
+
+@pytest.fixture
+def test_logger():
+    logger = log_pipeline.get_logger("pipeline_test")
+    yield logger
+    logger.setLevel(logging.NOTSET)
+
+
+def test_set_logger_level(test_logger):
+    assert test_logger.name == "tenbin.pipeline_test"
+    assert log_pipeline.set_logger_level("pipeline_test", "debug") == "DEBUG"
+    assert test_logger.level == logging.DEBUG
+    assert log_pipeline.get_logger_levels()["tenbin.pipeline_test"] == "DEBUG"
+
+    with pytest.raises(ValueError):
+        log_pipeline.set_logger_level("pipeline_test", "chatty")
+    assert test_logger.level == logging.DEBUG
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""别名路由：选择最快的健康模型，未尝试的模型只作为探测，令牌阶段的失败同样计入，不健康的模型经探索后可以恢复"""
+
+import asyncio
+import random
+
+import pytest
+
+import main
+import model_router
+from circuit_breaker import CircuitBreaker
+from deadline import Deadline
+from model_router import ModelRouter
+
+POOL = ["fast", "slow"]
+
+
+def make_router(**kwargs):
+    router = ModelRouter(alpha=0.5, max_error_rate=0.5, **kwargs)
+    router._random = random.Random(1)
+    return router
+
+
+def test_prefers_lowest_score_and_untried_models():
+    router = make_router(explore_rate=0)
+    router.record_ttft("slow", 2.0)
+    router.record_result("slow", True)
+    assert router.choose("alias", POOL) == "fast"  # 还没有样本
+    router.record_ttft("fast", 1.0)
+    router.record_result("fast", True)
+    assert router.choose("alias", POOL) == "fast"
+
+
+def test_untried_model_is_probed_once_at_a_time():
+    router = make_router(explore_rate=0, probe_timeout=30)
+    router.record_ttft("slow", 2.0)
+    router.record_result("slow", True)
+    assert router.choose("alias", POOL) == "fast"
+    # 探测还没有结果：其余请求走已有样本的模型，而不是都压到未尝试的模型上
+    assert {router.choose("alias", POOL) for _ in range(5)} == {"slow"}
+    router.record_ttft("fast", 1.0)
+    assert router.choose("alias", POOL) == "fast"
+
+
+def test_lost_probe_expires(monkeypatch):
+    router = make_router(explore_rate=0, probe_timeout=30)
+    router.record_ttft("slow", 2.0)
+    now = [1000.0]
+    monkeypatch.setattr(model_router, "time", type("Clock", (), {"monotonic": staticmethod(lambda: now[0])}))
+    assert router.choose("alias", POOL) == "fast"
+    assert router.choose("alias", POOL) == "slow"
+    now[0] += 31
+    assert router.choose("alias", POOL) == "fast"
+
+
+def test_unhealthy_models_are_skipped_without_exploration():
+    router = make_router(explore_rate=0)
+    for model, ttft in (("fast", 1.0), ("slow", 2.0)):
+        router.record_ttft(model, ttft)
+        router.record_result(model, True)
+    router.record_result("fast", False)
+    router.record_result("fast", False)
+    assert {router.choose("alias", POOL) for _ in range(50)} == {"slow"}
+
+
+def test_unhealthy_model_recovers_through_exploration():
+    router = make_router(explore_rate=0.2)
+    for model, ttft in (("fast", 1.0), ("slow", 2.0)):
+        router.record_ttft(model, ttft)
+        router.record_result(model, True)
+    router.record_result("fast", False)
+    router.record_result("fast", False)
+
+    # 探索仍会选中不健康的模型；它恢复后重新成为首选
+    for _ in range(200):
+        model = router.choose("alias", POOL)
+        router.record_result(model, True)
+        if model == "fast" and router._health["fast"].error_rate <= router.max_error_rate:
+            break
+    else:
+        raise AssertionError("unhealthy model was never explored")
+
+    # 重新健康后参与正常选择，错误率继续下降后又是得分最低的模型
+    router.explore_rate = 0
+    for _ in range(3):
+        router.record_result("fast", True)
+    assert router.choose("alias", POOL) == "fast"
+    assert router.snapshot({"alias": POOL})["alias"]["fast"]["routed"] > 0
+
+
+@pytest.fixture
+def alias_pool(monkeypatch):
+    router = make_router(explore_rate=0)
+    monkeypatch.setattr(model_router, "model_router", router)
+    monkeypatch.setattr(main, "model_router", router)
+    monkeypatch.setattr(model_router, "MODEL_ALIASES", {"alias": POOL})
+    monkeypatch.setattr(main, "TENBIN_MODELS", {"fast": "id-fast", "slow": "id-slow"})
+    account = {"session_id": "session-0001", "is_valid": True, "last_used": 0.0, "error_count": 0}
+    monkeypatch.setattr(main, "TENBIN_ACCOUNTS", [account])
+    monkeypatch.setattr(main, "token_breaker", CircuitBreaker("token_issuance", 5))
+    return router
+
+
+def test_token_failures_move_the_alias_to_another_model(alias_pool, monkeypatch):
+    def issue(model_id, session_id, deadline):
+        if model_id == "id-fast":
+            raise ConnectionError("token endpoint rejected the model")
+        return "exec-token"
+
+    monkeypatch.setattr(main, "get_tenbin_execution_token", issue)
+
+    def route():
+        request = main.ChatCompletionRequest(model="alias", messages=[{"role": "user", "content": "hi"}])
+        internal_model_id = main.resolve_chat_request(request)[0]
+        return request.model, internal_model_id
+
+    model, internal_model_id = route()
+    assert model == "fast"
+    with pytest.raises(main.HTTPException) as excinfo:
+        asyncio.run(main.open_upstream(model, internal_model_id, [], Deadline(30)))
+    assert excinfo.value.status_code == 503
+    assert alias_pool.snapshot({"alias": POOL})["alias"]["fast"]["failures"] == 1
+
+    model, internal_model_id = route()
+    assert model == "slow"
+    assert asyncio.run(main.open_upstream(model, internal_model_id, [], Deadline(30)))["execution_token"] == "exec-token"
+    assert route()[0] == "slow"
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""本地执行 stop 和 max_tokens：跨片段的停止序列、结束时输出扣留内容、预算边界"""
+
+import pytest
+
+from output_limits import OutputLimiter
+
+
+def run(limiter, segments):
+    output = []
+    for kind, value in segments:
+        output.extend(limiter.feed(kind, value))
+    return output
+
+
+def content(output):
+    return "".join(value for kind, value in output if kind == "content")
+
+
+def test_stop_sequence_split_across_segments():
+    limiter = OutputLimiter(stop=["END"])
+    output = run(limiter, [("content", "hello E"), ("content", "N"), ("content", "D world"), ("finish", "stop")])
+    assert output == [("content", "hello "), ("finish", "stop")]
+    assert limiter.finish_reason == "stop"
+
+
+def test_partial_stop_prefix_that_does_not_complete_is_released():
+    limiter = OutputLimiter(stop=["END"])
+    output = run(limiter, [("content", "the EN"), ("content", "d is near")])
+    assert content(output) == "the ENd is near"
+    assert limiter.finish_reason is None
+
+
+def test_earliest_of_several_stop_sequences_wins():
+    limiter = OutputLimiter(stop=["bb", "a"])
+    assert content(run(limiter, [("content", "xxbba")])) == "xx"
+
+
+@pytest.mark.parametrize("end", [("finish", "stop"), ("error", "boom"), ("timeout", "late"), ("limit", "too long")])
+def test_held_text_is_flushed_before_the_end_segment(end):
+    limiter = OutputLimiter(stop=["END"])
+    output = run(limiter, [("content", "almost E"), end])
+    assert output == [("content", "almost "), ("content", "E"), end]
+    assert limiter.held == ""
+
+
+def test_max_tokens_boundary():
+    limiter = OutputLimiter(max_tokens=2)
+    assert run(limiter, [("content", "abcd")]) == [("content", "abcd")]
+    assert limiter.finish_reason is None
+    # 第二个片段越过预算：只输出到恰好用完预算的位置
+    assert run(limiter, [("content", "efghij")]) == [("content", "efgh"), ("finish", "length")]
+    assert limiter.completion_tokens == 2
+    assert run(limiter, [("content", "more"), ("finish", "stop")]) == []
+
+
+def test_budget_used_up_exactly_finishes_with_length():
+    limiter = OutputLimiter(max_tokens=1)
+    assert run(limiter, [("content", "abcd")]) == [("content", "abcd"), ("finish", "length")]
+
+
+def test_reasoning_content_counts_toward_max_tokens():
+    limiter = OutputLimiter(max_tokens=1)
+    output = run(limiter, [("reasoning_content", "ab"), ("content", "cdef")])
+    assert output == [("reasoning_content", "ab"), ("content", "cd"), ("finish", "length")]
+
+
+def test_flushed_held_text_still_counts_toward_max_tokens():
+    limiter = OutputLimiter(max_tokens=1, stop=["xyz"])
+    output = run(limiter, [("content", "abx"), ("content", "y"), ("finish", "stop")])
+    assert output == [("content", "ab"), ("content", "xy"), ("finish", "length")]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""流中途出错时的 SSE 错误事件与响应开始前的错误格式一致"""
+
+import json
+
+import pytest
+
+import main
+
+
+def parse_events(text):
+    return [event[len("data: "):] for event in text.split("\n\n") if event.startswith("data: ")]
+
+
+@pytest.mark.parametrize("kind, code", [("error", 502), ("timeout", 504), ("limit", 502)])
+def test_error_segments_use_structured_errors(kind, code):
+    events = parse_events(main.encode_segment("chatcmpl-1", 0, "m", kind, "went wrong"))
+    assert events[-1] == "[DONE]"
+    assert json.loads(events[0]) == {"error": {"message": "went wrong", "type": "tenbin_api_error", "code": code}}
+    assert main.encode_segment("chatcmpl-1", 0, "m", kind, "went wrong") == main.encode_stream_error("went wrong", code)
+
+
+def test_content_segments_are_chunks():
+    events = parse_events(main.encode_segment("chatcmpl-1", 0, "m", "content", "hi"))
+    assert json.loads(events[0])["choices"][0]["delta"] == {"content": "hi"}
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""可续传 SSE 流：断线重连回放、过期丢弃、慢读者背压、总字节数上限和只允许发起请求的客户端重连"""
+
+import asyncio
+import types
+
+import pytest
+from fastapi import Depends, FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+import main
+import stream_replay
+from stream_replay import ReplayRegistry
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(stream_replay, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+
+def chunks(count, size=10):
+    async def events():
+        for i in range(count):
+            yield f"data: {i:0{size}d}\n\n"
+            await asyncio.sleep(0)
+
+    return events()
+
+
+def payloads(framed_events):
+    return [event.split("\n")[1] for event in framed_events if event.startswith("id: ")]
+
+
+async def read_all(registry, buffer, after_seq=0):
+    return [event async for event in registry.read(buffer, after_seq)]
+
+
+def test_reconnect_replays_from_last_event_id():
+    async def scenario():
+        registry = ReplayRegistry()
+        buffer = registry.start("s1", chunks(5))
+        first = registry.read(buffer)
+        received = [await first.__anext__(), await first.__anext__()]
+        await first.aclose()
+
+        last_event_id = received[-1].split("\n")[0][len("id: "):]
+        stream_id, seq = stream_replay.parse_event_id(last_event_id)
+        assert stream_id == "s1" and seq == 2
+        rest = await read_all(registry, registry.get(stream_id), seq)
+        assert payloads(received + rest) == [f"data: {i:010d}" for i in range(5)]
+        assert rest[-1].startswith("id: s1:5\n")
+
+    asyncio.run(scenario())
+
+
+def test_finished_streams_expire_after_ttl(clock):
+    async def scenario():
+        registry = ReplayRegistry(ttl=300)
+        buffer = registry.start("s1", chunks(3))
+        await read_all(registry, buffer)
+        await asyncio.sleep(0)
+        assert registry.get("s1") is buffer
+
+        clock.now += 301
+        assert registry.get("s1") is None
+        assert registry.bytes == 0
+
+    asyncio.run(scenario())
+
+
+def test_slow_reader_is_not_cut_off_by_the_per_stream_cap(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(stream_replay, "SSE_REPLAY_MAX_BYTES", 100)
+        registry = ReplayRegistry()
+        buffer = registry.start("s1", chunks(50))
+        reader = registry.read(buffer)
+        received = [await reader.__anext__()]
+        # 读者停住时上游暂停，缓冲不会无限增长，也不会丢弃读者还没读的事件
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert buffer.bytes <= buffer.max_bytes + 40
+        assert buffer.last_seq < 10 and not buffer.finished
+        received += [event async for event in reader]
+        assert payloads(received) == [f"data: {i:010d}" for i in range(50)]
+
+    asyncio.run(scenario())
+
+
+def test_total_bytes_cap_evicts_finished_buffers_first():
+    async def scenario():
+        registry = ReplayRegistry(total_bytes=1000)
+        old = registry.start("old", chunks(20))
+        await read_all(registry, old)
+        await asyncio.sleep(0)
+        assert registry.get("old") is old
+
+        new = registry.start("new", chunks(20))
+        await read_all(registry, new)
+        await asyncio.sleep(0)
+        assert registry.get("old") is None
+        assert registry.get("new") is new
+        assert registry.bytes <= registry.total_bytes
+
+    asyncio.run(scenario())
+
+
+def test_total_bytes_cap_holds_while_a_reader_lags():
+    async def scenario():
+        registry = ReplayRegistry(total_bytes=200)
+        buffer = registry.start("s1", chunks(50))
+        reader = registry.read(buffer)
+        received = [await reader.__anext__()]
+        for _ in range(20):
+            await asyncio.sleep(0)
+        assert registry.bytes <= registry.total_bytes + 40
+        assert buffer.last_seq < 10
+        received += [event async for event in reader]
+        assert len(payloads(received)) == 50
+
+    asyncio.run(scenario())
+
+
+def test_resume_position_outside_the_buffer_returns_410():
+    async def scenario():
+        registry = ReplayRegistry()
+        buffer = stream_replay.ReplayBuffer("s1", max_events=2)
+        buffer.append("data: a\n\ndata: b\n\ndata: c\n\n")
+        buffer.finish()
+        events = await read_all(registry, buffer, 0)
+        assert '"code": 410' in events[0]
+
+    asyncio.run(scenario())
+
+
+@pytest.fixture
+def finished_stream(monkeypatch):
+    registry = ReplayRegistry()
+    monkeypatch.setattr(stream_replay, "replay_registry", registry)
+    buffer = stream_replay.ReplayBuffer("s1", registry=registry, owner=main.client_id_for_key("key-a"))
+    buffer.append("data: secret\n\n")
+    buffer.finish()
+    registry._retire(buffer)
+    return buffer
+
+
+def test_only_the_owner_can_resume_a_stream(finished_stream, monkeypatch):
+    monkeypatch.setattr(main, "VALID_CLIENT_KEYS", {"key-a", "key-b"})
+    app = FastAPI()
+    app.include_router(stream_replay.stream_replay_router, dependencies=[Depends(main.authenticate_client)])
+    with TestClient(app) as client:
+        for headers in ({}, {"Last-Event-ID": "s1:0"}):
+            response = client.get("/v1/chat/completions/s1/events", headers={"Authorization": "Bearer key-b", **headers})
+            assert response.status_code == 404
+        response = client.get("/v1/chat/completions/s1/events", headers={"Authorization": "Bearer key-a"})
+        assert response.status_code == 200 and "data: secret" in response.text
+
+
+def test_last_event_id_on_post_checks_the_owner(finished_stream):
+    # POST /v1/chat/completions 带 Last-Event-ID 时同样经 resume_response 按客户端校验
+    with pytest.raises(HTTPException) as excinfo:
+        stream_replay.resume_response("s1:0", main.client_id_for_key("key-b"))
+    assert excinfo.value.status_code == 404
+    assert stream_replay.resume_response("s1:0", main.client_id_for_key("key-a")).status_code == 200
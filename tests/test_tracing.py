@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""链路追踪：一次聊天完成产生的 span 树（需要 opentelemetry-sdk），以及追踪关闭时的空操作路径"""
+
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import main
+import tracing
+from circuit_breaker import CircuitBreaker
+from model_router import ModelRouter
+
+
+@pytest.fixture
+def chat_app(monkeypatch):
+    """只挂载聊天完成的应用，上游换成固定输出的替身，外层套 TracingMiddleware"""
+    account = {"session_id": "session-0001", "is_valid": True, "last_used": 0.0, "error_count": 0}
+    monkeypatch.setattr(main, "TENBIN_MODELS", {"m": "id-m"})
+    monkeypatch.setattr(main, "TENBIN_ACCOUNTS", [account])
+    monkeypatch.setattr(main, "HEDGE_ENABLED", False)
+    monkeypatch.setattr(main, "token_breaker", CircuitBreaker("token_issuance", 5))
+    monkeypatch.setattr(main, "stream_breaker", CircuitBreaker("websocket_subscription", 5))
+    monkeypatch.setattr(main, "model_router", ModelRouter())
+    monkeypatch.setattr(main, "get_tenbin_execution_token", lambda model, session_id, deadline: "exec-token")
+
+    def iter_segments(model, prompt, session_id, execution_token, **kwargs):
+        yield ("content", "hello")
+        yield ("finish", "stop")
+
+    monkeypatch.setattr(main, "iter_tenbin_segments", iter_segments)
+
+    app = FastAPI()
+
+    @app.post("/v1/chat/completions")
+    async def completions(body: dict):
+        request = main.ChatCompletionRequest(**{**body, "stream": False})
+        return (await main.run_chat_completion(request)).model_dump()
+
+    return tracing.TracingMiddleware(app)
+
+
+def complete(app):
+    with TestClient(app) as client:
+        response = client.post("/v1/chat/completions", json={"model": "m", "messages": [{"role": "user", "content": "hi"}]})
+    assert response.status_code == 200
+    assert response.json()["choices"][0]["message"]["content"] == "hello"
+
+
+def test_chat_completion_exports_a_span_tree(chat_app, monkeypatch):
+    pytest.importorskip("opentelemetry.sdk")
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()  # 默认全部采样
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "_provider", provider)
+    monkeypatch.setattr(tracing, "_tracer", provider.get_tracer("test"))
+
+    complete(chat_app)
+
+    spans = {span.name: span for span in exporter.get_finished_spans()}
+    assert {"chat.completion", "prompt.build", "upstream.token", "upstream.session"} <= set(spans)
+    assert {"upstream.first_delta", "upstream.streaming"} <= set(spans)
+    root = spans["chat.completion"]
+    assert root.parent is None
+    assert root.attributes["http.response.status_code"] == 200
+    assert {span.context.trace_id for span in spans.values()} == {root.context.trace_id}
+    # 上游线程中创建的阶段 span 挂在会话 span 下，会话 span 挂在根 span 下
+    session = spans["upstream.session"]
+    assert session.parent.span_id == root.context.span_id
+    assert spans["upstream.streaming"].parent.span_id == session.context.span_id
+    assert session.attributes["finish_reason"] == "stop"
+
+
+def test_noop_path_when_tracing_is_off(chat_app, monkeypatch):
+    monkeypatch.setattr(tracing, "_tracer", None)
+    # 追踪关闭时所有辅助函数返回同一个空操作对象，不创建任何 span
+    with tracing.span("auth") as auth_span:
+        assert auth_span is tracing.NOOP_SPAN
+    assert tracing.current_span() is tracing.NOOP_SPAN
+    assert tracing.start_span("upstream.session") is tracing.NOOP_SPAN
+    assert tracing.start_span("upstream.first_delta", parent=tracing.NOOP_SPAN) is tracing.NOOP_SPAN
+    with tracing.use_span(tracing.NOOP_SPAN) as used:
+        assert used is tracing.NOOP_SPAN
+    assert tracing.tracing_stats()["enabled"] is False
+
+    # 中间件直接把原始的 send 交给应用，不包装
+    received = []
+
+    async def inner(scope, receive, send):
+        received.append(send)
+
+    async def send(message):
+        pass
+
+    scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions", "headers": []}
+    asyncio.run(tracing.TracingMiddleware(inner)(scope, None, send))
+    assert received == [send]
+
+    complete(chat_app)
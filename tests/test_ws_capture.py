@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""上游抓包的脱敏与无网络回放"""
+
+import gzip
+import json
+import os
+
+import main
+import ws_capture
+
+SAMPLE_CAPTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "sample_capture.ndjson.gz")
+SAMPLE_REPLY = "Hello! 这是一个回放测试。\n\n```python\nprint(1)\n```"
+
+
+def replay_segments(speed: float = 0, **kwargs):
+    transport = ws_capture.ReplayTransport.from_file(SAMPLE_CAPTURE, speed)
+    segments = list(main.iter_tenbin_segments("Claude-3.7-Sonnet", "prompt", "", "", transport=transport, **kwargs))
+    return transport, segments
+
+
+def test_replay_yields_recorded_deltas():
+    transport, segments = replay_segments()
+    assert "".join(value for kind, value in segments if kind == "content") == SAMPLE_REPLY
+    assert segments[-2] == ("state", "<redacted>")
+    assert segments[-1] == ("finish", "stop")
+    assert json.loads(transport.sent[0]) == {"type": "connection_init"}
+    assert json.loads(transport.sent[1])["payload"]["variables"]["prompt"] == "prompt"
+
+
+def test_replay_is_deterministic_with_coalescing():
+    _, first = replay_segments(coalesce_ms=50)
+    _, second = replay_segments(coalesce_ms=50)
+    assert first == second
+    assert "".join(value for kind, value in first if kind == "content") == SAMPLE_REPLY
+
+
+def test_replay_capture_stats():
+    stats = ws_capture.replay_capture(SAMPLE_CAPTURE)
+    assert stats["errors"] == 0
+    assert stats["events"] == 8  # 角色增量 + 6 个增量 + 结束
+    assert stats["ttft_ms"] is not None
+
+
+def test_fixture_is_redacted():
+    with gzip.open(SAMPLE_CAPTURE, "rt", encoding="utf-8") as f:
+        text = f.read()
+    assert "secret" not in text
+    assert "<redacted>" in text
+
+
+class FakeSocket:
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    def send(self, frame):
+        self.sent.append(frame)
+
+    def recv(self):
+        return self.frames.pop(0)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_recording_redacts_prompt_and_tokens(tmp_path):
+    subscribe = json.dumps({
+        "type": "subscribe",
+        "payload": {"variables": {"prompt": 'Human: "quoted" secret', "executionToken": "exec", "stateToken": "state"}},
+    })
+    finished = json.dumps({"type": "next", "payload": {"data": {"startConversation": {"newStateToken": "next-state"}}}})
+    socket = FakeSocket([finished])
+    transport = ws_capture.RecordingTransport(socket, "model", capture_dir=str(tmp_path))
+    transport.send(subscribe)
+    transport.recv()
+    transport.close()
+
+    # 发给上游的帧不受影响
+    assert socket.sent == [subscribe]
+    frames = ws_capture.load_capture(transport.path)["frames"]
+    sent = json.loads(frames[0][2])["payload"]["variables"]
+    assert sent == {"prompt": "<redacted>", "executionToken": "<redacted>", "stateToken": "<redacted>"}
+    received = json.loads(frames[1][2])["payload"]["data"]["startConversation"]
+    assert received == {"newStateToken": "<redacted>"}
+
+
+def test_redact_keeps_empty_values():
+    frame = '{"stateToken":"","prompt":"x"}'
+    assert ws_capture.redact_frame(frame) == '{"stateToken":"","prompt":"<redacted>"}'
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+聊天请求的 OpenTelemetry 链路追踪
+每个 /v1/chat/completions 请求生成一棵 span 树：
+
+    chat.completion                     请求入口到最后一个字节发出，结束时记录 finish 事件和输出的事件数、字节数
+    ├── auth                            客户端 API Key 校验
+    ├── prompt.build                    上下文裁剪和提示拼接
+    ├── upstream.token                  获取执行令牌（每个尝试的账户一个）
+    └── upstream.session                一次上游会话（对冲、复用状态时有多个）
+        ├── ws.connect                  建立 WebSocket 连接
+        ├── ws.init                     connection_init 握手
+        ├── ws.subscribe                发送订阅请求
+        ├── upstream.first_delta        订阅到首个增量
+        └── upstream.streaming          首个增量到结束，记录增量数、字节数和结束原因
+
+采样在入口按 TRACING_SAMPLE_RATE 决定（头部采样）。客户端传入的 traceparent 默认忽略，否则任何客户端
+都能用 -01 标记强制采样；网关等可信上游时设置 TRACING_TRUST_PARENT=true，沿用其链路和采样标记。
+未采样的请求只创建不记录数据的 span；只有处于已采样链路内时才创建子 span，
+认证等被其他接口共用的函数不会产生孤立的链路。
+导出到本地 OTLP 收集器（TRACING_EXPORTER=otlp，地址由 OTEL_EXPORTER_OTLP_ENDPOINT 指定），
+或按大小滚动的 NDJSON 文件（TRACING_EXPORTER=file）。opentelemetry-sdk 为可选依赖，未安装时追踪不生效。
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Sequence
+
+from log_pipeline import LOG_DIR, RotatingNDJSONWriter, get_logger
+
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import propagate, trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, SpanExporter, SpanExportResult
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    from opentelemetry.trace import SpanKind, Status, StatusCode
+except ImportError:  # 可选依赖，缺少时追踪不生效
+    trace = None
+    SpanExporter = object
+
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "false").lower() == "true"
+TRACING_EXPORTER = os.environ.get("TRACING_EXPORTER", "file")  # otlp / file
+TRACING_SAMPLE_RATE = float(os.environ.get("TRACING_SAMPLE_RATE", "0.1"))  # 入口请求的采样比例
+TRACING_TRUST_PARENT = os.environ.get("TRACING_TRUST_PARENT", "false").lower() == "true"  # 是否沿用请求中的 traceparent
+TRACING_SERVICE_NAME = os.environ.get("OTEL_SERVICE_NAME", "tenbin-api")
+TRACING_FILE = os.environ.get("TRACING_FILE", os.path.join(LOG_DIR, "traces.ndjson"))
+TRACING_FILE_MAX_BYTES = int(os.environ.get("TRACING_FILE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACING_FILE_BACKUP_COUNT = int(os.environ.get("TRACING_FILE_BACKUP_COUNT", "5"))
+
+TRACED_PATHS = ("/v1/chat/completions",)
+
+logger = get_logger("tracing")
+
+_tracer = None
+_provider = None
+
+
+class NoopSpan:
+    """追踪关闭或不在已采样链路内时使用，所有操作都是空操作"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, attributes):
+        pass
+
+    def add_event(self, name, attributes=None):
+        pass
+
+    def set_error(self, message: str):
+        pass
+
+    def end(self):
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class RecordingSpan:
+    """对 OpenTelemetry span 的薄包装，统一错误标记"""
+
+    __slots__ = ("span",)
+
+    def __init__(self, span):
+        self.span = span
+
+    def set_attribute(self, key, value):
+        self.span.set_attribute(key, value)
+
+    def set_attributes(self, attributes):
+        self.span.set_attributes(attributes)
+
+    def add_event(self, name, attributes=None):
+        self.span.add_event(name, attributes or {})
+
+    def set_error(self, message: str):
+        self.span.set_status(Status(StatusCode.ERROR, message))
+
+    def end(self):
+        self.span.end()
+
+    def is_recording(self) -> bool:
+        return True
+
+
+class RotatingJSONSpanExporter(SpanExporter):
+    """把结束的 span 逐行写入按大小滚动的 NDJSON 文件"""
+
+    def __init__(self, path: str = TRACING_FILE):
+        self._writer = RotatingNDJSONWriter(path, TRACING_FILE_MAX_BYTES, TRACING_FILE_BACKUP_COUNT)
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence) -> "SpanExportResult":
+        lines = [json.dumps(span_record(span), ensure_ascii=False) + "\n" for span in spans]
+        try:
+            with self._lock:
+                self._writer.write(lines)
+        except OSError as e:
+            logger.warning("Could not write %d spans: %s", len(lines), e)
+            return SpanExportResult.FAILURE
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        with self._lock:
+            self._writer.close()
+
+
+def span_record(span) -> Dict:
+    context = span.context
+    return {
+        "trace_id": format(context.trace_id, "032x"),
+        "span_id": format(context.span_id, "016x"),
+        "parent_id": format(span.parent.span_id, "016x") if span.parent else None,
+        "name": span.name,
+        "start_ns": span.start_time,
+        "duration_ms": round((span.end_time - span.start_time) / 1e6, 3),
+        "status": span.status.status_code.name,
+        "attributes": dict(span.attributes),
+        "events": [
+            {"name": event.name, "offset_ms": round((event.timestamp - span.start_time) / 1e6, 3), **event.attributes}
+            for event in span.events
+        ],
+    }
+
+
+def configure_tracing() -> bool:
+    """按环境变量初始化 TracerProvider，返回追踪是否生效"""
+    global _tracer, _provider
+    if not TRACING_ENABLED:
+        return False
+    if trace is None:
+        print("TRACING_ENABLED is set but opentelemetry-sdk is not installed. Tracing disabled.")
+        return False
+    if _tracer is not None:
+        return True
+    if TRACING_EXPORTER == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            print("opentelemetry-exporter-otlp-proto-http is not installed. Tracing disabled.")
+            return False
+        exporter = OTLPSpanExporter()
+    else:
+        exporter = RotatingJSONSpanExporter()
+    _provider = TracerProvider(
+        resource=Resource.create({"service.name": TRACING_SERVICE_NAME}),
+        sampler=ParentBased(TraceIdRatioBased(TRACING_SAMPLE_RATE)),
+    )
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    _tracer = _provider.get_tracer("tenbin")
+    print(f"Tracing enabled: exporter={TRACING_EXPORTER}, sample rate={TRACING_SAMPLE_RATE}")
+    return True
+
+
+def shutdown_tracing():
+    """导出缓冲中剩余的 span"""
+    global _tracer, _provider
+    if _provider is not None:
+        _provider.shutdown()
+    _tracer = _provider = None
+
+
+def _parent_recording() -> bool:
+    return _tracer is not None and trace.get_current_span().is_recording()
+
+
+def current_span():
+    """当前已采样的 span；不在链路内时返回空操作对象"""
+    if not _parent_recording():
+        return NOOP_SPAN
+    return RecordingSpan(trace.get_current_span())
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """在当前链路内创建子 span 并设为当前 span；不在已采样链路内时不做任何事"""
+    if not _parent_recording():
+        yield NOOP_SPAN
+        return
+    with _tracer.start_as_current_span(name, attributes=attributes, record_exception=False) as otel_span:
+        wrapped = RecordingSpan(otel_span)
+        try:
+            yield wrapped
+        except BaseException as e:
+            wrapped.set_error(f"{type(e).__name__}: {e}")
+            raise
+
+
+def start_span(name: str, parent=None, **attributes):
+    """创建子 span 但不设为当前 span，由调用方 end()，用于跨越多个回调的阶段"""
+    if parent is None:
+        if not _parent_recording():
+            return NOOP_SPAN
+        return RecordingSpan(_tracer.start_span(name, attributes=attributes))
+    if not parent.is_recording():
+        return NOOP_SPAN
+    parent_context = trace.set_span_in_context(parent.span)
+    return RecordingSpan(_tracer.start_span(name, context=parent_context, attributes=attributes))
+
+
+@contextmanager
+def use_span(wrapped):
+    """在其他线程中把 wrapped 设为当前 span，使其中创建的 span 成为它的子 span"""
+    if not wrapped.is_recording():
+        yield wrapped
+        return
+    token = otel_context.attach(trace.set_span_in_context(wrapped.span))
+    try:
+        yield wrapped
+    finally:
+        otel_context.detach(token)
+
+
+class TracingMiddleware:
+    """纯 ASGI 中间件：为聊天请求创建根 span，覆盖到流式响应的最后一个字节"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if _tracer is None or scope["type"] != "http" or scope["path"] not in TRACED_PATHS:
+            await self.app(scope, receive, send)
+            return
+        # 只在配置为可信时沿用请求中的 traceparent，否则作为根 span 由采样器按比例决定
+        parent = None
+        if TRACING_TRUST_PARENT:
+            carrier = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+            parent = propagate.extract(carrier)
+        status_code = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        with _tracer.start_as_current_span(
+            "chat.completion",
+            context=parent,
+            kind=SpanKind.SERVER,
+            attributes={"http.request.method": scope["method"], "url.path": scope["path"]},
+            record_exception=False,
+        ) as root:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                root.set_attribute("http.response.status_code", status_code)
+                if status_code >= 500:
+                    root.set_status(Status(StatusCode.ERROR))
+
+
+def tracing_stats() -> Dict:
+    return {
+        "enabled": _tracer is not None,
+        "exporter": TRACING_EXPORTER if _tracer is not None else None,
+        "sample_rate": TRACING_SAMPLE_RATE,
+        "trust_parent": TRACING_TRUST_PARENT,
+    }
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游延迟统计与请求对冲策略
+记录每个模型最近的首字时间（TTFT），据此计算对冲阈值；对冲次数受全局比例上限约束。
+"""
+
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+HEDGE_ENABLED = os.environ.get("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "95"))  # 超过该分位数的首字时间即发起对冲
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "20"))  # 样本不足时使用默认阈值
+HEDGE_DEFAULT_DELAY = float(os.environ.get("HEDGE_DEFAULT_DELAY", "8.0"))  # 秒
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "1.0"))  # 秒，阈值下限，避免过早对冲
+HEDGE_MAX_RATE = float(os.environ.get("HEDGE_MAX_RATE", "0.1"))  # 对冲请求占全部请求的最大比例
+HEDGE_RATE_WINDOW = 60.0  # 秒
+TTFT_SAMPLE_WINDOW = 200  # 每个模型保留的最近样本数
+
+
+class TTFTTracker:
+    """按模型记录最近的首字时间样本"""
+
+    def __init__(self, window: int = TTFT_SAMPLE_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, ttft: float):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(ttft)
+
+    def percentile(self, model: str, pct: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            samples = list(self._samples.get(model, ()))
+        if len(samples) < max(min_samples, 1):
+            return None
+        samples.sort()
+        index = min(len(samples) - 1, max(0, math.ceil(pct / 100.0 * len(samples)) - 1))
+        return samples[index]
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            models = list(self._samples)
+        result = {}
+        for model in models:
+            result[model] = {
+                "samples": len(self._samples.get(model, ())),
+                "p50": self.percentile(model, 50),
+                "p95": self.percentile(model, 95),
+                "p99": self.percentile(model, 99),
+            }
+        return result
+
+
+class HedgeBudget:
+    """限制对冲请求在滑动窗口内占全部请求的比例"""
+
+    def __init__(self, max_rate: float = HEDGE_MAX_RATE, window: float = HEDGE_RATE_WINDOW):
+        self.max_rate = max_rate
+        self.window = window
+        self._requests: Deque[float] = deque()
+        self._hedges: Deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now: float):
+        cutoff = now - self.window
+        while self._requests and self._requests[0] < cutoff:
+            self._requests.popleft()
+        while self._hedges and self._hedges[0] < cutoff:
+            self._hedges.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_acquire(self) -> bool:
+        """允许发起一次对冲时返回 True 并计入预算"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            if len(self._hedges) + 1 > max(1.0, self.max_rate * len(self._requests)):
+                return False
+            self._hedges.append(now)
+            return True
+
+
+class HedgeMetrics:
+    """对冲的触发和胜出次数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "fired": 0, "won": 0, "skipped_budget": 0, "skipped_no_account": 0}
+
+    def incr(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            data = dict(self.counters)
+        data["fire_rate"] = round(data["fired"] / data["requests"], 4) if data["requests"] else 0.0
+        data["win_rate"] = round(data["won"] / data["fired"], 4) if data["fired"] else 0.0
+        return data
+
+
+ttft_tracker = TTFTTracker()
+hedge_budget = HedgeBudget()
+hedge_metrics = HedgeMetrics()
+
+
+def hedge_delay(model: str) -> float:
+    """对冲阈值：该模型最近 TTFT 的高分位数，样本不足时使用默认值"""
+    observed = ttft_tracker.percentile(model, HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+    if observed is None:
+        return HEDGE_DEFAULT_DELAY
+    return max(observed, HEDGE_MIN_DELAY)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+上游 WebSocket 会话的录制与回放
+录制：按采样率把 graphql-transport-ws 原始帧及其时间偏移写入 gzip 压缩的 NDJSON 抓包文件
+回放：ReplayTransport 按原始速度或加速把抓包喂给 tenbin_stream_generator，无需网络
+
+抓包文件格式：
+    第一行为头部 {"version": 1, "model": ..., "created": ...}
+    之后每行一帧 [偏移毫秒, "in"|"out", 帧内容]
+
+写入前去掉帧中的用户提示、执行令牌和会话状态令牌（stateToken / newStateToken），
+回放只依赖上游返回的增量，不需要这些内容。
+"""
+
+import argparse
+import glob
+import gzip
+import json
+import os
+import random
+import re
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import websocket
+
+CAPTURE_DIR = os.environ.get("CAPTURE_DIR", "captures")
+CAPTURE_SAMPLE_RATE = float(os.environ.get("CAPTURE_SAMPLE_RATE", "0"))  # 0 表示不录制
+CAPTURE_VERSION = 1
+
+_SECRET_PATTERN = re.compile(r'"(executionToken|stateToken|newStateToken|prompt)"\s*:\s*"(?:[^"\\]|\\.)+"')
+
+
+def should_capture() -> bool:
+    """按采样率决定是否录制本次会话"""
+    return CAPTURE_SAMPLE_RATE > 0 and random.random() < CAPTURE_SAMPLE_RATE
+
+
+def redact_frame(frame: str) -> str:
+    """去掉帧中的用户提示和令牌，空值保持为空串"""
+    return _SECRET_PATTERN.sub(r'"\1":"<redacted>"', frame)
+
+
+class RecordingTransport:
+    """包装真实的 WebSocket 连接，边收发边把帧写入抓包文件"""
+
+    def __init__(self, ws, model: str, capture_dir: str = CAPTURE_DIR):
+        self.ws = ws
+        os.makedirs(capture_dir, exist_ok=True)
+        self.path = os.path.join(capture_dir, f"{int(time.time())}-{uuid.uuid4().hex[:8]}.ndjson.gz")
+        self._file = gzip.open(self.path, "wt", encoding="utf-8")
+        self._start = time.monotonic()
+        self._write_line({"version": CAPTURE_VERSION, "model": model, "created": int(time.time())})
+
+    def _write_line(self, item: Any):
+        self._file.write(json.dumps(item, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def _record(self, direction: str, frame: str):
+        if self._file is not None:
+            offset_ms = int((time.monotonic() - self._start) * 1000)
+            self._write_line([offset_ms, direction, frame])
+
+    def send(self, frame: str):
+        self._record("out", redact_frame(frame))
+        return self.ws.send(frame)
+
+    def recv(self) -> str:
+        frame = self.ws.recv()
+        self._record("in", redact_frame(frame))
+        return frame
+
+    def settimeout(self, timeout: Optional[float]):
+        self.ws.settimeout(timeout)
+
+    def abort(self):
+        # 可从其他线程调用，抓包文件由读取线程在 close 中关闭
+        self.ws.abort()
+
+    def close(self):
+        try:
+            self.ws.close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def load_capture(path: str) -> Dict[str, Any]:
+    """读取抓包文件，返回头部和帧列表"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"Unsupported capture version: {header.get('version')}")
+        frames = [json.loads(line) for line in f if line.strip()]
+    return {"header": header, "frames": frames}
+
+
+class ReplayTransport:
+    """按抓包中的时间回放上游帧，接口与 websocket-client 的连接一致
+
+    speed 为 1 时按原始节奏回放，大于 1 时加速，为 0 时不等待。
+    """
+
+    def __init__(self, capture: Dict[str, Any], speed: float = 1.0):
+        self.header = capture["header"]
+        self._frames: List[List[Any]] = [frame for frame in capture["frames"] if frame[1] == "in"]
+        self._index = 0
+        self.speed = speed
+        self.sent: List[str] = []
+        self.timeout: Optional[float] = None
+        self.closed = False
+        self._start = time.monotonic()
+
+    @classmethod
+    def from_file(cls, path: str, speed: float = 1.0) -> "ReplayTransport":
+        return cls(load_capture(path), speed)
+
+    def send(self, frame: str):
+        if self.closed:
+            raise websocket.WebSocketConnectionClosedException("Replay transport is closed")
+        self.sent.append(frame)
+
+    def settimeout(self, timeout: Optional[float]):
+        self.timeout = timeout
+
+    def recv(self) -> str:
+        if self.closed or self._index >= len(self._frames):
+            raise websocket.WebSocketConnectionClosedException("Capture exhausted")
+
+        offset_ms, _, frame = self._frames[self._index]
+        if self.speed > 0:
+            wait = self._start + offset_ms / 1000.0 / self.speed - time.monotonic()
+            if wait > 0:
+                if self.timeout is not None and wait > self.timeout:
+                    time.sleep(self.timeout)
+                    raise websocket.WebSocketTimeoutException("Replay recv timed out")
+                time.sleep(wait)
+        self._index += 1
+        return frame
+
+    def close(self):
+        self.closed = True
+
+    def abort(self):
+        self.close()
+
+
+def replay_capture(path: str, speed: float = 0, model: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+    """把一个抓包回放进 tenbin_stream_generator，返回事件数、字节数和首字时间等统计"""
+    from main import tenbin_stream_generator
+
+    transport = ReplayTransport.from_file(path, speed)
+    model = model or transport.header.get("model", "")
+    start = time.perf_counter()
+    first_delta_at = None
+    events = 0
+    total_bytes = 0
+    errors = 0
+    for event in tenbin_stream_generator(model, "", "", "", transport=transport, **kwargs):
+        events += 1
+        total_bytes += len(event)
+        if first_delta_at is None and ('"content"' in event or '"reasoning_content"' in event):
+            first_delta_at = time.perf_counter()
+        if '"error"' in event:
+            errors += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "capture": os.path.basename(path),
+        "model": model,
+        "events": events,
+        "bytes": total_bytes,
+        "errors": errors,
+        "ttft_ms": round((first_delta_at - start) * 1000, 2) if first_delta_at else None,
+        "total_ms": round(elapsed * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded Tenbin WebSocket captures")
+    parser.add_argument("paths", nargs="*", help="capture files (default: all files in CAPTURE_DIR)")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 1 = original timing, 0 = no waits")
+    parser.add_argument("--model", default=None, help="override the model recorded in the capture")
+    parser.add_argument("--coalesce-ms", type=int, default=None)
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob(os.path.join(CAPTURE_DIR, "*.ndjson.gz")))
+    if not paths:
+        print(f"No captures found in {CAPTURE_DIR}")
+        return
+    for path in paths:
+        stats = replay_capture(path, args.speed, args.model, coalesce_ms=args.coalesce_ms)
+        print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()